@@ -13,6 +13,8 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // API端點 - 部署後替換為實際API Gateway URL
     const API_ENDPOINT = 'https://9kv632fosa.execute-api.us-west-2.amazonaws.com/prod/assistant';
+    // 串流端點 - 設定後以NDJSON串流逐段顯示回應（例如本地伺服器 http://localhost:8080/），留空則使用一般API
+    const STREAM_ENDPOINT = '';
     
     // 用戶和會話ID
     const userId = 'user_' + Date.now();
@@ -121,10 +123,109 @@ document.addEventListener('DOMContentLoaded', function() {
         
         chatBox.appendChild(messageDiv);
         chatBox.scrollTop = chatBox.scrollHeight;
+        return messageDiv;
+    }
+    
+    // 根據回應的中繼資料更新專業度背景與網絡搜索指示器
+    function applyResponseMeta(expertiseLevel, webSearchUsed) {
+        setTimeout(() => {
+            setBackgroundColorByExpertise(expertiseLevel);
+            document.body.setAttribute('data-expertise', expertiseLevel);
+        }, 10);
+        
+        if (webSearchUsed) {
+            webSearchIndicator.style.display = 'block';
+            setTimeout(() => {
+                webSearchIndicator.style.display = 'none';
+            }, 5000);
+        }
+    }
+    
+    // 串流請求：逐行解析NDJSON事件並即時渲染回應
+    async function sendStreamingRequest(data) {
+        console.log("Sending streaming request:", data);
+        let messageDiv = null;
+        let responseText = '';
+        let renderScheduled = false;
+        
+        // 以animation frame節流Markdown重繪
+        const scheduleRender = () => {
+            if (renderScheduled) return;
+            renderScheduled = true;
+            requestAnimationFrame(() => {
+                renderScheduled = false;
+                try {
+                    messageDiv.innerHTML = marked.parse(responseText);
+                } catch (error) {
+                    messageDiv.textContent = responseText;
+                }
+                chatBox.scrollTop = chatBox.scrollHeight;
+            });
+        };
+        
+        const handleEvent = (event) => {
+            if (event.type === 'meta') {
+                applyResponseMeta(event.expertise_level || 'beginner', event.web_search_used || false);
+            } else if (event.type === 'delta') {
+                if (!messageDiv) {
+                    // 收到第一段文字時隱藏載入動畫
+                    loader.style.display = 'none';
+                    messageDiv = addMessage(' ', 'assistant');
+                }
+                responseText += event.text;
+                scheduleRender();
+            } else if (event.type === 'error') {
+                throw new Error(event.error);
+            }
+        };
+        
+        try {
+            const response = await fetch(STREAM_ENDPOINT, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ ...data, stream: true })
+            });
+            if (!response.ok) {
+                throw new Error(`網絡請求失敗: ${response.status}`);
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder('utf-8');
+            let buffer = '';
+            
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                let newlineIndex;
+                while ((newlineIndex = buffer.indexOf('\n')) >= 0) {
+                    const line = buffer.slice(0, newlineIndex).trim();
+                    buffer = buffer.slice(newlineIndex + 1);
+                    if (line) handleEvent(JSON.parse(line));
+                }
+            }
+            if (buffer.trim()) handleEvent(JSON.parse(buffer));
+            
+            loader.style.display = 'none';
+            if (!messageDiv) {
+                addMessage("收到無效的回應格式，請稍後再試。", 'assistant');
+            }
+        } catch (error) {
+            loader.style.display = 'none';
+            console.error('Streaming request error:', error);
+            addMessage(`發生錯誤: ${error.message}`, 'assistant');
+        }
     }
     
     // 發送API請求
     function sendRequest(data) {
+        if (STREAM_ENDPOINT) {
+            sendStreamingRequest(data);
+            return;
+        }
         console.log("Sending request to API:", data);
         fetch(API_ENDPOINT, {
             method: 'POST',
@@ -1,26 +1,80 @@
 import json
 import boto3
+import importlib
+import importlib.util
+import contextvars
 import os
 import io
 import base64
+import hashlib
+import uuid
+import zlib
+import itertools
+import threading
 import requests
-import pandas as pd
-import numpy as np
 import re
 import time
-from urllib.parse import unquote_plus
-from bs4 import BeautifulSoup
+from urllib.parse import unquote_plus, urlsplit, urlunsplit, parse_qsl, urlencode
+from html.parser import HTMLParser
 from datetime import datetime
+from collections import OrderedDict, namedtuple
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 import traceback
+import random
+from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# 初始化AWS客戶端
-bedrock = boto3.client('bedrock-runtime')
-kendra = boto3.client('kendra')
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-textract = boto3.client('textract')     
-rekognition = boto3.client('rekognition')  
-comprehend = boto3.client('comprehend')   
+# 延遲初始化的耗時紀錄（秒），供冷啟動分析
+lazy_init_timings = {}
+
+class LazyProxy:
+    """延遲建立的代理物件：第一次存取屬性時才呼叫factory，之後在熱啟動的調用之間重複使用"""
+    
+    # boto3預設Session不是執行緒安全的，建立時一律串行（可重入，供巢狀建立）
+    _creation_lock = threading.RLock()
+    
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+    
+    def _resolve(self):
+        instance = self._instance
+        if instance is None:
+            with LazyProxy._creation_lock:
+                if self._instance is None:
+                    started = time.monotonic()
+                    with trace_span(f"init.{self._name}"):
+                        self._instance = self._factory()
+                    lazy_init_timings[self._name] = round(time.monotonic() - started, 4)
+                instance = self._instance
+        return instance
+    
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+    
+    def __repr__(self):
+        state = 'loaded' if self._instance is not None else 'not loaded'
+        return f"<LazyProxy {self._name} ({state})>"
+
+# 初始化AWS客戶端（第一次使用時才建立）
+bedrock = LazyProxy('bedrock', lambda: instrument_client(boto3.client('bedrock-runtime')))
+kendra = LazyProxy('kendra', lambda: instrument_client(boto3.client('kendra')))
+s3 = LazyProxy('s3', lambda: instrument_client(boto3.client('s3')))
+dynamodb = LazyProxy('dynamodb', lambda: instrument_resource(boto3.resource('dynamodb')))
+textract = LazyProxy('textract', lambda: instrument_client(boto3.client('textract')))
+rekognition = LazyProxy('rekognition', lambda: instrument_client(boto3.client('rekognition')))
+comprehend = LazyProxy('comprehend', lambda: instrument_client(boto3.client('comprehend')))
+
+# 大型套件只在需要時載入：pandas用於Excel/CSV，numpy用於向量與成分運算
+pd = LazyProxy('pandas', lambda: importlib.import_module('pandas'))
+np = LazyProxy('numpy', lambda: importlib.import_module('numpy'))
+# lxml只用於網頁抽取；冷啟動時只確認是否已安裝，第一次抽取網頁時才載入
+LXML_AVAILABLE = importlib.util.find_spec('lxml') is not None
+lxml_etree = LazyProxy('lxml', lambda: importlib.import_module('lxml.etree'))
 
 # 環境變數
 KENDRA_INDEX_ID = os.environ.get('KENDRA_INDEX_ID', 'bb62d174-7a66-495c-9fdd-cad8d7d2c223')
@@ -30,193 +84,1357 @@ GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY', '')
 GOOGLE_SEARCH_ENGINE_ID = os.environ.get('GOOGLE_SEARCH_ENGINE_ID', '')
 WEB_SEARCH_ENABLED = os.environ.get('WEB_SEARCH_ENABLED', 'false').lower() == 'true'
 BEDROCK_WEB_SEARCH = os.environ.get('BEDROCK_WEB_SEARCH', 'false').lower() == 'true'
+# 內部推理模式：off直接回答；adaptive依問題複雜度選擇推理深度
+INTERNAL_REASONING = os.environ.get('INTERNAL_REASONING', 'off')
+
+GOOGLE_SEARCH_ENDPOINT = os.environ.get('GOOGLE_SEARCH_ENDPOINT', 'https://www.googleapis.com/customsearch/v1')
+WEB_SEARCH_WORKERS = int(os.environ.get('WEB_SEARCH_WORKERS', '10'))
+
+# 對外HTTP連線設定（連線池、逾時與重試）
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '20'))
+HTTP_POOL_PER_HOST = int(os.environ.get('HTTP_POOL_PER_HOST', '10'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))
+SCRAPE_TOP_N = int(os.environ.get('SCRAPE_TOP_N', '3'))
+SCRAPE_WORKERS = int(os.environ.get('SCRAPE_WORKERS', '4'))
+SCRAPE_BUDGET = float(os.environ.get('SCRAPE_BUDGET', '3'))
+SCRAPE_MAX_BYTES = int(os.environ.get('SCRAPE_MAX_BYTES', str(1024 * 1024)))
+SCRAPE_CACHE_FRESH = int(os.environ.get('SCRAPE_CACHE_FRESH', '900'))
+SCRAPE_CACHE_TTL = int(os.environ.get('SCRAPE_CACHE_TTL', '86400'))
+SCRAPE_CACHE_SIZE = int(os.environ.get('SCRAPE_CACHE_SIZE', '128'))
+HTML_EXTRACTOR = os.environ.get('HTML_EXTRACTOR', 'auto')
+HTTP_USER_AGENT = os.environ.get(
+    'HTTP_USER_AGENT',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+)
+
+# 並行檢索的時間預算（秒）
+RETRIEVAL_BUDGET = float(os.environ.get('RETRIEVAL_BUDGET', '8'))
+HISTORY_TIMEOUT = float(os.environ.get('HISTORY_TIMEOUT', '2'))
+KENDRA_TIMEOUT = float(os.environ.get('KENDRA_TIMEOUT', '5'))
+WEB_SEARCH_TIMEOUT = float(os.environ.get('WEB_SEARCH_TIMEOUT', '8'))
+
+# 檔案分析結果快取（內容雜湊為鍵）
+ANALYSIS_CACHE_TTL = int(os.environ.get('ANALYSIS_CACHE_TTL', str(7 * 24 * 3600)))
+ANALYSIS_CACHE_SIZE = int(os.environ.get('ANALYSIS_CACHE_SIZE', '32'))
+
+# 非同步Textract作業設定
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get('TEXTRACT_SNS_TOPIC_ARN', '')
+TEXTRACT_SNS_ROLE_ARN = os.environ.get('TEXTRACT_SNS_ROLE_ARN', '')
+TEXTRACT_POLL_MAX_WAIT = float(os.environ.get('TEXTRACT_POLL_MAX_WAIT', '60'))
+
+# 對話歷史視窗：最近的對話以token預算截取，較舊的對話保留滾動摘要
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', '2000'))
+HISTORY_FETCH_LIMIT = int(os.environ.get('HISTORY_FETCH_LIMIT', '40'))
+HISTORY_SUMMARY_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TOKENS', '400'))
+
+# 提示組合的輸入token上限
+PROMPT_TOKEN_CEILING = int(os.environ.get('PROMPT_TOKEN_CEILING', '12000'))
+PROMPT_MIN_EXCERPT_TOKENS = int(os.environ.get('PROMPT_MIN_EXCERPT_TOKENS', '50'))
+# 最近一輪對話（最後一問一答）的保留預算上限，檢索摘錄再多也不會擠掉
+PROMPT_HISTORY_RESERVE_TOKENS = int(os.environ.get('PROMPT_HISTORY_RESERVE_TOKENS', '1000'))
+
+# 容器內的對話歷史快取（記憶體上限，位元組）
+SESSION_CACHE_MAX_BYTES = int(os.environ.get('SESSION_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# 對話寫入設定：auto在Lambda中使用內部擴充功能於回應送出後寫入，本地使用背景執行緒
+CONVERSATION_WRITE_MODE = os.environ.get('CONVERSATION_WRITE_MODE', 'auto')
+CONVERSATION_WRITE_RETRIES = int(os.environ.get('CONVERSATION_WRITE_RETRIES', '5'))
+
+# 請求追蹤：各階段耗時與token數以CloudWatch EMF輸出，可另寫入本地JSON Lines檔
+TRACE_EMF_ENABLED = os.environ.get('TRACE_EMF_ENABLED', 'true').lower() == 'true'
+TRACE_NAMESPACE = os.environ.get('TRACE_NAMESPACE', 'SteelAssistant')
+TRACE_LOCAL_SINK = os.environ.get('TRACE_LOCAL_SINK', '')
+
+# 答案快取設定
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', str(24 * 3600)))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', '256'))
+ANSWER_CACHE_TABLE = os.environ.get('ANSWER_CACHE_TABLE', '')
+
+# 語意快取設定（以嵌入向量比對改寫過的相似問題）
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', '5000'))
+SEMANTIC_CACHE_S3_PREFIX = os.environ.get('SEMANTIC_CACHE_S3_PREFIX', 'semantic-cache/index')
+# 新項目在回應送出後批次合併寫回S3的最短間隔（秒）
+SEMANTIC_CACHE_FLUSH_INTERVAL = float(os.environ.get('SEMANTIC_CACHE_FLUSH_INTERVAL', '60'))
+SEMANTIC_CACHE_MERGE_RETRIES = int(os.environ.get('SEMANTIC_CACHE_MERGE_RETRIES', '3'))
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'bedrock')
+EMBEDDING_MODEL_ID = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', '256'))
+
+# Kendra批次索引設定
+KENDRA_CHUNK_BYTES = int(os.environ.get('KENDRA_CHUNK_BYTES', '5000'))
+KENDRA_CHUNK_OVERLAP_BYTES = int(os.environ.get('KENDRA_CHUNK_OVERLAP_BYTES', '300'))
+KENDRA_CHUNK_ATTRIBUTES = os.environ.get('KENDRA_CHUNK_ATTRIBUTES', 'false').lower() == 'true'
+KENDRA_BATCH_SIZE = 10  # BatchPutDocument每次最多10份文檔
+KENDRA_MAX_BATCH_BYTES = int(os.environ.get('KENDRA_MAX_BATCH_BYTES', str(50 * 1024 * 1024)))
+KENDRA_INDEX_WORKERS = int(os.environ.get('KENDRA_INDEX_WORKERS', '4'))
+KENDRA_MAX_RETRIES = int(os.environ.get('KENDRA_MAX_RETRIES', '5'))
+
+# 本地鋼種對照資料
+GRADE_EQUIVALENCE_FILE = os.environ.get(
+    'GRADE_EQUIVALENCE_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grade_equivalence.json')
+)
+GRADE_LOOKUP_SHORT_CIRCUIT = os.environ.get('GRADE_LOOKUP_SHORT_CIRCUIT', 'false').lower() == 'true'
 
 # DynamoDB表引用
-conversation_table = dynamodb.Table(CONVERSATION_TABLE)
+conversation_table = LazyProxy('conversation_table', lambda: dynamodb.Table(CONVERSATION_TABLE))
+answer_cache_table = LazyProxy('answer_cache_table', lambda: dynamodb.Table(ANSWER_CACHE_TABLE)) if ANSWER_CACHE_TABLE else None
+
+# API回應共用的CORS標頭
+CORS_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': 'https://d185h9ecahpj1h.cloudfront.net',
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
+    'Access-Control-Allow-Methods': 'POST,OPTIONS'
+}
+
+# 檢索用執行緒池，在熱啟動的調用之間重複使用
+retrieval_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('RETRIEVAL_WORKERS', '8')))
+search_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_WORKERS)
+scrape_executor = ThreadPoolExecutor(max_workers=SCRAPE_WORKERS)
+
+# 目前請求的追蹤與所在區段路徑；提交到執行緒池時複製context一併傳遞
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span = contextvars.ContextVar('current_span', default='')
+trace_sink_lock = threading.Lock()
+
+class RequestTrace:
+    """單次請求的追蹤：記錄各階段的計時區段與Bedrock token數"""
+    
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.monotonic()
+        self.spans = []
+        self.tokens = {'input_tokens': 0, 'output_tokens': 0, 'bedrock_calls': 0}
+        self.properties = {}
+        self._lock = threading.Lock()
+    
+    def record(self, name, started, duration, error=None):
+        span = {
+            'name': name,
+            'start_ms': round((started - self.started) * 1000, 1),
+            'duration_ms': round(duration * 1000, 1)
+        }
+        if error:
+            span['error'] = error
+        with self._lock:
+            self.spans.append(span)
+    
+    def add_usage(self, usage):
+        with self._lock:
+            self.tokens['input_tokens'] += usage.get('input_tokens', 0) or 0
+            self.tokens['output_tokens'] += usage.get('output_tokens', 0) or 0
+            self.tokens['bedrock_calls'] += 1
+    
+    def annotate(self, **properties):
+        self.properties.update(properties)
+    
+    def stage_totals(self):
+        """依區段名稱（路徑最後一段）加總耗時，作為EMF指標"""
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            stage = span['name'].rsplit('/', 1)[-1]
+            totals[stage] = round(totals.get(stage, 0) + span['duration_ms'], 1)
+        return totals
+    
+    def timings(self):
+        """回應中選用的 timings 欄位"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start_ms'])
+        return {
+            'request_id': self.request_id,
+            'total_ms': round((time.monotonic() - self.started) * 1000, 1),
+            'stages': self.stage_totals(),
+            'spans': spans,
+            'tokens': dict(self.tokens),
+            **self.properties
+        }
+
+def record_span(name, started, error=None):
+    """在目前區段之下記錄一個已結束的區段（不改變目前區段，供串流與事件掛鉤使用）"""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    parent = current_span.get()
+    trace.record(f"{parent}/{name}" if parent else name, started, time.monotonic() - started, error)
+
+@contextmanager
+def trace_span(name):
+    """計時區段：期間內的子區段都記錄在此區段之下；沒有進行中的追蹤時不做任何事"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    parent = current_span.get()
+    path = f"{parent}/{name}" if parent else name
+    token = current_span.set(path)
+    started = time.monotonic()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        trace.record(path, started, time.monotonic() - started, error)
+
+def traced(name):
+    """裝飾器：把整個函數的執行記錄為一個區段"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def submit_traced(executor, func, *args):
+    """提交到執行緒池，並在工作執行緒中延續目前的追蹤"""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+def with_trace_context(func):
+    """包裝函數供 executor.map 使用：每次呼叫都在呼叫端context的副本中執行"""
+    context = contextvars.copy_context()
+    def run(*args):
+        return context.copy().run(func, *args)
+    return run
+
+def record_bedrock_usage(usage):
+    """把Bedrock回應中的token數累加到目前的追蹤"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_usage(usage or {})
+
+def start_aws_call_span(context=None, **kwargs):
+    """boto3 before-call事件：記錄AWS API呼叫的開始時間"""
+    if context is not None and current_trace.get() is not None:
+        context['trace_started'] = time.monotonic()
+        context['trace_name'] = f"{kwargs['model'].service_model.service_name}.{kwargs['model'].name}"
+
+def finish_aws_call_span(context=None, parsed=None, exception=None, **kwargs):
+    """boto3 after-call / after-call-error事件：把AWS API呼叫記錄為「服務.操作」區段"""
+    if context is None or 'trace_started' not in context:
+        return
+    started = context.pop('trace_started')
+    error = None
+    if exception is not None:
+        error = type(exception).__name__
+    elif parsed and parsed.get('Error'):
+        error = parsed['Error'].get('Code')
+    record_span(context.pop('trace_name'), started, error)
+
+def instrument_client(client):
+    """在boto3客戶端掛上計時事件，每次AWS API呼叫都成為目前請求的一個區段"""
+    client.meta.events.register('before-call.*.*', start_aws_call_span)
+    client.meta.events.register('after-call.*.*', finish_aws_call_span)
+    client.meta.events.register('after-call-error.*.*', finish_aws_call_span)
+    return client
+
+def instrument_resource(resource):
+    """boto3 resource 使用底層客戶端的事件"""
+    instrument_client(resource.meta.client)
+    return resource
+
+def emit_trace_metrics(trace):
+    """以CloudWatch Embedded Metric Format輸出一行追蹤紀錄，並可寫入本地JSON Lines檔"""
+    if not TRACE_EMF_ENABLED and not TRACE_LOCAL_SINK:
+        return
+    try:
+        timings = trace.timings()
+        metrics = dict(timings['stages'])
+        metrics['total'] = timings['total_ms']
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': TRACE_NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics] +
+                               [{'Name': name, 'Unit': 'Count'} for name in timings['tokens']]
+                }]
+            },
+            'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+            'RequestId': trace.request_id,
+            **metrics,
+            **timings['tokens'],
+            'spans': timings['spans'],
+            **trace.properties
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        if TRACE_EMF_ENABLED:
+            print(line)
+        if TRACE_LOCAL_SINK:
+            with trace_sink_lock, open(TRACE_LOCAL_SINK, 'a', encoding='utf-8') as sink:
+                sink.write(line + "\n")
+    except Exception as e:
+        print(f"輸出追蹤紀錄錯誤: {str(e)}")
+
+def http_timeout(deadline=None):
+    """回傳 (連線, 讀取) 逾時；有期限時讀取逾時不超過期限"""
+    if deadline is None:
+        return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return (min(HTTP_CONNECT_TIMEOUT, deadline), min(HTTP_READ_TIMEOUT, deadline))
+
+def build_http_session(headers=None):
+    """建立帶連線池、帶抖動的重試與gzip的Session，在熱啟動的調用之間重複使用"""
+    retry_options = {
+        'total': HTTP_MAX_RETRIES,
+        'status_forcelist': (429, 500, 502, 503, 504),
+        'allowed_methods': frozenset(['GET', 'HEAD']),
+        'backoff_factor': 0.3,
+        'respect_retry_after_header': True,
+        'raise_on_status': False
+    }
+    try:
+        retry = Retry(backoff_jitter=0.3, **retry_options)
+    except TypeError:
+        # 舊版urllib3沒有backoff_jitter
+        retry = Retry(**retry_options)
+    
+    # pool_connections為保留的主機數，pool_maxsize為每個主機的連線上限
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    if headers:
+        session.headers.update(headers)
+    return session
+
+# 搜索API與網頁抓取各用一個連線池
+http_sessions = {
+    'search': build_http_session(),
+    'scrape': build_http_session({'User-Agent': HTTP_USER_AGENT})
+}
+
+def http_pool_stats():
+    """統計各連線池的請求數與新建連線數，計算連線重用率"""
+    stats = {}
+    for name, session in http_sessions.items():
+        requests_made = 0
+        connections_made = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_made += pool.num_requests
+                connections_made += pool.num_connections
+        reuse_rate = 1 - connections_made / requests_made if requests_made else 0.0
+        stats[name] = {'requests': requests_made, 'connections': connections_made, 'reuse_rate': round(reuse_rate, 3)}
+    return stats
+
+class TTLCache:
+    """執行緒安全的LRU快取，項目超過TTL後失效，在熱啟動的調用之間保留"""
+    
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+# 檔案分析結果的容器內快取
+analysis_cache = TTLCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL)
+
+# 回答的容器內快取，DynamoDB為跨容器共享層
+answer_cache = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+# 網頁抓取快取：以URL為鍵，保存ETag/Last-Modified以便條件式請求
+scrape_cache = TTLCache(SCRAPE_CACHE_SIZE, SCRAPE_CACHE_TTL)
+
+class SessionCache:
+    """容器內的對話項目LRU快取，以記憶體上限淘汰；以中繼資料的序號與本容器已確認的寫入數驗證"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generations = itertools.count(1)
+    
+    @staticmethod
+    def _item_bytes(item):
+        return len(item['message'].encode('utf-8')) + 200
+    
+    def get(self, key, remote_seq):
+        """遠端序號恰好等於讀取時的序號加上本容器已確認的寫入數時命中
+        
+        尚未寫入的本容器對話已在快取中，不影響序號；只要有其他容器寫入，序號就會多出而不相符
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if remote_seq != entry['base_seq'] + entry['confirmed']:
+                # 其他容器寫入過（或本容器的寫入尚未確認），快取已過時
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return list(entry['items'])
+    
+    def store(self, key, items, seq):
+        """以查詢結果（由新到舊）取代快取內容"""
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            entry = {
+                'items': list(items[:HISTORY_FETCH_LIMIT]),
+                'base_seq': seq,
+                'confirmed': 0,
+                'generation': next(self._generations)
+            }
+            entry['bytes'] = sum(self._item_bytes(item) for item in entry['items'])
+            self._entries[key] = entry
+            self.total_bytes += entry['bytes']
+            self._evict()
+    
+    def append(self, key, new_items):
+        """加入剛排入寫入佇列的對話（由舊到新），返回快取項目的世代，供寫入完成時確認"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            items = list(reversed(new_items)) + entry['items']
+            self.total_bytes -= entry['bytes']
+            entry['items'] = items[:HISTORY_FETCH_LIMIT]
+            entry['bytes'] = sum(self._item_bytes(item) for item in entry['items'])
+            self.total_bytes += entry['bytes']
+            self._entries.move_to_end(key)
+            self._evict()
+            return entry['generation']
+    
+    def confirm_write(self, key, generation):
+        """本容器的序號遞增已寫入；只計入加入時的同一快取項目，重新讀取後的項目已包含該次寫入"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['generation'] == generation:
+                entry['confirmed'] += 1
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry['bytes']
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._drop(oldest_key)
+
+session_cache = SessionCache(SESSION_CACHE_MAX_BYTES)
+
+# 鋼種別名所屬的成分標準體系
+ALIAS_COMPOSITION_SYSTEMS = {
+    'UNS': 'ASTM', 'UNS_ALT': 'ASTM', 'AISI': 'ASTM', 'COMMON': 'ASTM',
+    'JIS': 'JIS',
+    'EN': 'EN', 'EN_NAME': 'EN'
+}
+
+def normalize_grade_token(token):
+    """正規化鋼種名稱：大寫並移除空白、連字符與UNS/AISI等前綴"""
+    token = re.sub(r'[\s\-]+', '', token.upper())
+    return re.sub(r'^(UNS|AISI|TYPE|TP)', '', token)
+
+class GradeEquivalenceIndex:
+    """由版本化資料檔建立的鋼種跨標準對照索引，以正規化別名做O(1)查詢"""
+    
+    def __init__(self, path):
+        self.version = None
+        self.grades = []
+        self._aliases = {}
+        self._alias_systems = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"載入鋼種對照資料錯誤: {str(e)}")
+            return
+        self.version = data['version']
+        self.grades = data['grades']
+        for grade in self.grades:
+            for system, alias in grade['aliases'].items():
+                self._aliases[normalize_grade_token(alias)] = grade
+                self._alias_systems[normalize_grade_token(alias)] = ALIAS_COMPOSITION_SYSTEMS.get(system, 'ASTM')
+    
+    def lookup(self, token):
+        """查詢單一鋼種名稱，返回包含別名與成分範圍的資料，找不到時返回None"""
+        return self._aliases.get(normalize_grade_token(token))
+    
+    def lookup_system(self, token):
+        """返回鋼種名稱所屬的成分標準體系（ASTM/JIS/EN）"""
+        return self._alias_systems.get(normalize_grade_token(token))
+    
+    def match_tokens(self, tokens):
+        """找出候選鋼種名稱（QueryAnalysis.grade_tokens）中可對照的項目，返回 (原始名稱, 鋼種資料) 列表"""
+        return [(token, grade) for token in tokens for grade in [self.lookup(token)] if grade]
+    
+    def resolve(self, tokens):
+        """找出候選鋼種名稱中可對照的鋼種，每個鋼種只返回一次"""
+        matches = []
+        seen = set()
+        for token, grade in self.match_tokens(tokens):
+            if grade['name'] not in seen:
+                seen.add(grade['name'])
+                matches.append((token, grade))
+        return matches
+
+# 鋼種對照索引，冷啟動時載入一次
+grade_index = GradeEquivalenceIndex(GRADE_EQUIVALENCE_FILE)
+
+class CompositionEngine:
+    """以NumPy陣列保存各鋼種/標準的元素上下限，一次向量化運算求多個標準的成分交集"""
+    
+    def __init__(self, index):
+        self.index = index
+        self.elements = []
+        self.spec_keys = []
+        self._rows = {}
+        for grade in index.grades:
+            for system, composition in grade['compositions'].items():
+                for element in composition['elements']:
+                    if element not in self.elements:
+                        self.elements.append(element)
+                self._rows[(grade['name'], system)] = len(self.spec_keys)
+                self.spec_keys.append((grade['name'], system, composition['standard']))
+        
+        # 未規定的元素下限為0、上限為無限大
+        self.mins = np.zeros((len(self.spec_keys), len(self.elements)))
+        self.maxs = np.full((len(self.spec_keys), len(self.elements)), np.inf)
+        for grade in index.grades:
+            for system, composition in grade['compositions'].items():
+                row = self._rows[(grade['name'], system)]
+                for element, value in composition['elements'].items():
+                    column = self.elements.index(element)
+                    low, high = value if isinstance(value, list) else (None, value)
+                    self.mins[row, column] = low or 0.0
+                    self.maxs[row, column] = high
+    
+    def resolve_spec(self, spec):
+        """將規格描述轉為矩陣列號；spec可為鋼種名稱（如 SUS316L）或 {'grade', 'standard'}"""
+        if isinstance(spec, dict):
+            grade = self.index.lookup(spec.get('grade', ''))
+            system = (spec.get('standard') or self.index.lookup_system(spec.get('grade', '')) or '').upper()
+            system = next((key for key in ('ASTM', 'JIS', 'EN') if system.startswith(key)), system)
+        else:
+            grade = self.index.lookup(spec)
+            system = self.index.lookup_system(spec)
+        if not grade or (grade['name'], system) not in self._rows:
+            raise ValueError(f"找不到規格的成分資料: {spec}")
+        return self._rows[(grade['name'], system)]
+    
+    def intersect(self, rows):
+        """計算多個規格的成分交集，並標示無交集（無法同時滿足）的元素"""
+        rows = np.asarray(rows)
+        lows = self.mins[rows].max(axis=0)
+        highs = self.maxs[rows].min(axis=0)
+        empty = lows > highs
+        constrained = np.isfinite(self.maxs[rows]).any(axis=0) | (self.mins[rows] > 0).any(axis=0)
+        
+        elements = {}
+        for column in np.flatnonzero(constrained):
+            elements[self.elements[column]] = {
+                'min': float(lows[column]) if lows[column] > 0 else None,
+                'max': float(highs[column]) if np.isfinite(highs[column]) else None,
+                'empty': bool(empty[column]),
+                'per_spec': [
+                    [float(self.mins[row, column]) or None,
+                     float(self.maxs[row, column]) if np.isfinite(self.maxs[row, column]) else None]
+                    for row in rows
+                ]
+            }
+        return {
+            'specs': [f"{self.spec_keys[row][0]} ({self.spec_keys[row][2]})" for row in rows],
+            'elements': elements,
+            'feasible': not bool(empty[constrained].any()),
+            'conflicts': [self.elements[column] for column in np.flatnonzero(empty & constrained)]
+        }
+
+composition_engine = LazyProxy('composition_engine', lambda: CompositionEngine(grade_index))
 
 def lambda_handler(event, context):
     """處理API Gateway傳入的請求或直接測試請求"""
+    trace = RequestTrace(getattr(context, 'aws_request_id', None) or uuid.uuid4().hex)
+    trace_token = current_trace.set(trace)
+    include_timings = False
     try:
         print("Received event:", json.dumps(event))
         
-        # 處理不同的輸入格式
-        if isinstance(event, dict):
-            if 'body' in event:
-                # API Gateway 格式
-                if isinstance(event['body'], str):
-                    body = json.loads(event['body'])
-                else:
-                    body = event['body']
-            else:
-                # 直接測試格式
-                body = event
-        else:
-            body = {'message': str(event)}
+        # Textract非同步作業完成的SNS通知
+        if isinstance(event, dict) and event.get('Records'):
+            return handle_textract_notifications(event['Records'])
         
+        body = parse_request_body(event)
         print("Processed body:", json.dumps(body))
+        # 選用：在回應中附上各階段耗時
+        include_timings = bool(body.get('timings'))
         
-        user_id = body.get('user_id', 'anonymous')
-        message = body.get('message', '')
-        session_id = body.get('session_id', f'test_{int(time.time())}')
+        # 非對話的操作請求（例如排程輪詢）
+        if body.get('action'):
+            trace.annotate(action=body['action'])
+            return handle_action(body)
         
-        file_content = None
-        file_type = None
-        file_key = None
-        extracted_text = ""
-        file_analysis = None  # 初始化這個變數
-        
-        if 'file' in body and body['file']:
-            file_data = body['file']
-            file_content = base64.b64decode(file_data['content'])
-            file_type = file_data['type']
-            file_name = file_data['name']
-            
-            # 上傳檔案到S3
-            file_key = f"uploads/{user_id}/{session_id}/{datetime.now().strftime('%Y%m%d%H%M%S')}_{file_name}"
-            s3.put_object(
-                Bucket='stainless-steel-standards-docs',
-                Key=file_key,
-                Body=file_content
-            )
-            
-            # 分析檔案內容
-            try:
-                file_analysis = analyze_file(file_key, file_type, file_content)
-                if file_analysis and isinstance(file_analysis, dict) and 'extracted_text' in file_analysis:
-                    extracted_text = file_analysis.get('extracted_text', '')
-            except Exception as e:
-                print(f"File analysis error: {str(e)}")
-                file_analysis = {
-                    'success': False,
-                    'error': str(e),
-                    'extracted_text': ''
-                }
-            
-            # 上傳檔案到S3
-            file_key = f"uploads/{user_id}/{session_id}/{datetime.now().strftime('%Y%m%d%H%M%S')}_{file_name}"
-            s3.put_object(
-                Bucket='stainless-steel-standards-docs',
-                Key=file_key,
-                Body=file_content
-            )
-            
-            # 分析檔案內容
-            try:
-                file_analysis = analyze_file(file_key, file_type, file_content)
-                if file_analysis and isinstance(file_analysis, dict) and 'extracted_text' in file_analysis:
-                    extracted_text = file_analysis.get('extracted_text', '')
-            except Exception as e:
-                print(f"File analysis error: {str(e)}")
-                file_analysis = {
-                    'success': False,
-                    'error': str(e),
-                    'extracted_text': ''
-                }
-        
-        # 獲取對話歷史
-        conversation_history = get_conversation_history(user_id, session_id)
-        
-        # 簡化版用戶專業度評估
-        expertise_level = "beginner"  # 預設為初學者
-        
-        # 檢查消息中的專業術語和標準引用
-        technical_terms = ["奧氏體", "肥粒體", "馬氏體", "固溶處理", "時效硬化", "PREN", "晶間腐蝕"]
-        standards_regex = r'[A-Z]{2,5}\s*[A-Z]?[0-9]{1,5}(-[0-9]+)?'
-        
-        term_count = sum(1 for term in technical_terms if term.lower() in message.lower())
-        standards_count = len(re.findall(standards_regex, message))
-        
-        if term_count >= 3 or standards_count >= 2:
-            expertise_level = "expert"
-        elif term_count >= 1 or standards_count >= 1:
-            expertise_level = "intermediate"
-        
-        enhanced_system_prompt = f"""你是一個專業的不銹鋼國際規範AI助理，專門協助華新麗華公司的技術人員處理客戶訂單相關問題。
-                            你擅長處理國際規範標準(ASTM、JIS、EN等)與規範項目(鋼種成分、尺寸公差、試驗標準等)的相關問題。
-
-                            **使用者專業程度**: {expertise_level} (初學者/中級/專家)
-
-                            **重要指示**:
-                            1. 絕對不要向用戶請求提供額外資訊，如果不知道特定資訊，必須自行從已提供的資料中推斷或明確表示無法回答。
-                            2. 在回答前，先進行深度思考：分析問題核心、評估可用資訊、應用專業知識、規劃回答結構。
-                            3. 根據用戶專業程度調整回答:
-                            - 初學者: 提供基礎解釋，解釋專業術語，使用簡單語言
-                            - 中級: 提供更詳細的技術信息，但仍附帶必要的背景說明
-                            - 專家: 直接使用專業術語，提供詳細技術數據和深入分析
-
-                            4. 回答應包含充分的細節，並盡可能以表格形式呈現比較結果。
-                            5. 對比較結果要仔細計算化學成分區間，確保多個標準的要求都能滿足。
-                            6. 使用現有資訊作出最佳判斷，即使不確定也要提供有幫助的回答。"""
-        
-        
-        # 獲取Kendra查詢結果
-        kendra_results = query_kendra(message)
-        
-        # 強制對標準相關問題進行網絡搜索
-        standards_keywords = ["ASTM", "EN", "ISO", "JIS", "DIN", "UNS", "AISI", "SAE",
-                            "標準", "規範", "對應", "比較", "相當"]
-        force_web_search = any(keyword in message for keyword in standards_keywords)
-        requires_web_search = force_web_search or (WEB_SEARCH_ENABLED and check_if_requires_web_search(message, kendra_results))
-        
-        web_results = []
-        detailed_content = []
-        
-        if requires_web_search:
-            prompt = construct_prompt_with_web_results(
-                message, conversation_history, kendra_results, 
-                web_results, detailed_content, file_content, file_type, file_key,
-                extracted_text=extracted_text, file_analysis=file_analysis,
-                enhanced_system_prompt=enhanced_system_prompt
-            )
-        else:
-            prompt = construct_prompt(
-                message, conversation_history, kendra_results, 
-                file_content, file_type, file_key,
-                extracted_text=extracted_text, file_analysis=file_analysis,
-                enhanced_system_prompt=enhanced_system_prompt
-            )
+        request_state = prepare_request(body)
         
         # 調用模型
-        if BEDROCK_WEB_SEARCH and requires_web_search:
-            response = invoke_bedrock_with_web_search(prompt, extract_search_query(message))
-        else:
-            response = invoke_bedrock(prompt)
+        response = generate_response(request_state)
         
-        # 儲存對話歷史
-        save_conversation(user_id, session_id, message, response)
+        # 儲存對話歷史與答案快取
+        finalize_response(request_state, response)
+        annotate_trace(trace, request_state)
+        
+        response_body = {
+            'response': response or "很抱歉，無法生成回應。請稍後再試。",
+            'web_search_used': request_state['requires_web_search'],
+            'expertise_level': request_state['expertise_level']  # 添加這行，返回專業度
+        }
+        if include_timings:
+            response_body['timings'] = trace.timings()
         
         return {
             'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': 'https://d185h9ecahpj1h.cloudfront.net',
-                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
-            },
-            'body': json.dumps({
-                'response': response or "很抱歉，無法生成回應。請稍後再試。",
-                'web_search_used': requires_web_search,
-                'expertise_level': expertise_level  # 添加這行，返回專業度
-            })
+            'headers': CORS_HEADERS,
+            'body': json.dumps(response_body, default=str)
         }
     
     except Exception as e:
         print(f"Error: {str(e)}")
         traceback.print_exc()  # 打印詳細的錯誤堆疊
+        trace.annotate(error=type(e).__name__)
+        error_body = {
+            'error': str(e),
+            'trace': traceback.format_exc()
+        }
+        if include_timings:
+            error_body['timings'] = trace.timings()
         return {
             'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': 'https://d185h9ecahpj1h.cloudfront.net',
-                'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
-            },
-            'body': json.dumps({
+            'headers': CORS_HEADERS,
+            'body': json.dumps(error_body, default=str)
+        }
+    
+    finally:
+        current_trace.reset(trace_token)
+        emit_trace_metrics(trace)
+        # 回應送出後再寫入對話紀錄
+        conversation_writer.invocation_finished()
+
+def annotate_trace(trace, request_state):
+    """把請求的專業度、網絡搜索、提示組合與推理統計附加到追蹤紀錄"""
+    trace.annotate(
+        expertise_level=request_state['expertise_level'],
+        web_search_used=request_state['requires_web_search'],
+        direct_response=request_state['direct_response'] is not None,
+        prompt_report=request_state['prompt_report'],
+        reasoning_stats=request_state['reasoning_stats']
+    )
+
+def handle_action(body):
+    """處理非對話的操作請求"""
+    action = body['action']
+    if action == 'poll_textract_jobs':
+        result = poll_pending_textract_jobs()
+    elif action == 'composition_intersection':
+        try:
+            rows = [composition_engine.resolve_spec(spec) for spec in body.get('specs', [])]
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': CORS_HEADERS,
+                'body': json.dumps({'error': str(e)}, ensure_ascii=False)
+            }
+        result = composition_engine.intersect(rows) if rows else {'error': "請提供至少一個規格"}
+        if rows:
+            result['table'] = format_composition_table(result)
+    elif action == 'grade_lookup':
+        grade = grade_index.lookup(body.get('grade', ''))
+        result = {'version': grade_index.version, 'grade': grade}
+    else:
+        return {
+            'statusCode': 400,
+            'headers': CORS_HEADERS,
+            'body': json.dumps({'error': f"未知的操作: {action}"})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': CORS_HEADERS,
+        'body': json.dumps(result, ensure_ascii=False)
+    }
+
+def parse_request_body(event):
+    """解析API Gateway、直接測試或本地伺服器傳入的事件"""
+    if isinstance(event, dict):
+        if 'body' in event:
+            # API Gateway 格式
+            if isinstance(event['body'], str):
+                return json.loads(event['body'])
+            return event['body']
+        # 直接測試格式
+        return event
+    return {'message': str(event)}
+
+@traced('prepare')
+def prepare_request(body):
+    """處理上傳檔案、並行檢索並構建提示，返回後續生成回應所需的狀態"""
+    user_id = body.get('user_id', 'anonymous')
+    message = body.get('message', '')
+    session_id = body.get('session_id', f'test_{int(time.time())}')
+
+    # 一次掃描分析消息（簡化版專業度、網絡搜索關鍵詞與搜索查詢）
+    query_analysis = analyze_query(message)
+    expertise_level = query_analysis.expertise_level
+
+    # 本地鋼種對照：純對照問題直接回答，其他問題預先填入精確對照
+    grade_matches = grade_index.resolve(query_analysis.grade_tokens)
+    grade_reference = format_grade_reference(grade_matches) if grade_matches else ""
+    composition_rows = composition_specs_for_query(query_analysis) if grade_matches else []
+    if len(composition_rows) >= 2:
+        # 只有詢問同時滿足多個規格的材料時才提供交集；一般比較問題並列各規格的範圍
+        composition_result = composition_engine.intersect(composition_rows)
+        if query_analysis.term_counts['intersection']:
+            grade_reference += "\n" + format_composition_table(composition_result)
+        else:
+            grade_reference += "\n" + format_composition_comparison(composition_result)
+    # 有對話歷史時問題可能依賴上下文，一律交給模型回答；歷史讀取沿用檢索任務，其餘檢索待確定不直接回答後再啟動
+    history_task = (get_conversation_history, (user_id, session_id), HISTORY_TIMEOUT, [])
+    pending_retrieval = {}
+    if GRADE_LOOKUP_SHORT_CIRCUIT and not body.get('file') and is_grade_lookup_question(message, grade_matches, query_analysis):
+        pending_retrieval = start_retrieval({'history': history_task})
+    if 'history' in pending_retrieval and not collect_retrieval(pending_retrieval, ['history'])['history']:
+        print(f"鋼種對照直接回答: {[grade['name'] for _, grade in grade_matches]}")
+        return {
+            'user_id': user_id,
+            'session_id': session_id,
+            'message': message,
+            'prompt': None,
+            'requires_web_search': False,
+            'expertise_level': expertise_level,
+            'answer_cache_key': None,
+            'kendra_fingerprint': None,
+            'query_embedding': None,
+            'direct_response': grade_reference + "\n\n（以上由本地鋼種對照資料庫直接回答）",
+            'prompt_report': {},
+            'reasoning_stats': {},
+            'generation_failed': False
+        }
+
+    # 強制對標準相關問題進行網絡搜索
+    force_web_search = query_analysis.force_web_search
+
+    # 答案快取只用於未上傳檔案的問題；先查候選回答，命中時不必預先啟動付費的網絡搜索
+    use_answer_cache = not body.get('file')
+    cache_key = answer_cache_key(message, query_analysis) if use_answer_cache else None
+    cached_answer = get_cached_answer(cache_key) if cache_key else None
+
+    # 並行啟動檢索：對話歷史、Kendra與網絡搜索彼此獨立，同時進行
+    retrieval_tasks = {'kendra': (query_kendra, (message,), KENDRA_TIMEOUT, [])}
+    if 'history' not in pending_retrieval:
+        retrieval_tasks['history'] = history_task
+    # 語意快取需要查詢的嵌入向量，與其他檢索同時計算
+    if SEMANTIC_CACHE_ENABLED and use_answer_cache:
+        retrieval_tasks['embedding'] = (embed_text, (message,), KENDRA_TIMEOUT, None)
+    # 只有不論Kendra結果都一定需要網絡搜索、且沒有快取可能命中時才預先啟動
+    # 實際抓取網頁只在 WEB_SEARCH_ENABLED 開啟時進行；標準相關問題的 force_web_search 在關閉時與原本相同，
+    # 只改用網絡搜索版的提示模板（或交給 BEDROCK_WEB_SEARCH），不呼叫搜索API
+    web_search_certain = WEB_SEARCH_ENABLED and (force_web_search or bool(query_analysis.web_search_keywords))
+    if (web_search_certain and cached_answer is None and 'embedding' not in retrieval_tasks
+            and not BEDROCK_WEB_SEARCH):
+        retrieval_tasks['web'] = web_retrieval_task(query_analysis)
+    pending_retrieval.update(start_retrieval(retrieval_tasks))
+
+    # 處理上傳檔案：上傳一次、分析一次
+    file_ingestion = ingest_file(body.get('file'), user_id, session_id)
+    file_content = file_ingestion['file_content']
+    file_type = file_ingestion['file_type']
+    file_key = file_ingestion['file_key']
+    extracted_text = file_ingestion['extracted_text']
+    file_analysis = file_ingestion['file_analysis']
+
+    enhanced_system_prompt = f"""你是一個專業的不銹鋼國際規範AI助理，專門協助華新麗華公司的技術人員處理客戶訂單相關問題。
+                        你擅長處理國際規範標準(ASTM、JIS、EN等)與規範項目(鋼種成分、尺寸公差、試驗標準等)的相關問題。
+
+                        **使用者專業程度**: {expertise_level} (初學者/中級/專家)
+
+                        **重要指示**:
+                        1. 絕對不要向用戶請求提供額外資訊，如果不知道特定資訊，必須自行從已提供的資料中推斷或明確表示無法回答。
+                        2. 在回答前，先進行深度思考：分析問題核心、評估可用資訊、應用專業知識、規劃回答結構。
+                        3. 根據用戶專業程度調整回答:
+                        - 初學者: 提供基礎解釋，解釋專業術語，使用簡單語言
+                        - 中級: 提供更詳細的技術信息，但仍附帶必要的背景說明
+                        - 專家: 直接使用專業術語，提供詳細技術數據和深入分析
+
+                        4. 回答應包含充分的細節，並盡可能以表格形式呈現比較結果。
+                        5. 對比較結果要仔細計算化學成分區間，確保多個標準的要求都能滿足。
+                        6. 使用現有資訊作出最佳判斷，即使不確定也要提供有幫助的回答。"""
+
+
+    # 收集檢索結果，超過期限的來源以空結果代替
+    retrieved = collect_retrieval(pending_retrieval, ['history', 'kendra'])
+    conversation_history = retrieved['history']
+    kendra_results = retrieved['kendra']
+
+    requires_web_search = force_web_search or (WEB_SEARCH_ENABLED and check_if_requires_web_search(message, kendra_results))
+
+    request_state = {
+        'user_id': user_id,
+        'session_id': session_id,
+        'message': message,
+        'prompt': None,
+        'requires_web_search': requires_web_search,
+        'expertise_level': expertise_level,
+        'answer_cache_key': None,
+        'kendra_fingerprint': None,
+        'query_embedding': None,
+        'direct_response': None,
+        'prompt_report': {},
+        'reasoning_stats': {},
+        'generation_failed': False
+    }
+
+    # 有對話歷史時追問（例如「那它的耐蝕性呢？」）依賴上下文，兩種快取都不讀也不寫
+    if use_answer_cache and not conversation_history:
+        # 答案快取：Kendra結果相同的重複問題直接使用先前的回答，不必等待網絡搜索或調用模型
+        request_state['answer_cache_key'] = cache_key
+        request_state['kendra_fingerprint'] = kendra_fingerprint(kendra_results)
+        if cached_answer is not None and cached_answer['kendra_fingerprint'] == request_state['kendra_fingerprint']:
+            request_state['direct_response'] = cached_answer['response']
+            return request_state
+
+        # 語意快取：以嵌入向量比對中英文改寫過的相似問題
+        if 'embedding' in pending_retrieval:
+            request_state['query_embedding'] = collect_retrieval(pending_retrieval, ['embedding'])['embedding']
+            if request_state['query_embedding'] is not None:
+                request_state['direct_response'] = semantic_cache.search(request_state['query_embedding'], expertise_level)
+                if request_state['direct_response'] is not None:
+                    return request_state
+
+    web_results = []
+    detailed_content = []
+    if requires_web_search and WEB_SEARCH_ENABLED and not BEDROCK_WEB_SEARCH:
+        if 'web' not in pending_retrieval:
+            pending_retrieval.update(start_retrieval({'web': web_retrieval_task(query_analysis)}))
+        web_results, detailed_content = collect_retrieval(pending_retrieval, ['web'])['web']
+
+    if requires_web_search:
+        prompt = construct_prompt_with_web_results(
+            message, conversation_history, kendra_results, 
+            web_results, detailed_content, file_content, file_type, file_key,
+            extracted_text=extracted_text, file_analysis=file_analysis,
+            enhanced_system_prompt=enhanced_system_prompt, grade_reference=grade_reference,
+            prompt_report=request_state['prompt_report']
+        )
+    else:
+        prompt = construct_prompt(
+            message, conversation_history, kendra_results, 
+            file_content, file_type, file_key,
+            extracted_text=extracted_text, file_analysis=file_analysis,
+            enhanced_system_prompt=enhanced_system_prompt, grade_reference=grade_reference,
+            prompt_report=request_state['prompt_report']
+        )
+    
+    request_state['prompt'] = prompt
+    return request_state
+
+@traced('file')
+def ingest_file(file_data, user_id, session_id):
+    """檔案處理階段：將上傳檔案存入S3並分析內容，每個檔案僅上傳與分析一次"""
+    ingestion = {
+        'file_content': None,
+        'file_type': None,
+        'file_key': None,
+        'extracted_text': "",
+        'file_analysis': None
+    }
+    if not file_data:
+        return ingestion
+    
+    file_content = base64.b64decode(file_data['content'])
+    file_type = file_data['type']
+    file_name = file_data['name']
+    
+    # 上傳檔案到S3
+    file_key = f"uploads/{user_id}/{session_id}/{datetime.now().strftime('%Y%m%d%H%M%S')}_{file_name}"
+    s3.put_object(
+        Bucket='stainless-steel-standards-docs',
+        Key=file_key,
+        Body=file_content
+    )
+    ingestion.update({'file_content': file_content, 'file_type': file_type, 'file_key': file_key})
+    
+    # 相同內容的檔案直接使用快取的分析結果，跳過Textract/Rekognition/pandas
+    content_hash = file_content_hash(file_content, file_type)
+    file_analysis = get_cached_file_analysis(content_hash)
+    
+    # 分析檔案內容
+    if file_analysis is None:
+        try:
+            file_analysis = analyze_file(file_key, file_type, file_content)
+            # 非同步作業尚未完成的結果只有部分文本，待作業完成時再寫入快取
+            if file_analysis and file_analysis.get('success') and not file_analysis.get('async_job'):
+                store_cached_file_analysis(content_hash, file_analysis)
+        except Exception as e:
+            print(f"File analysis error: {str(e)}")
+            file_analysis = {
+                'success': False,
                 'error': str(e),
-                'trace': traceback.format_exc()
-            })
+                'extracted_text': ''
+            }
+    
+    if file_analysis and isinstance(file_analysis, dict) and 'extracted_text' in file_analysis:
+        ingestion['extracted_text'] = file_analysis.get('extracted_text', '')
+    ingestion['file_analysis'] = file_analysis
+    
+    return ingestion
+
+@traced('generate')
+def generate_response(request_state):
+    """根據請求狀態調用模型，返回完整回應文本"""
+    if request_state['direct_response'] is not None:
+        return request_state['direct_response']
+    if BEDROCK_WEB_SEARCH and request_state['requires_web_search']:
+        return invoke_bedrock_with_web_search(request_state['prompt'], extract_search_query(request_state['message']))
+    if INTERNAL_REASONING == 'adaptive':
+        return "".join(reasoning_chunks(request_state))
+    return invoke_bedrock(request_state['prompt'])
+
+def reasoning_chunks(request_state):
+    """以組合好的提示作為知識內容，進行自適應深度的內部推理"""
+    return internal_reasoning_stream(
+        request_state['message'], [], request_state['prompt'],
+        expertise_level=request_state['expertise_level'],
+        reasoning_stats=request_state['reasoning_stats']
+    )
+
+@traced('finalize')
+def finalize_response(request_state, response):
+    """儲存對話歷史，並將新生成的回答寫入答案快取"""
+    save_conversation(request_state['user_id'], request_state['session_id'], request_state['message'], response)
+    
+    # 直接回應（快取命中或本地對照）、錯誤訊息與任一生成/推理階段失敗的回答不寫入快取
+    failed = request_state['generation_failed'] or request_state['reasoning_stats'].get('failed')
+    if (request_state['answer_cache_key'] and request_state['direct_response'] is None
+            and response and not response.startswith("Error:") and not failed):
+        store_cached_answer(request_state['answer_cache_key'], response, request_state['kendra_fingerprint'])
+        if request_state['query_embedding'] is not None:
+            semantic_cache.add(request_state['query_embedding'], request_state['expertise_level'], response)
+
+def stream_chat(body):
+    """串流模式：逐段產生回應事件，最後儲存完整對話"""
+    trace = RequestTrace(uuid.uuid4().hex)
+    trace_token = current_trace.set(trace)
+    try:
+        yield from stream_chat_events(body, trace)
+    finally:
+        current_trace.reset(trace_token)
+        emit_trace_metrics(trace)
+
+def stream_chat_events(body, trace):
+    """產生串流事件；body帶有 timings 時在結束事件附上各階段耗時"""
+    try:
+        request_state = prepare_request(body)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        traceback.print_exc()
+        trace.annotate(error=type(e).__name__)
+        yield {'type': 'error', 'error': str(e)}
+        return
+    
+    # 先送出中繼資料，讓前端可以立即調整介面
+    yield {
+        'type': 'meta',
+        'web_search_used': request_state['requires_web_search'],
+        'expertise_level': request_state['expertise_level']
+    }
+    
+    response_parts = []
+    stream_usage = {}
+    if request_state['direct_response'] is not None or (BEDROCK_WEB_SEARCH and request_state['requires_web_search']):
+        # 直接回應（快取或本地對照）或網絡搜索模式（沒有串流API）時整段送出
+        chunks = [generate_response(request_state)]
+    elif INTERNAL_REASONING == 'adaptive':
+        chunks = reasoning_chunks(request_state)
+    else:
+        chunks = invoke_bedrock_stream(request_state['prompt'], usage=stream_usage)
+    
+    generate_started = time.monotonic()
+    for chunk in chunks:
+        response_parts.append(chunk)
+        yield {'type': 'delta', 'text': chunk}
+    record_span('stream', generate_started)
+    # 串流中途失敗時錯誤訊息接在部分回答之後，以旗標標記
+    request_state['generation_failed'] = 'error' in stream_usage
+    
+    response = "".join(response_parts) or "很抱歉，無法生成回應。請稍後再試。"
+    finalize_response(request_state, response)
+    annotate_trace(trace, request_state)
+    done = {'type': 'done'}
+    if body.get('timings'):
+        done['timings'] = trace.timings()
+    yield done
+
+def normalize_query(message, query_analysis):
+    """正規化查詢：統一標準編號與鋼種寫法，忽略大小寫、空白與標點"""
+    standards, steels = query_analysis.upper_standards, query_analysis.upper_steels
+    tokens = sorted(set(re.sub(r'\s+', '', token) for token in standards + steels))
+    
+    residual = message.upper()
+    for token in sorted(set(standards + steels), key=len, reverse=True):
+        residual = residual.replace(token, ' ')
+    residual = re.sub(r'[\W_]+', '', residual.casefold())
+    
+    return " ".join(tokens) + "|" + residual
+
+def answer_cache_key(message, query_analysis):
+    """以正規化查詢與專業程度組成答案快取鍵"""
+    key_source = f"{normalize_query(message, query_analysis)}\0{query_analysis.expertise_level}"
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def kendra_fingerprint(kendra_results):
+    """計算Kendra結果指紋，知識庫內容變動時快取的回答即失效"""
+    return hashlib.sha256(json.dumps(
+        [[result.get('source', ''), result.get('excerpt', '')] for result in kendra_results],
+        ensure_ascii=False
+    ).encode('utf-8')).hexdigest()
+
+@traced('answer_cache')
+def get_cached_answer(cache_key):
+    """依序查詢容器內快取與DynamoDB共享快取，返回回答與Kendra指紋，未命中時返回None"""
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        print(f"答案快取候選(記憶體): {cache_key}")
+        return cached
+    
+    if answer_cache_table is None:
+        return None
+    
+    try:
+        item = answer_cache_table.get_item(Key={'cache_key': cache_key}).get('Item')
+    except Exception as e:
+        print(f"讀取答案快取錯誤: {str(e)}")
+        return None
+    
+    # DynamoDB的TTL刪除有延遲，需自行檢查是否過期
+    if not item or int(item.get('expires_at', 0)) < time.time():
+        return None
+    
+    print(f"答案快取候選(DynamoDB): {cache_key}")
+    cached = {'response': item['response'], 'kendra_fingerprint': item.get('kendra_fingerprint', '')}
+    answer_cache.set(cache_key, cached)
+    return cached
+
+def store_cached_answer(cache_key, response, kendra_fingerprint):
+    """將回答與其Kendra指紋寫入容器內快取與DynamoDB共享快取"""
+    answer_cache.set(cache_key, {'response': response, 'kendra_fingerprint': kendra_fingerprint})
+    if answer_cache_table is None:
+        return
+    try:
+        answer_cache_table.put_item(Item={
+            'cache_key': cache_key,
+            'response': response,
+            'kendra_fingerprint': kendra_fingerprint,
+            'expires_at': int(time.time()) + ANSWER_CACHE_TTL
+        })
+    except Exception as e:
+        print(f"寫入答案快取錯誤: {str(e)}")
+
+def embed_text_with_bedrock(text):
+    """使用Bedrock嵌入模型計算文本向量"""
+    response = bedrock.invoke_model(
+        modelId=EMBEDDING_MODEL_ID,
+        body=json.dumps({
+            "inputText": text,
+            "dimensions": EMBEDDING_DIMENSIONS,
+            "normalize": True
+        })
+    )
+    response_body = json.loads(response['body'].read())
+    record_bedrock_usage({'input_tokens': response_body.get('inputTextTokenCount', 0)})
+    return response_body['embedding']
+
+def embed_text_with_hashing(text):
+    """本地確定性嵌入：以字元n-gram雜湊到固定維度，供測試或離線使用"""
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    normalized = re.sub(r'\s+', ' ', text.casefold()).strip()
+    for n in (1, 2, 3):
+        for i in range(len(normalized) - n + 1):
+            bucket = zlib.crc32(normalized[i:i + n].encode('utf-8'))
+            vector[bucket % EMBEDDING_DIMENSIONS] += 1.0 if bucket & 0x80000000 else -1.0
+    return vector
+
+# 可抽換的嵌入後端
+EMBEDDING_BACKENDS = {
+    'bedrock': embed_text_with_bedrock,
+    'hash': embed_text_with_hashing
+}
+
+@traced('embedding')
+def embed_text(text):
+    """使用設定的後端計算單位長度的嵌入向量"""
+    vector = np.asarray(EMBEDDING_BACKENDS[EMBEDDING_BACKEND](text), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class SemanticCache:
+    """以NumPy矩陣保存問題嵌入向量的語意快取，以單一.npz物件（float16矩陣+中繼資料）持久化到S3"""
+    
+    def __init__(self, s3_prefix, threshold, max_entries, ttl):
+        self.s3_key = f"{s3_prefix}.npz"
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.vectors = None
+        self.entries = []
+        # 尚未寫回S3的新項目：(向量, 項目)
+        self.pending = []
+        self.last_flush = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def _read_index(self):
+        """讀取S3上的索引，返回 (向量矩陣, 項目, ETag)；不存在或嵌入設定不同時返回空索引"""
+        empty = np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float16)
+        try:
+            response = s3.get_object(Bucket='stainless-steel-standards-docs', Key=self.s3_key)
+        except s3.exceptions.NoSuchKey:
+            return empty, [], None
+        etag = response.get('ETag')
+        archive = np.load(io.BytesIO(response['Body'].read()), allow_pickle=False)
+        meta = json.loads(archive['meta'].tobytes().decode('utf-8'))
+        if meta.get('backend') != EMBEDDING_BACKEND or meta.get('dimensions') != EMBEDDING_DIMENSIONS:
+            print("語意快取的嵌入設定已變更，忽略已保存的索引")
+            return empty, [], etag
+        return archive['vectors'].astype(np.float16), meta['entries'], etag
+    
+    def _write_index(self, vectors, entries, etag):
+        """以ETag條件式寫入索引，其他容器在讀取後已更新時會失敗（PreconditionFailed）"""
+        meta = json.dumps({
+            'backend': EMBEDDING_BACKEND,
+            'dimensions': EMBEDDING_DIMENSIONS,
+            'entries': entries
+        }, ensure_ascii=False).encode('utf-8')
+        buffer = io.BytesIO()
+        np.savez(buffer, vectors=vectors, meta=np.frombuffer(meta, dtype=np.uint8))
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        s3.put_object(
+            Bucket='stainless-steel-standards-docs',
+            Key=self.s3_key,
+            Body=buffer.getvalue(),
+            **condition
+        )
+    
+    def _trim(self, vectors, entries):
+        """移除過期項目，超過上限時保留最新的項目"""
+        now = time.time()
+        keep = [index for index, entry in enumerate(entries) if now - entry['created_at'] <= self.ttl]
+        keep = sorted(keep, key=lambda index: entries[index]['created_at'])[-self.max_entries:]
+        return vectors[keep], [entries[index] for index in keep]
+    
+    def _ensure_loaded(self):
+        """冷啟動後第一次使用時從S3載入索引"""
+        if self._loaded:
+            return
+        self._loaded = True
+        self.vectors = np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float16)
+        try:
+            self.vectors, self.entries, _ = self._read_index()
+            if self.entries:
+                print(f"已載入語意快取: {len(self.entries)} 筆")
+        except Exception as e:
+            print(f"載入語意快取錯誤: {str(e)}")
+    
+    def search(self, vector, expertise_level):
+        """返回相似度超過門檻且專業程度相同的最近鄰回答"""
+        with self._lock:
+            self._ensure_loaded()
+            if not self.entries:
+                return None
+            similarities = self.vectors.astype(np.float32) @ vector
+            now = time.time()
+            valid = np.array([
+                entry['expertise_level'] == expertise_level and now - entry['created_at'] <= self.ttl
+                for entry in self.entries
+            ])
+            similarities[~valid] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            print(f"語意快取命中: 相似度 {similarities[best]:.3f}")
+            return self.entries[best]['response']
+    
+    def add(self, vector, expertise_level, response):
+        """加入新的問題向量與回答；只更新容器內的索引，寫回S3由flush在回應送出後批次進行"""
+        with self._lock:
+            self._ensure_loaded()
+            vector = vector.astype(np.float16)
+            entry = {
+                'id': uuid.uuid4().hex,
+                'expertise_level': expertise_level,
+                'response': response,
+                'created_at': time.time()
+            }
+            self.vectors = np.vstack([self.vectors, vector[np.newaxis, :]])
+            self.entries.append(entry)
+            self.pending.append((vector, entry))
+            if len(self.entries) > self.max_entries:
+                overflow = len(self.entries) - self.max_entries
+                self.vectors = self.vectors[overflow:]
+                self.entries = self.entries[overflow:]
+    
+    def flush(self, force=False):
+        """把新項目合併到S3上的最新索引後以條件式寫入，衝突時重新讀取合併；未到批次間隔時略過"""
+        with self._lock:
+            if not self.pending or (not force and time.time() - self.last_flush < SEMANTIC_CACHE_FLUSH_INTERVAL):
+                return
+            pending, self.pending = self.pending, []
+            self.last_flush = time.time()
+        
+        for attempt in range(SEMANTIC_CACHE_MERGE_RETRIES):
+            try:
+                vectors, entries, etag = self._read_index()
+                known = {entry.get('id') for entry in entries}
+                new = [(vector, entry) for vector, entry in pending if entry['id'] not in known]
+                if new:
+                    vectors = np.vstack([vectors] + [vector[np.newaxis, :] for vector, _ in new])
+                    entries = entries + [entry for _, entry in new]
+                vectors, entries = self._trim(vectors, entries)
+                self._write_index(vectors, entries, etag)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    time.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+                    continue
+                print(f"保存語意快取錯誤: {str(e)}")
+                break
+            except Exception as e:
+                print(f"保存語意快取錯誤: {str(e)}")
+                break
+            
+            # 以合併後的索引（含其他容器的項目）取代容器內的索引，再加上合併期間新增的項目
+            with self._lock:
+                local_new = self.pending
+                if local_new:
+                    vectors = np.vstack([vectors] + [vector[np.newaxis, :] for vector, _ in local_new])
+                    entries = entries + [entry for _, entry in local_new]
+                self.vectors, self.entries = vectors, entries
+            return
+        
+        # 寫入失敗時保留項目，下次再合併
+        with self._lock:
+            self.pending = pending + self.pending
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_S3_PREFIX, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL)
+
+def start_retrieval(tasks):
+    """並行啟動檢索來源，tasks格式為 {名稱: (函數, 參數, 期限秒數, 預設值)}"""
+    started = time.monotonic()
+    pending = {}
+    for name, (func, args, timeout, default) in tasks.items():
+        pending[name] = {
+            'future': submit_traced(retrieval_executor, func, *args),
+            # 每個來源的期限不超過整體預算
+            'deadline': started + min(timeout, RETRIEVAL_BUDGET),
+            'default': default
         }
+    return pending
+
+def web_retrieval_task(query_analysis):
+    """組成網絡搜索的檢索任務"""
+    return (
+        search_and_scrape,
+        (query_analysis.search_query, GOOGLE_API_KEY, GOOGLE_SEARCH_ENGINE_ID),
+        WEB_SEARCH_TIMEOUT + SCRAPE_BUDGET, ([], [])
+    )
+
+@traced('retrieval.wait')
+def collect_retrieval(pending, names=None):
+    """依期限收集檢索結果，逾時或失敗的來源回傳預設值"""
+    results = {}
+    for name in sorted(names or pending, key=lambda n: pending[n]['deadline']):
+        task = pending[name]
+        remaining = max(0.0, task['deadline'] - time.monotonic())
+        try:
+            results[name] = task['future'].result(timeout=remaining)
+        except FutureTimeoutError:
+            print(f"檢索來源 {name} 超過期限，使用目前可用的結果")
+            task['future'].cancel()
+            results[name] = task['default']
+        except Exception as e:
+            print(f"檢索來源 {name} 錯誤: {str(e)}")
+            results[name] = task['default']
+    return results
 
+def file_content_hash(file_content, file_type):
+    """以檔案內容與類型計算快取鍵"""
+    digest = hashlib.sha256()
+    digest.update((file_type or '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(file_content)
+    return digest.hexdigest()
+
+def get_cached_file_analysis(content_hash):
+    """依序查詢容器內快取與S3快取，未命中或已過期時返回None"""
+    cached = analysis_cache.get(content_hash)
+    if cached is not None:
+        print(f"檔案分析快取命中(記憶體): {content_hash}")
+        return cached
+    
+    try:
+        response = s3.get_object(
+            Bucket='stainless-steel-standards-docs',
+            Key=f"analysis-cache/{content_hash}.json"
+        )
+        entry = json.loads(response['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"讀取分析快取錯誤: {str(e)}")
+        return None
+    
+    if time.time() - entry.get('cached_at', 0) > ANALYSIS_CACHE_TTL:
+        return None
+    
+    print(f"檔案分析快取命中(S3): {content_hash}")
+    analysis_cache.set(content_hash, entry['result'])
+    return entry['result']
+
+def store_cached_file_analysis(content_hash, file_analysis):
+    """將分析結果寫入容器內快取與S3快取"""
+    analysis_cache.set(content_hash, file_analysis)
+    try:
+        s3.put_object(
+            Bucket='stainless-steel-standards-docs',
+            Key=f"analysis-cache/{content_hash}.json",
+            Body=json.dumps({'cached_at': time.time(), 'result': file_analysis}, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"寫入分析快取錯誤: {str(e)}")
+
+@traced('file.analyze')
 def analyze_file(file_key, file_type, file_content):
     """增強的文件分析功能，支持PDF、圖片和Excel等格式"""
     try:
@@ -237,38 +1455,36 @@ def analyze_file(file_key, file_type, file_content):
             print(f"處理PDF文件: {file_key}")
             # 先將內容保存到臨時S3位置
             pdf_s3_key = file_key
+            document = {'S3Object': {'Bucket': 'stainless-steel-standards-docs', 'Name': pdf_s3_key}}
             
-            # 使用Textract同步API抽取文本
-            response = textract.detect_document_text(
-                Document={'S3Object': {'Bucket': 'stainless-steel-standards-docs', 'Name': pdf_s3_key}}
-            )
-            
-            # 提取文本內容
-            for item in response['Blocks']:
-                if item['BlockType'] == 'LINE':
-                    extracted_text += item['Text'] + "\n"
+            # Textract同步API只接受單頁PDF；頁數無法從檔案判斷時（例如壓縮的物件串流）以同步API的錯誤為準
+            multi_page = pdf_page_count(file_content) > 1
+            if not multi_page:
+                try:
+                    response = textract.detect_document_text(Document=document)
+                    
+                    # 提取文本內容
+                    for item in response['Blocks']:
+                        if item['BlockType'] == 'LINE':
+                            extracted_text += item['Text'] + "\n"
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') != 'UnsupportedDocumentException':
+                        raise
+                    multi_page = True
             
-            # 如果PDF有多頁，可能需要啟動非同步作業
-            if len(extracted_text) < 100:  # 如果提取的文本非常少，可能是多頁文檔
+            if multi_page:
+                # 多頁PDF直接啟動非同步作業；完整文本由SNS通知或輪詢完成後再索引，不阻塞對話請求
                 print("使用非同步Textract作業處理多頁PDF")
-                async_response = textract.start_document_text_detection(
-                    DocumentLocation={'S3Object': {'Bucket': 'stainless-steel-standards-docs', 'Name': pdf_s3_key}}
-                )
-                job_id = async_response['JobId']
-                
-                # 這部分代碼實際上需要通過Step Functions或其他機制等待作業完成
-                # 這裡僅做示例，實際實現時應考慮非同步處理流程
-                print(f"Textract Job ID: {job_id} - 需要在生產環境中實現輪詢機制")
-            
-            # 嘗試提取表格
-            try:
-                tables_response = textract.analyze_document(
-                    Document={'S3Object': {'Bucket': 'stainless-steel-standards-docs', 'Name': pdf_s3_key}},
-                    FeatureTypes=['TABLES']
-                )
-                file_analysis_results["tables"] = extract_tables_from_textract(tables_response)
-            except Exception as table_err:
-                print(f"PDF表格提取錯誤: {str(table_err)}")
+                job_id = submit_textract_job(pdf_s3_key, file_content_hash(file_content, file_type))
+                if job_id:
+                    file_analysis_results["async_job"] = {"job_id": job_id, "status": "IN_PROGRESS"}
+            else:
+                # 嘗試提取表格（同步API同樣只接受單頁）
+                try:
+                    tables_response = textract.analyze_document(Document=document, FeatureTypes=['TABLES'])
+                    file_analysis_results["tables"] = extract_tables_from_textract(tables_response)
+                except Exception as table_err:
+                    print(f"PDF表格提取錯誤: {str(table_err)}")
         
         # 圖片處理 (PNG, JPEG)
         elif file_type in ['image/png', 'image/jpeg', 'image/jpg']:
@@ -313,12 +1529,14 @@ def analyze_file(file_key, file_type, file_content):
             
             # 使用pandas讀取Excel
             excel_data = io.BytesIO(file_content)
-            excel_file = pd.ExcelFile(excel_data)
+            with trace_span('pandas.read_excel'):
+                excel_file = pd.ExcelFile(excel_data)
             all_sheets = {}
             
             for sheet_name in excel_file.sheet_names:
                 try:
-                    df = pd.read_excel(excel_file, sheet_name=sheet_name)
+                    with trace_span('pandas.read_excel'):
+                        df = pd.read_excel(excel_file, sheet_name=sheet_name)
                     
                     # 處理可能的NaN值
                     df = df.replace({np.nan: None})
@@ -356,7 +1574,8 @@ def analyze_file(file_key, file_type, file_content):
             try:
                 # 讀取CSV並處理
                 csv_data = io.BytesIO(file_content)
-                df = pd.read_csv(csv_data)
+                with trace_span('pandas.read_csv'):
+                    df = pd.read_csv(csv_data)
                 
                 # 處理可能的NaN值
                 df = df.replace({np.nan: None})
@@ -456,125 +1675,488 @@ def analyze_file(file_key, file_type, file_content):
             'file_type': file_type
         }
 
+PDF_PAGE_PATTERN = re.compile(rb'/Type\s*/Page\b')
+
+def pdf_page_count(file_content):
+    """以頁面物件標記估算PDF頁數；頁面物件位於壓縮串流中時返回0（無法判斷）"""
+    return len(PDF_PAGE_PATTERN.findall(file_content))
+
+def submit_textract_job(file_key, content_hash=None):
+    """提交非同步Textract文本檢測作業，並在S3記錄待完成的作業（含分析快取鍵）"""
+    try:
+        request = {
+            'DocumentLocation': {'S3Object': {'Bucket': 'stainless-steel-standards-docs', 'Name': file_key}},
+            # 相同文件重複提交時返回同一個作業
+            'ClientRequestToken': hashlib.sha256(file_key.encode('utf-8')).hexdigest()[:64]
+        }
+        if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_SNS_ROLE_ARN:
+            request['NotificationChannel'] = {
+                'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN,
+                'RoleArn': TEXTRACT_SNS_ROLE_ARN
+            }
+        
+        job_id = textract.start_document_text_detection(**request)['JobId']
+        
+        s3.put_object(
+            Bucket='stainless-steel-standards-docs',
+            Key=f"textract-jobs/{job_id}.json",
+            Body=json.dumps({
+                'job_id': job_id, 'file_key': file_key, 'content_hash': content_hash, 'submitted_at': time.time()
+            }).encode('utf-8'),
+            ContentType='application/json'
+        )
+        print(f"已提交Textract作業 {job_id}: {file_key}")
+        return job_id
+    except Exception as e:
+        print(f"提交Textract作業錯誤: {str(e)}")
+        return None
+
+def fetch_textract_job_blocks(job_id):
+    """分頁取得已完成作業的所有區塊"""
+    blocks = []
+    next_token = None
+    while True:
+        request = {'JobId': job_id, 'MaxResults': 1000}
+        if next_token:
+            request['NextToken'] = next_token
+        response = textract.get_document_text_detection(**request)
+        if response['JobStatus'] != 'SUCCEEDED':
+            raise RuntimeError(f"Textract作業 {job_id} 狀態為 {response['JobStatus']}")
+        blocks.extend(response.get('Blocks', []))
+        next_token = response.get('NextToken')
+        if not next_token:
+            return blocks
+
+def assemble_textract_text(blocks):
+    """依頁碼組合LINE區塊為文本，並加入頁碼標記"""
+    pages = {}
+    for block in blocks:
+        if block['BlockType'] == 'LINE':
+            pages.setdefault(block.get('Page', 1), []).append(block.get('Text', ''))
+    
+    text = ""
+    for page in sorted(pages):
+        text += f"--- 第{page}頁 ---\n"
+        text += "\n".join(pages[page]) + "\n"
+    return text
+
+def complete_textract_job(job_id, file_key):
+    """取得作業結果，保存完整文本、提交Kendra索引並以完整結果更新檔案分析快取"""
+    extracted_text = assemble_textract_text(fetch_textract_job_blocks(job_id))
+    if extracted_text:
+        s3.put_object(
+            Bucket='stainless-steel-standards-docs',
+            Key=f"{file_key}_extracted_text.txt",
+            Body=extracted_text.encode('utf-8')
+        )
+        index_extracted_text(extracted_text, file_key)
+        refresh_cached_file_analysis(job_id, file_key, extracted_text)
+    
+    s3.delete_object(Bucket='stainless-steel-standards-docs', Key=f"textract-jobs/{job_id}.json")
+    print(f"Textract作業 {job_id} 完成，共 {len(extracted_text)} 字元: {file_key}")
+    return len(extracted_text)
+
+def refresh_cached_file_analysis(job_id, file_key, extracted_text):
+    """以作業的完整文本更新上傳時保存的分析結果，並寫入分析快取，讓重新上傳直接取得完整內容"""
+    try:
+        record = json.loads(s3.get_object(
+            Bucket='stainless-steel-standards-docs', Key=f"textract-jobs/{job_id}.json"
+        )['Body'].read())
+        content_hash = record.get('content_hash')
+        if not content_hash:
+            return
+        file_analysis = json.loads(s3.get_object(
+            Bucket='stainless-steel-standards-docs', Key=f"{file_key}_analysis_result.json"
+        )['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return
+    except Exception as e:
+        print(f"更新分析快取錯誤: {str(e)}")
+        return
+    
+    file_analysis['extracted_text'] = extracted_text
+    file_analysis.pop('async_job', None)
+    store_cached_file_analysis(content_hash, file_analysis)
+
+def handle_textract_notifications(records):
+    """處理Textract透過SNS發送的作業完成通知"""
+    results = []
+    for record in records:
+        try:
+            notification = json.loads(record['Sns']['Message'])
+            job_id = notification['JobId']
+            file_key = notification['DocumentLocation']['S3ObjectName']
+            if notification['Status'] == 'SUCCEEDED':
+                complete_textract_job(job_id, file_key)
+            else:
+                print(f"Textract作業 {job_id} 失敗: {notification['Status']}")
+                s3.delete_object(Bucket='stainless-steel-standards-docs', Key=f"textract-jobs/{job_id}.json")
+            results.append({'job_id': job_id, 'status': notification['Status']})
+        except Exception as e:
+            print(f"處理Textract通知錯誤: {str(e)}")
+            traceback.print_exc()
+    return {'statusCode': 200, 'body': json.dumps({'jobs': results})}
+
+def poll_pending_textract_jobs():
+    """未設定SNS時由排程觸發：逐一查詢待完成作業的狀態（不等待），處理已完成者；超過時間預算的作業留待下次"""
+    results = []
+    deadline = time.monotonic() + TEXTRACT_POLL_MAX_WAIT
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket='stainless-steel-standards-docs', Prefix='textract-jobs/'):
+        for item in page.get('Contents', []):
+            job_id = item['Key'].rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            if time.monotonic() >= deadline:
+                results.append({'job_id': job_id, 'status': 'DEFERRED'})
+                continue
+            try:
+                # 單一作業紀錄遺失或損毀時只略過該作業
+                record = json.loads(s3.get_object(Bucket='stainless-steel-standards-docs', Key=item['Key'])['Body'].read())
+                job_id = record['job_id']
+                status = textract.get_document_text_detection(JobId=job_id, MaxResults=1)['JobStatus']
+                if status == 'SUCCEEDED':
+                    complete_textract_job(job_id, record['file_key'])
+                elif status != 'IN_PROGRESS':
+                    print(f"Textract作業 {job_id} 失敗: {status}")
+                    s3.delete_object(Bucket='stainless-steel-standards-docs', Key=item['Key'])
+                results.append({'job_id': job_id, 'status': status})
+            except Exception as e:
+                print(f"輪詢Textract作業 {job_id} 錯誤: {str(e)}")
+                results.append({'job_id': job_id, 'status': 'ERROR', 'error': str(e)})
+    return {'jobs': results}
+
+TABLE_CONTINUATION_MARGIN = 0.2  # 跨頁延續的表格須貼近上一頁底部與本頁頂部（頁面高度比例）
+
 def extract_tables_from_textract(textract_response):
-    """從Textract返回的表格結果中提取結構化數據"""
+    """從Textract返回的表格結果中提取結構化數據，支援合併儲存格與跨頁表格"""
     tables = []
     
     if 'Blocks' not in textract_response:
         return tables
     
-    # 找出所有表格
-    table_blocks = {}
-    cell_blocks = {}
-    
-    for block in textract_response['Blocks']:
-        if block['BlockType'] == 'TABLE':
-            table_blocks[block['Id']] = []
-        elif block['BlockType'] == 'CELL':
-            cell_blocks[block['Id']] = {
-                'RowIndex': block['RowIndex'],
-                'ColumnIndex': block['ColumnIndex'],
-                'RowSpan': block.get('RowSpan', 1),
-                'ColumnSpan': block.get('ColumnSpan', 1),
-                'content': ''
-            }
-    
-    # 找出所有單元格對應的表格
-    for block in textract_response['Blocks']:
-        if block['BlockType'] == 'TABLE' and 'Relationships' in block:
-            for relationship in block['Relationships']:
-                if relationship['Type'] == 'CHILD':
-                    for cell_id in relationship['Ids']:
-                        if cell_id in cell_blocks:
-                            table_blocks[block['Id']].append(cell_id)
-    
-    # 填充單元格內容
-    for block in textract_response['Blocks']:
-        if block['BlockType'] == 'CELL' and 'Relationships' in block:
-            cell_content = ''
-            for relationship in block['Relationships']:
-                if relationship['Type'] == 'CHILD':
-                    for child_id in relationship['Ids']:
-                        for content_block in textract_response['Blocks']:
-                            if content_block['Id'] == child_id and content_block['BlockType'] in ['WORD', 'LINE']:
-                                cell_content += content_block.get('Text', '') + ' '
-            cell_blocks[block['Id']]['content'] = cell_content.strip()
-    
-    # 組織表格數據
-    for table_id, cell_ids in table_blocks.items():
-        if not cell_ids:
-            continue
-            
-        # 確定表格大小
+    # 單次建立 Id -> 區塊 索引，避免對每個子項目重新掃描全部區塊
+    block_index = {block['Id']: block for block in textract_response['Blocks']}
+    
+    def related_ids(block, relationship_type='CHILD'):
+        for relationship in block.get('Relationships', []):
+            if relationship['Type'] == relationship_type:
+                yield from relationship['Ids']
+    
+    def cell_text(cell):
+        words = []
+        for child_id in related_ids(cell):
+            child = block_index.get(child_id)
+            if child and child['BlockType'] in ('WORD', 'LINE'):
+                words.append(child.get('Text', ''))
+        return ' '.join(words).strip()
+    
+    # 依頁碼與頁面位置排序表格，以便判斷跨頁延續
+    table_blocks = [block for block in textract_response['Blocks'] if block['BlockType'] == 'TABLE']
+    table_blocks.sort(key=lambda block: (
+        block.get('Page', 1),
+        block.get('Geometry', {}).get('BoundingBox', {}).get('Top', 0)
+    ))
+    
+    table_pages = []
+    for table_block in table_blocks:
+        grid = {}
         max_row = 0
         max_col = 0
-        for cell_id in cell_ids:
-            cell = cell_blocks[cell_id]
-            max_row = max(max_row, cell['RowIndex'])
-            max_col = max(max_col, cell['ColumnIndex'])
         
-        # 創建空表格
-        table = [[''] * max_col for _ in range(max_row)]
+        # 填充單元格內容，跨列/跨欄的單元格填入所覆蓋的每個位置
+        for cell_id in related_ids(table_block):
+            cell = block_index.get(cell_id)
+            if not cell or cell['BlockType'] != 'CELL':
+                continue
+            text = cell_text(cell)
+            row_end = cell['RowIndex'] + cell.get('RowSpan', 1)
+            col_end = cell['ColumnIndex'] + cell.get('ColumnSpan', 1)
+            for row in range(cell['RowIndex'], row_end):
+                for col in range(cell['ColumnIndex'], col_end):
+                    grid[(row, col)] = text
+            max_row = max(max_row, row_end - 1)
+            max_col = max(max_col, col_end - 1)
         
-        # 填充表格內容
-        for cell_id in cell_ids:
-            cell = cell_blocks[cell_id]
-            row_idx = cell['RowIndex'] - 1  # 0-based index
-            col_idx = cell['ColumnIndex'] - 1  # 0-based index
-            table[row_idx][col_idx] = cell['content']
+        if not grid:
+            continue
         
-        tables.append(table)
+        # 合併儲存格：文字分散在組成的單元格中，合併後填入整個範圍
+        for merged_id in related_ids(table_block, 'MERGED_CELL'):
+            merged = block_index.get(merged_id)
+            if not merged:
+                continue
+            texts = [cell_text(block_index[cell_id]) for cell_id in related_ids(merged) if cell_id in block_index]
+            merged_text = ' '.join(text for text in texts if text)
+            for row in range(merged['RowIndex'], merged['RowIndex'] + merged.get('RowSpan', 1)):
+                for col in range(merged['ColumnIndex'], merged['ColumnIndex'] + merged.get('ColumnSpan', 1)):
+                    grid[(row, col)] = merged_text
+        
+        # 組織表格數據
+        table = [[grid.get((row, col), '') for col in range(1, max_col + 1)] for row in range(1, max_row + 1)]
+        page = table_block.get('Page', 1)
+        has_title = any(True for _ in related_ids(table_block, 'TABLE_TITLE'))
+        box = table_block.get('Geometry', {}).get('BoundingBox', {})
+        top = box.get('Top', 0)
+        bottom = top + box.get('Height', 0)
+        
+        # 跨頁表格：上一頁最後一個表格延伸到頁面底部、本頁第一個表格從頁面頂部開始，
+        # 且欄數相同、本表無標題時合併；只是欄數相同的兩個獨立表格不合併
+        # （表格已排序，頁碼不同即代表分別為上一頁最後與本頁第一個表格）
+        if table_pages and not has_title:
+            previous_table, previous_page, previous_bottom = table_pages[-1]
+            adjoining = previous_bottom >= 1 - TABLE_CONTINUATION_MARGIN and top <= TABLE_CONTINUATION_MARGIN
+            if page == previous_page + 1 and len(previous_table[0]) == max_col and adjoining:
+                # 重複的表頭列不再加入
+                continuation = table[1:] if table[0] == previous_table[0] else table
+                previous_table.extend(continuation)
+                table_pages[-1] = (previous_table, page, bottom)
+                continue
+        
+        table_pages.append((table, page, bottom))
     
+    tables = [table for table, _, _ in table_pages]
     return tables
 
+def split_text_by_bytes(text, max_bytes):
+    """依UTF-8位元組數切分文本，不會切斷多位元組字元（例如中文）"""
+    encoded = text.encode('utf-8')
+    chunks = []
+    start = 0
+    while start < len(encoded):
+        end = min(start + max_bytes, len(encoded))
+        # 向前退到字元邊界（UTF-8延續位元組為0b10xxxxxx）
+        while end < len(encoded) and end > start and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        if end == start:
+            # 上限小於單一字元時至少取一個完整字元，避免無限迴圈
+            end = start + 1
+            while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+                end += 1
+        chunks.append(encoded[start:end].decode('utf-8'))
+        start = end
+    return chunks
+
+# 規範文本的結構標記
+PAGE_MARKER_PATTERN = re.compile(r'^--- 第(\d+)頁 ---$')
+HEADING_PATTERN = re.compile(
+    r'^\s*(?:'
+    r'(?P<clause>\d{1,2}(?:\.\d{1,3}){0,4})\.?\s+\S'  # 條款編號，如 5.2.1 Chemical Composition
+    r'|(?P<chapter>第[一二三四五六七八九十百\d]+[章節條])'  # 中文章節
+    r'|(?P<section>(?:Section|SECTION|Annex|ANNEX|Appendix|APPENDIX|附錄|附件)\s*[\dA-Z]*)'
+    r'|(?P<table>(?:Table|TABLE|表格?)\s*[\dA-Z]+)'
+    r'|(?P<sheet>工作表:.*)'
+    r')'
+)
+STANDARD_ID_PATTERN = re.compile(r'\b(ASTM|JIS|EN|ISO|DIN|GB/T|GB|BS|SAE|AISI|ASME)\s*[A-Z]?\s*\d+(?:[.\-]\d+)*')
+
+TABLE_SEPARATOR_PATTERN = re.compile(r'^[\s|+:]*[-=]{3,}[\s\-=|+:]*$')
+TABLE_HEADER_FRACTION = 8  # 每段重複的表頭最多佔片段上限的 1/8
+
+def is_table_line(line):
+    """判斷是否為表格列（Textract/Excel/CSV轉換後以 | 分隔）"""
+    return line.count(' | ') >= 1
+
+def is_table_separator(line):
+    """判斷是否為表頭下的分隔線（Excel/CSV轉換後的 ----- 或Markdown的 |---|）"""
+    return TABLE_SEPARATOR_PATTERN.match(line) is not None
+
+def chunk_standard_text(text, source_key, max_bytes=KENDRA_CHUNK_BYTES, overlap_bytes=KENDRA_CHUNK_OVERLAP_BYTES):
+    """依章節標題、條款編號與表格邊界切分規範文本，並附加標準編號、條款與頁碼資訊"""
+    standard_match = STANDARD_ID_PATTERN.search(text[:2000]) or STANDARD_ID_PATTERN.search(source_key)
+    standard_id = re.sub(r'\s+', ' ', standard_match.group(0)) if standard_match else ''
+    
+    # 第一步：將文本分成結構區塊，標題、表格起訖與換頁處為邊界
+    blocks = []
+    current = None
+    page = 1
+    clause = ''
+    for line in text.splitlines():
+        page_match = PAGE_MARKER_PATTERN.match(line.strip())
+        if page_match:
+            page = int(page_match.group(1))
+            continue
+        if not line.strip():
+            continue
+        
+        # 表頭下的分隔線屬於同一個表格，不作為區塊邊界
+        if current is not None and current['is_table'] and current['page'] == page and is_table_separator(line):
+            current['lines'].append(line)
+            continue
+        
+        heading = HEADING_PATTERN.match(line)
+        table_line = is_table_line(line)
+        if heading and not table_line:
+            clause = line.strip()[:80]
+        
+        if (current is None or (heading and not table_line) or current['is_table'] != table_line
+                or current['page'] != page):
+            current = {'lines': [], 'is_table': table_line, 'clause': clause, 'page': page}
+            blocks.append(current)
+        current['lines'].append(line)
+    
+    # 第二步：超過上限的區塊按行切分，表格每段重複表頭列（不含分隔線）；
+    # 表頭過長時只重複開頭部分，確保每段不超過上限
+    pieces = []
+    for block in blocks:
+        header = None
+        if block['is_table']:
+            header = split_text_by_bytes(block['lines'][0], max(1, max_bytes // TABLE_HEADER_FRACTION))[0]
+        piece_lines = []
+        piece_bytes = 0
+        for line in block['lines']:
+            for segment in split_text_by_bytes(line, max(1, max_bytes // 2)):
+                size = len(segment.encode('utf-8')) + 1
+                if piece_lines and piece_bytes + size > max_bytes // 2:
+                    pieces.append({**block, 'lines': piece_lines})
+                    piece_lines = [header] if header and segment != header else []
+                    piece_bytes = sum(len(l.encode('utf-8')) + 1 for l in piece_lines)
+                piece_lines.append(segment)
+                piece_bytes += size
+        if piece_lines:
+            pieces.append({**block, 'lines': piece_lines})
+    
+    # 第三步：將區塊合併為不超過上限的片段，並帶入上一片段末尾的重疊內容
+    chunks = []
+    chunk_lines = []
+    chunk_bytes = 0
+    chunk_meta = None
+    for piece in pieces:
+        piece_bytes = sum(len(line.encode('utf-8')) + 1 for line in piece['lines'])
+        if chunk_lines and chunk_bytes + piece_bytes > max_bytes:
+            chunks.append({**chunk_meta, 'text': "\n".join(chunk_lines)})
+            overlap = []
+            overlap_size = 0
+            # 表格片段已帶表頭，不需要重疊內容
+            for line in ([] if piece['is_table'] else reversed(chunk_lines)):
+                size = len(line.encode('utf-8')) + 1
+                if overlap_size + size > overlap_bytes or overlap_size + size + piece_bytes > max_bytes:
+                    break
+                overlap.insert(0, line)
+                overlap_size += size
+            chunk_lines = overlap
+            chunk_bytes = overlap_size
+            chunk_meta = None
+        if chunk_meta is None:
+            chunk_meta = {'standard_id': standard_id, 'clause': piece['clause'], 'page': piece['page']}
+        chunk_lines.extend(piece['lines'])
+        chunk_bytes += piece_bytes
+    if chunk_lines:
+        chunks.append({**chunk_meta, 'text': "\n".join(chunk_lines)})
+    
+    return chunks
+
+def batch_kendra_documents(documents):
+    """依文檔數量與請求大小上限將文檔分批"""
+    batches = []
+    current = []
+    current_bytes = 0
+    for document in documents:
+        size = len(document['Blob'])
+        if current and (len(current) >= KENDRA_BATCH_SIZE or current_bytes + size > KENDRA_MAX_BATCH_BYTES):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(document)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+def put_kendra_batch(documents):
+    """提交一批文檔，遇到限流或內部錯誤時以帶抖動的指數退避重試，返回最終失敗的文檔"""
+    pending = documents
+    failed = []
+    for attempt in range(KENDRA_MAX_RETRIES + 1):
+        try:
+            response = kendra.batch_put_document(IndexId=KENDRA_INDEX_ID, Documents=pending)
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code', '')
+            if error_code != 'ThrottlingException' or attempt == KENDRA_MAX_RETRIES:
+                return failed + [
+                    {'Id': document['Id'], 'ErrorCode': error_code, 'ErrorMessage': str(e)}
+                    for document in pending
+                ]
+            time.sleep(random.uniform(0, min(20.0, 0.5 * 2 ** attempt)))
+            continue
+        
+        # 內部錯誤的文檔重試，其餘錯誤直接回報
+        retry_ids = set()
+        for failure in response.get('FailedDocuments', []):
+            if failure.get('ErrorCode') == 'InternalError' and attempt < KENDRA_MAX_RETRIES:
+                retry_ids.add(failure['Id'])
+            else:
+                failed.append(failure)
+        if not retry_ids:
+            return failed
+        pending = [document for document in pending if document['Id'] in retry_ids]
+        time.sleep(random.uniform(0, min(20.0, 0.5 * 2 ** attempt)))
+    return failed
+
+@traced('kendra.index')
 def index_extracted_text(text, source_key):
-    """將提取的文本加入到Kendra索引中"""
+    """將提取的文本分批並行加入到Kendra索引中，返回包含失敗文檔的報告"""
     try:
         # 選擇適當的語言
         language = 'zh' if contains_chinese(text) else 'en'
         
-        # 將文本切分成小塊，確保每塊不超過Kendra的限制
-        max_chunk_size = 5000  # Kendra的文檔大小限制為5KB
-        chunks = [text[i:i+max_chunk_size] for i in range(0, len(text), max_chunk_size)]
+        # 依章節、條款與表格結構切分文本，確保每塊不超過Kendra的限制
+        chunks = chunk_standard_text(text, source_key)
         
+        # 設置屬性過濾器的屬性
+        attributes = {
+            '_language_code': language,
+            '_source_uri': f"s3://stainless-steel-standards-docs/{source_key}",
+            '_file_type': 'PLAIN_TEXT'
+        }
+        
+        # 創建屬性列表
+        attribute_list = []
+        for key, value in attributes.items():
+            attribute_list.append({
+                'Key': key,
+                'Value': {'StringValue': value}
+            })
+        
+        documents = []
         for i, chunk in enumerate(chunks):
-            chunk_id = f"extracted_{source_key.replace('/', '_')}_{i}"
-            
-            # 設置屬性過濾器的屬性
-            attributes = {
-                '_language_code': language,
-                '_source_uri': f"s3://stainless-steel-standards-docs/{source_key}",
-                '_file_type': 'PLAIN_TEXT'
-            }
-            
-            # 創建屬性列表
-            attribute_list = []
-            for key, value in attributes.items():
-                attribute_list.append({
-                    'Key': key,
-                    'Value': {'StringValue': value}
-                })
-            
-            # 將文本塊加入Kendra索引
-            response = kendra.batch_put_document(
-                IndexId=KENDRA_INDEX_ID,
-                Documents=[
-                    {
-                        'Id': chunk_id,
-                        'Blob': chunk.encode('utf-8'),
-                        'ContentType': 'PLAIN_TEXT',
-                        'Title': f"從{source_key}提取的文本 (片段{i+1})",
-                        'Attributes': attribute_list
-                    }
+            # 標題帶入標準編號、條款與頁碼，提升檢索摘錄的可讀性
+            location = " ".join(part for part in [chunk['standard_id'], chunk['clause'], f"第{chunk['page']}頁"] if part)
+            chunk_attributes = attribute_list
+            if KENDRA_CHUNK_ATTRIBUTES:
+                # 需先在Kendra索引中定義這些自訂欄位
+                chunk_attributes = attribute_list + [
+                    {'Key': 'standard_id', 'Value': {'StringValue': chunk['standard_id']}},
+                    {'Key': 'clause', 'Value': {'StringValue': chunk['clause']}},
+                    {'Key': 'page', 'Value': {'LongValue': chunk['page']}}
                 ]
-            )
-            print(f"已將文本片段{i+1}加入索引: {response}")
+            documents.append({
+                'Id': f"extracted_{source_key.replace('/', '_')}_{i}",
+                'Blob': chunk['text'].encode('utf-8'),
+                'ContentType': 'PLAIN_TEXT',
+                'Title': f"{location} - 從{source_key}提取的文本 (片段{i+1})",
+                'Attributes': chunk_attributes
+            })
         
-        return True
+        # 並行提交各批次
+        batches = batch_kendra_documents(documents)
+        failed = []
+        with ThreadPoolExecutor(max_workers=KENDRA_INDEX_WORKERS) as executor:
+            for batch_failures in executor.map(with_trace_context(put_kendra_batch), batches):
+                failed.extend(batch_failures)
+        
+        for failure in failed:
+            print(f"文本片段索引失敗 {failure['Id']}: {failure.get('ErrorCode')} {failure.get('ErrorMessage')}")
+        print(f"已將 {len(documents) - len(failed)}/{len(documents)} 個文本片段以 {len(batches)} 個批次加入索引")
+        
+        return {
+            'success': not failed,
+            'indexed': len(documents) - len(failed),
+            'failed': failed
+        }
     except Exception as e:
         print(f"索引文本錯誤: {str(e)}")
-        return False
+        return {'success': False, 'indexed': 0, 'failed': [], 'error': str(e)}
 
+@traced('kendra')
 def query_kendra(query):
     """查詢Kendra索引獲取相關知識"""
     try:
@@ -610,28 +2192,140 @@ def query_kendra(query):
         print(f"Kendra query error: {str(e)}")
         return []
 
+CHINESE_CHAR_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+
 def contains_chinese(text):
     """檢查文本是否包含中文字符"""
-    for char in text:
-        if '\u4e00' <= char <= '\u9fff':
-            return True
-    return False
+    return CHINESE_CHAR_PATTERN.search(text) is not None
+
+CJK_CHAR_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+def estimate_tokens(text):
+    """粗估token數：中日文字元約一字一token，其餘約四個字元一token"""
+    if not text:
+        return 0
+    cjk_count = len(CJK_CHAR_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    """截斷文本使估計token數不超過上限"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + "...(已截斷)"
+
+def session_meta_key(user_id, session_id):
+    """對話的中繼資料項目（摘要等），排序鍵不會被 session_id# 前綴查詢取到"""
+    return {'user_id': user_id, 'timestamp_session': f"{session_id}!meta"}
+
+def summarize_turn(item):
+    """抽取式摘要：取訊息第一個有內容的行，優先略過Markdown標題"""
+    lines = [line.strip() for line in item['message'].splitlines() if line.strip().strip('#*|>-: ')]
+    if not lines:
+        return ""
+    body_lines = [line for line in lines if not line.startswith('#')]
+    return truncate_to_tokens((body_lines or lines)[0].strip('#*|> ').strip(), 60)
 
+def update_session_summary(user_id, session_id, summary, summarized_until, dropped_items):
+    """把移出視窗的對話併入滾動摘要，超過上限時捨棄最舊的行；回應送出後才寫入"""
+    lines = summary.splitlines() if summary else []
+    for item in dropped_items:
+        if summarized_until and item['timestamp_session'] <= summarized_until:
+            continue
+        text = summarize_turn(item)
+        if text:
+            lines.append(f"{'問' if item['is_user'] else '答'}: {text}")
+    while lines and estimate_tokens("\n".join(lines)) > HISTORY_SUMMARY_TOKENS:
+        lines.pop(0)
+    
+    newest = dropped_items[-1]['timestamp_session']
+    conversation_writer.enqueue_update({
+        'Key': session_meta_key(user_id, session_id),
+        'UpdateExpression': 'SET summary = :summary, summarized_until = :until',
+        # 並行請求時只允許摘要往前推進
+        'ConditionExpression': 'attribute_not_exists(summarized_until) OR summarized_until < :until',
+        'ExpressionAttributeValues': {':summary': "\n".join(lines), ':until': newest}
+    })
+    return "\n".join(lines)
+
+def fetch_unsummarized_items(user_id, session_id, summarized_until, oldest_fetched):
+    """讀取摘要進度之後、但早於本次讀取範圍的對話（由舊到新），讓超過讀取上限的對話也能併入摘要"""
+    lower = summarized_until or f"{session_id}#"
+    query_args = {
+        'KeyConditionExpression': 'user_id = :uid AND timestamp_session BETWEEN :lower AND :upper',
+        'ExpressionAttributeValues': {':uid': user_id, ':lower': lower, ':upper': oldest_fetched},
+        'ScanIndexForward': True
+    }
+    items = []
+    while True:
+        response = conversation_table.query(**query_args)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    # BETWEEN包含兩端，兩端的項目已摘要或已在讀取範圍內
+    return [item for item in items if summarized_until < item['timestamp_session'] < oldest_fetched]
+
+@traced('history')
 def get_conversation_history(user_id, session_id):
-    """從DynamoDB獲取對話歷史"""
+    """從DynamoDB獲取最近的對話歷史，依token預算截取，較舊的對話以摘要代替"""
     try:
-        response = conversation_table.query(
-            KeyConditionExpression='user_id = :uid AND begins_with(timestamp_session, :sid)',
-            ExpressionAttributeValues={
-                ':uid': user_id,
-                ':sid': f"{session_id}#"
-            },
-            ScanIndexForward=True,
-            Limit=10  # 限制歷史記錄數量
-        )
+        # 先讀取中繼資料項目（序號與摘要），序號未變時使用容器內快取，略過查詢
+        meta = conversation_table.get_item(
+            Key=session_meta_key(user_id, session_id),
+            ProjectionExpression='#seq, #summary, #until',
+            ExpressionAttributeNames={'#seq': 'seq', '#summary': 'summary', '#until': 'summarized_until'}
+        ).get('Item') or {}
+        remote_seq = int(meta.get('seq', 0))
+        cache_key = (user_id, session_id)
+        items = session_cache.get(cache_key, remote_seq)
+        
+        if items is None:
+            # 由新到舊讀取，最新的對話優先放入視窗
+            response = conversation_table.query(
+                KeyConditionExpression='user_id = :uid AND begins_with(timestamp_session, :sid)',
+                ExpressionAttributeValues={
+                    ':uid': user_id,
+                    ':sid': f"{session_id}#"
+                },
+                ScanIndexForward=False,
+                Limit=HISTORY_FETCH_LIMIT
+            )
+            items = response.get('Items', [])
+            session_cache.store(cache_key, items, remote_seq)
+        
+        window = []
+        used_tokens = 0
+        for item in items:
+            tokens = estimate_tokens(item['message'])
+            if used_tokens + tokens > HISTORY_TOKEN_BUDGET:
+                # 最新一則就超過預算時截斷後保留
+                if not window:
+                    window.append(dict(item, message=truncate_to_tokens(item['message'], HISTORY_TOKEN_BUDGET)))
+                break
+            window.append(item)
+            used_tokens += tokens
+        dropped = list(reversed(items[len(window):]))
+        
+        # 摘要存放在對話的中繼資料項目
+        summary = meta.get('summary', "")
+        summarized_until = meta.get('summarized_until', "")
+        # 讀取數達上限時更舊的對話不在items中，摘要尚未涵蓋的部分另外讀取
+        if len(items) >= HISTORY_FETCH_LIMIT and items[-1]['timestamp_session'] > summarized_until:
+            dropped = fetch_unsummarized_items(user_id, session_id, summarized_until, items[-1]['timestamp_session']) + dropped
+        if dropped and dropped[-1]['timestamp_session'] > summarized_until:
+            summary = update_session_summary(user_id, session_id, summary, summarized_until, dropped)
         
         history = []
-        for item in response.get('Items', []):
+        if summary:
+            history.append({'role': 'summary', 'content': summary})
+        for item in reversed(window):
             history.append({
                 'role': 'human' if item['is_user'] else 'assistant',
                 'content': item['message']
@@ -643,27 +2337,172 @@ def get_conversation_history(user_id, session_id):
         print(f"Error retrieving conversation history: {str(e)}")
         return []
 
+def format_conversation_turns(conversation_history):
+    """將對話歷史逐則格式化，摘要放在最前面"""
+    turns = []
+    for turn in conversation_history:
+        if turn['role'] == 'summary':
+            turns.append(f"先前對話摘要:\n{turn['content']}\n\n")
+            continue
+        role = "Human" if turn['role'] == 'human' else "Assistant"
+        turns.append(f"{role}: {turn['content']}\n\n")
+    return turns
+
+class ConversationWriter:
+    """批次寫入對話紀錄，讓使用者看到的回應不必等待DynamoDB
+    
+    模式：extension在回應送出後由Lambda內部擴充功能寫入；thread由背景執行緒寫入；
+    sync在handler結束前同步寫入（擴充功能註冊失敗時的後備）
+    """
+    
+    BATCH_SIZE = 25
+    
+    def __init__(self, mode):
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.pending = []
+        self.updates = []
+        self.ready = threading.Event()
+        if mode == 'extension':
+            self._start_extension()
+        elif mode == 'thread':
+            threading.Thread(target=self._run_thread, name='conversation-writer', daemon=True).start()
+    
+    def enqueue(self, items):
+        """加入待寫入的項目"""
+        with self.lock:
+            self.pending.extend(items)
+        if self.mode == 'thread':
+            self.ready.set()
+    
+    def enqueue_update(self, params, on_success=None):
+        """加入待執行的update_item（例如對話摘要）；on_success在更新成功後呼叫"""
+        with self.lock:
+            self.updates.append((params, on_success))
+        if self.mode == 'thread':
+            self.ready.set()
+    
+    def invocation_finished(self):
+        """handler結束時呼叫：通知擴充功能開始寫入，或同步寫入"""
+        if self.mode == 'extension':
+            self.ready.set()
+        elif self.mode == 'sync':
+            self.flush()
+    
+    def flush(self):
+        """以batch_write_item寫入所有待寫入項目並執行更新，返回最終失敗的數量"""
+        with self.lock:
+            items, self.pending = self.pending, []
+            updates, self.updates = self.updates, []
+        failed = 0
+        for start in range(0, len(items), self.BATCH_SIZE):
+            failed += self._write_batch([{'PutRequest': {'Item': item}} for item in items[start:start + self.BATCH_SIZE]])
+        # 中繼資料（序號、摘要）在對話項目寫入後才更新
+        for params, on_success in updates:
+            try:
+                conversation_table.update_item(**params)
+                if on_success:
+                    on_success()
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    print(f"Error updating conversation metadata: {str(e)}")
+            except Exception as e:
+                print(f"Error updating conversation metadata: {str(e)}")
+        if failed:
+            print(f"對話紀錄寫入失敗: {failed}/{len(items)} 筆")
+        # 語意快取的新項目也在回應送出後批次寫回
+        if SEMANTIC_CACHE_ENABLED:
+            semantic_cache.flush()
+        return failed
+    
+    def _write_batch(self, write_requests):
+        """寫入一批項目，未處理項目與限流以帶抖動的指數退避重試"""
+        table_name = conversation_table.name
+        for attempt in range(CONVERSATION_WRITE_RETRIES + 1):
+            try:
+                response = conversation_table.meta.client.batch_write_item(RequestItems={table_name: write_requests})
+                write_requests = response.get('UnprocessedItems', {}).get(table_name, [])
+            except ClientError as e:
+                error_code = e.response.get('Error', {}).get('Code', '')
+                if error_code not in ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded'):
+                    print(f"Error writing conversation batch: {str(e)}")
+                    return len(write_requests)
+            except Exception as e:
+                print(f"Error writing conversation batch: {str(e)}")
+                return len(write_requests)
+            if not write_requests:
+                return 0
+            if attempt < CONVERSATION_WRITE_RETRIES:
+                time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+        return len(write_requests)
+    
+    def _run_thread(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            self.flush()
+    
+    def _start_extension(self):
+        """在初始化階段註冊內部擴充功能；Lambda會等擴充功能呼叫next後才凍結環境"""
+        runtime_api = os.environ.get('AWS_LAMBDA_RUNTIME_API')
+        try:
+            response = requests.post(
+                f"http://{runtime_api}/2020-01-01/extension/register",
+                headers={'Lambda-Extension-Name': 'conversation-writer'},
+                json={'events': ['INVOKE']},
+                timeout=2
+            )
+            response.raise_for_status()
+            extension_id = response.headers['Lambda-Extension-Identifier']
+        except Exception as e:
+            print(f"無法註冊Lambda擴充功能，改為同步寫入: {str(e)}")
+            self.mode = 'sync'
+            return
+        threading.Thread(target=self._run_extension, args=(runtime_api, extension_id), name='conversation-writer', daemon=True).start()
+    
+    def _run_extension(self, runtime_api, extension_id):
+        while True:
+            try:
+                # 等待下一次調用開始；回傳前環境不會被凍結
+                requests.get(
+                    f"http://{runtime_api}/2020-01-01/extension/event/next",
+                    headers={'Lambda-Extension-Identifier': extension_id},
+                    timeout=None
+                ).raise_for_status()
+            except Exception as e:
+                print(f"Lambda擴充功能事件錯誤，改為同步寫入: {str(e)}")
+                self.mode = 'sync'
+                self.flush()
+                return
+            # handler回傳後（回應已送出）才寫入
+            self.ready.wait()
+            self.ready.clear()
+            self.flush()
+
+def resolve_conversation_write_mode():
+    """決定對話寫入模式"""
+    if CONVERSATION_WRITE_MODE != 'auto':
+        return CONVERSATION_WRITE_MODE
+    return 'extension' if os.environ.get('AWS_LAMBDA_RUNTIME_API') else 'thread'
+
+conversation_writer = ConversationWriter(resolve_conversation_write_mode())
+
 def save_conversation(user_id, session_id, user_message, assistant_response):
-    """將對話儲存到DynamoDB"""
-    import time
-    
+    """將對話加入批次寫入佇列，回應送出後才寫入DynamoDB"""
     timestamp = str(int(time.time() * 1000))
     
-    # 保存用戶消息
-    conversation_table.put_item(
-        Item={
+    items = [
+        # 用戶消息
+        {
             'user_id': user_id,
             'timestamp_session': f"{session_id}#{timestamp}_1",
             'message': user_message,
             'is_user': True,
             'session_id': session_id,
             'timestamp': timestamp
-        }
-    )
-    
-    # 保存助理響應
-    conversation_table.put_item(
-        Item={
+        },
+        # 助理響應
+        {
             'user_id': user_id,
             'timestamp_session': f"{session_id}#{timestamp}_2",
             'message': assistant_response,
@@ -671,10 +2510,192 @@ def save_conversation(user_id, session_id, user_message, assistant_response):
             'session_id': session_id,
             'timestamp': timestamp
         }
-    )
+    ]
+    conversation_writer.enqueue(items)
+    cache_key = (user_id, session_id)
+    generation = session_cache.append(cache_key, items)
+    # 序號遞增讓其他容器得知快取已過時；寫入器會先寫對話項目再更新序號，成功後本容器快取才計入這次寫入
+    conversation_writer.enqueue_update({
+        'Key': session_meta_key(user_id, session_id),
+        'UpdateExpression': 'ADD seq :one',
+        'ExpressionAttributeValues': {':one': 1}
+    }, on_success=(lambda: session_cache.confirm_write(cache_key, generation)) if generation else None)
+
+QUERY_TERM_PATTERN = re.compile(r'[A-Z0-9][A-Z0-9.\-]*|[\u4e00-\u9fff]+')
+
+def query_terms(text):
+    """提取比對用的詞：英數字詞與中文二字詞"""
+    terms = set()
+    for token in QUERY_TERM_PATTERN.findall(text.upper()):
+        if CJK_CHAR_PATTERN.match(token):
+            terms.update(token[i:i + 2] for i in range(max(1, len(token) - 1)))
+        elif len(token) > 1:
+            terms.add(token)
+    return terms
+
+def rank_excerpts(message, excerpts, text_of):
+    """依與問題共同詞的數量排序摘錄，同分時保留原本順序"""
+    terms = query_terms(message)
+    if not terms or len(excerpts) < 2:
+        return list(excerpts)
+    scores = [len(terms & query_terms(text_of(excerpt))) for excerpt in excerpts]
+    order = sorted(range(len(excerpts)), key=lambda i: -scores[i])
+    return [excerpts[i] for i in order]
+
+class PromptPlanner:
+    """依優先順序為各段落分配token預算，超出上限時捨棄低排序的摘錄或截斷，並回報被捨棄的內容
+    
+    系統提示與問題一定保留；段落依加入順序組合，依priority（數字小者優先）分配預算，
+    設定reserve的段落先預留該預算，優先順序較高的段落不能佔用。
+    """
+    
+    def __init__(self, system_prompt, question, ceiling=None):
+        self.system_prompt = system_prompt
+        self.question = question
+        self.ceiling = ceiling or PROMPT_TOKEN_CEILING
+        self.sections = []
+    
+    def add(self, name, priority, items, header="", separator="\n\n", keep='head', reserve=0):
+        """加入段落；items依重要性排列，keep='tail'時從最後面保留（例如對話歷史），reserve為預留的token數"""
+        items = [item for item in items if item]
+        if items:
+            self.sections.append({
+                'name': name, 'priority': priority, 'items': items,
+                'header': header, 'separator': separator, 'keep': keep, 'reserve': reserve
+            })
+    
+    def _reserved(self, section):
+        """段落實際需要預留的預算：不超過reserve，也不超過段落本身的大小"""
+        if not section['reserve']:
+            return 0
+        overhead = estimate_tokens(section['header']) + estimate_tokens(section['separator'])
+        return overhead + min(section['reserve'], sum(estimate_tokens(item) for item in section['items']))
+    
+    def _fit(self, section, budget):
+        """在預算內盡量保留摘錄，返回 (文本, 統計)"""
+        header_tokens = estimate_tokens(section['header']) + estimate_tokens(section['separator'])
+        items = section['items'] if section['keep'] == 'head' else list(reversed(section['items']))
+        kept = []
+        used = header_tokens
+        truncated = False
+        for item in items:
+            tokens = estimate_tokens(item)
+            if used + tokens <= budget:
+                kept.append(item)
+                used += tokens
+                continue
+            # 放不下時，剩餘空間足夠則截斷這一則
+            if budget - used >= PROMPT_MIN_EXCERPT_TOKENS:
+                kept.append(truncate_to_tokens(item, budget - used) + "\n\n")
+                used = budget
+                truncated = True
+            break
+        
+        stats = {'items': len(kept), 'dropped_items': len(items) - len(kept), 'truncated': truncated}
+        if not kept:
+            stats['tokens'] = 0
+            return "", stats
+        if section['keep'] == 'tail':
+            kept.reverse()
+        stats['tokens'] = used
+        return section['header'] + "".join(kept), stats
+    
+    def build(self, report=None):
+        """組合提示；report為選用的輸出參數，記錄各段落的token數與被捨棄的內容"""
+        remaining = self.ceiling - estimate_tokens(self.system_prompt + "\n\n") - estimate_tokens(self.question)
+        rendered = {}
+        section_stats = {}
+        reserved = {section['name']: self._reserved(section) for section in self.sections}
+        for section in sorted(self.sections, key=lambda item: item['priority']):
+            # 尚未分配的段落所預留的預算不能被這個段落佔用
+            reserved.pop(section['name'])
+            text, stats = self._fit(section, max(0, remaining - sum(reserved.values())))
+            remaining -= stats['tokens']
+            rendered[section['name']] = text
+            section_stats[section['name']] = stats
+        
+        full_prompt = f"{self.system_prompt}\n\n"
+        for section in self.sections:
+            if rendered[section['name']]:
+                full_prompt += rendered[section['name']] + section['separator']
+        full_prompt += self.question
+        
+        dropped = [name for name, stats in section_stats.items() if stats['dropped_items'] or stats['truncated']]
+        if dropped:
+            print(f"提示超過上限 {self.ceiling} tokens，已截斷或捨棄: {', '.join(dropped)}")
+        if report is not None:
+            report.update({
+                'ceiling': self.ceiling,
+                'total_tokens': estimate_tokens(full_prompt),
+                'sections': section_stats,
+                'dropped': dropped
+            })
+        return full_prompt
+
+def format_file_analysis(file_type, file_key, extracted_text, file_analysis, include_nlp=True):
+    """整理上傳文件的分析結果，返回 (中繼資料文本, 提取的文本)"""
+    file_analysis_text = "用戶已上傳文件，以下是文件分析結果:\n"
+    
+    # 添加文件類型信息
+    file_analysis_text += f"文件類型: {file_type}\n"
+    
+    # 添加結構化數據信息
+    if file_analysis.get('structured_data'):
+        file_analysis_text += "檔案包含結構化數據。\n"
+    
+    # 添加表格信息
+    if file_analysis.get('tables'):
+        table_count = len(file_analysis.get('tables', []))
+        file_analysis_text += f"檔案中識別出 {table_count} 個表格。\n"
+    
+    # 添加關鍵片語
+    if include_nlp and file_analysis.get('key_phrases'):
+        key_phrases = [phrase.get('Text', '') for phrase in file_analysis.get('key_phrases', [])[:10]]
+        if key_phrases:
+            file_analysis_text += "檔案關鍵片語: " + ", ".join(key_phrases) + "\n"
+    
+    # 添加實體識別結果
+    if include_nlp and file_analysis.get('entities'):
+        entities = {}
+        for entity in file_analysis.get('entities', []):
+            entity_type = entity.get('Type', '')
+            entity_text = entity.get('Text', '')
+            if entity_type not in entities:
+                entities[entity_type] = []
+            if entity_text not in entities[entity_type]:
+                entities[entity_type].append(entity_text)
+        
+        if entities:
+            file_analysis_text += "檔案中識別的實體:\n"
+            for entity_type, texts in entities.items():
+                file_analysis_text += f"- {entity_type}: {', '.join(texts[:5])}"
+                if len(texts) > 5:
+                    file_analysis_text += f" (還有 {len(texts)-5} 項)"
+                file_analysis_text += "\n"
+    
+    # 多頁文件的完整內容仍在非同步處理中
+    if file_analysis.get('async_job'):
+        file_analysis_text += "此文件為多頁文件，完整內容正在背景處理，完成後將加入知識庫。\n"
+    
+    if file_key:
+        file_analysis_text += f"文件已保存為: {file_key}\n"
+    
+    # 提取的文本內容放在最後，超過預算時由規劃器截斷
+    displayed_text = ""
+    if extracted_text:
+        # 限制文本長度，避免提示過長
+        max_text_length = 3000
+        if len(extracted_text) > max_text_length:
+            displayed_text = extracted_text[:max_text_length] + "...(內容已截斷)"
+        else:
+            displayed_text = extracted_text
+        displayed_text = "提取的文本內容:\n" + displayed_text + "\n\n"
+    
+    return file_analysis_text, displayed_text
 
-def construct_prompt(message, conversation_history, kendra_results, file_content=None, file_type=None, file_key=None, extracted_text=None, enhanced_system_prompt=None, file_analysis=None):
-    """使用增強的系統提示構建提示"""
+@traced('prompt')
+def construct_prompt(message, conversation_history, kendra_results, file_content=None, file_type=None, file_key=None, extracted_text=None, enhanced_system_prompt=None, file_analysis=None, grade_reference=None, prompt_report=None):
+    """使用增強的系統提示構建提示，各段落依token預算組合"""
     # 使用增強的系統提示或默認提示
     system_prompt = enhanced_system_prompt or """你是一個專業的不銹鋼國際規範AI助理，專門協助華新麗華公司的技術人員處理客戶訂單相關問題。
 你擅長處理國際規範標準(ASTM、JIS、EN等)與規範項目(鋼種成分、尺寸公差、試驗標準等)的相關問題。
@@ -684,102 +2705,44 @@ def construct_prompt(message, conversation_history, kendra_results, file_content
 回答應包含充分的細節，並盡可能以表格形式呈現比較結果。
 對比較結果要仔細計算化學成分區間，確保兩個標準的要求都能滿足。"""
 
-    # 構建對話歷史
-    conversation_text = ""
-    for turn in conversation_history:
-        role = "Human" if turn['role'] == 'human' else "Assistant"
-        conversation_text += f"{role}: {turn['content']}\n\n"
+    planner = PromptPlanner(system_prompt, f"Human: {message}\n\nAssistant:")
+    
+    # 添加Kendra搜索結果作為背景知識，與問題最相關的排在前面
+    ranked_results = rank_excerpts(message, kendra_results or [], lambda result: f"{result['title']} {result['excerpt']}")
+    planner.add('knowledge', 3, [
+        f"參考 {idx+1}: {result['title']}\n{result['excerpt']}\n\n"
+        for idx, result in enumerate(ranked_results)
+    ], header="以下是相關的專業知識參考:\n\n")
     
-    # 添加Kendra搜索結果作為背景知識
-    knowledge_text = ""
-    if kendra_results:
-        knowledge_text = "以下是相關的專業知識參考:\n\n"
-        for idx, result in enumerate(kendra_results):
-            knowledge_text += f"參考 {idx+1}: {result['title']}\n"
-            knowledge_text += f"{result['excerpt']}\n\n"
+    if grade_reference:
+        planner.add('grade_reference', 1, [grade_reference])
     
     if file_analysis is None:
         file_analysis = {}
 
     # 處理上傳的文件內容
-    file_analysis_text = ""
     if file_content and file_type:
-        file_analysis_text = "用戶已上傳文件，以下是文件分析結果:\n"
-        
-        # 添加文件類型信息
-        file_analysis_text += f"文件類型: {file_type}\n"
-        
-        # 添加提取的文本內容
-        if extracted_text:
-            # 限制文本長度，避免提示過長
-            max_text_length = 3000
-            if len(extracted_text) > max_text_length:
-                displayed_text = extracted_text[:max_text_length] + "...(內容已截斷)"
-            else:
-                displayed_text = extracted_text
-                
-            file_analysis_text += "提取的文本內容:\n"
-            file_analysis_text += displayed_text + "\n\n"
-        
-        # 添加結構化數據信息
-        if file_analysis and file_analysis.get('structured_data'):
-            file_analysis_text += "檔案包含結構化數據。\n"
-        
-        # 添加表格信息
-        if file_analysis and file_analysis.get('tables'):
-            table_count = len(file_analysis.get('tables', []))
-            file_analysis_text += f"檔案中識別出 {table_count} 個表格。\n"
-        
-        # 添加關鍵片語
-        if file_analysis and file_analysis.get('key_phrases'):
-            key_phrases = [phrase.get('Text', '') for phrase in file_analysis.get('key_phrases', [])[:10]]
-            if key_phrases:
-                file_analysis_text += "檔案關鍵片語: " + ", ".join(key_phrases) + "\n"
-        
-        # 添加實體識別結果
-        if file_analysis and file_analysis.get('entities'):
-            entities = {}
-            for entity in file_analysis.get('entities', []):
-                entity_type = entity.get('Type', '')
-                entity_text = entity.get('Text', '')
-                if entity_type not in entities:
-                    entities[entity_type] = []
-                if entity_text not in entities[entity_type]:
-                    entities[entity_type].append(entity_text)
-            
-            if entities:
-                file_analysis_text += "檔案中識別的實體:\n"
-                for entity_type, texts in entities.items():
-                    file_analysis_text += f"- {entity_type}: {', '.join(texts[:5])}"
-                    if len(texts) > 5:
-                        file_analysis_text += f" (還有 {len(texts)-5} 項)"
-                    file_analysis_text += "\n"
-        
-        if file_key:
-            file_analysis_text += f"文件已保存為: {file_key}\n"
-    
-    # 組合最終提示
-    full_prompt = f"{system_prompt}\n\n"
+        file_summary, file_text = format_file_analysis(file_type, file_key, extracted_text, file_analysis)
+        planner.add('file', 2, [file_summary, file_text])
     
-    if knowledge_text:
-        full_prompt += f"{knowledge_text}\n\n"
+    add_conversation_section(planner, conversation_history)
     
-    if file_analysis_text:
-        full_prompt += f"{file_analysis_text}\n\n"
-    
-    if conversation_text:
-        full_prompt += f"{conversation_text}\n"
-    
-    full_prompt += f"Human: {message}\n\nAssistant:"
-    
-    return full_prompt
+    return planner.build(prompt_report)
+
+def add_conversation_section(planner, conversation_history):
+    """加入對話歷史：超過預算時從最舊的開始捨棄，但最近一輪對話有預留預算，追問所需的上下文不會被檢索摘錄擠掉"""
+    turns = format_conversation_turns(conversation_history)
+    latest_tokens = sum(estimate_tokens(turn) for turn in turns[-2:])
+    planner.add('conversation', 4, turns, separator="\n", keep='tail',
+                reserve=min(PROMPT_HISTORY_RESERVE_TOKENS, latest_tokens))
 
+@traced('prompt')
 def construct_prompt_with_web_results(message, conversation_history, kendra_results, 
                                      web_results, detailed_content, 
                                      file_content=None, file_type=None, file_key=None,
                                      extracted_text=None, enhanced_system_prompt=None,
-                                     file_analysis=None):
-    """使用增強的系統提示構建網絡搜索提示"""
+                                     file_analysis=None, grade_reference=None, prompt_report=None):
+    """使用增強的系統提示構建網絡搜索提示，各段落依token預算組合"""
     # 使用增強的系統提示或默認提示
     system_prompt = enhanced_system_prompt or """你是一個專業的不銹鋼國際規範AI助理，專門協助華新麗華公司的技術人員處理客戶訂單相關問題。
 你擅長處理國際規範標準(ASTM、JIS、EN等)與規範項目(鋼種成分、尺寸公差、試驗標準等)的相關問題。
@@ -790,93 +2753,43 @@ def construct_prompt_with_web_results(message, conversation_history, kendra_resu
 為了提供最準確的信息，你已進行了網絡搜索獲取最新資料。在引用這些資料時，要清楚標明信息來源。
 如果網絡搜索結果與內部知識庫有衝突，優先考慮最新的網絡搜索結果，特別是標準更新的情況。"""
 
-    # 構建對話歷史
-    conversation_text = ""
-    for turn in conversation_history:
-        role = "Human" if turn['role'] == 'human' else "Assistant"
-        conversation_text += f"{role}: {turn['content']}\n\n"
+    planner = PromptPlanner(system_prompt, f"Human: {message}\n\nAssistant:")
     
     # 添加Kendra搜索結果
-    knowledge_text = ""
-    if kendra_results:
-        knowledge_text = "以下是內部知識庫的相關專業知識參考:\n\n"
-        for idx, result in enumerate(kendra_results):
-            knowledge_text += f"內部參考 {idx+1}: {result['title']}\n"
-            knowledge_text += f"{result['excerpt']}\n\n"
+    ranked_results = rank_excerpts(message, kendra_results or [], lambda result: f"{result['title']} {result['excerpt']}")
+    planner.add('knowledge', 3, [
+        f"內部參考 {idx+1}: {result['title']}\n{result['excerpt']}\n\n"
+        for idx, result in enumerate(ranked_results)
+    ], header="以下是內部知識庫的相關專業知識參考:\n\n")
+    
+    if grade_reference:
+        planner.add('grade_reference', 1, [grade_reference])
     
     if file_analysis is None:
         file_analysis = {}
 
     # 添加網絡搜索結果
-    web_search_text = ""
-    if web_results:
-        web_search_text = "以下是從網絡搜索獲取的最新資料:\n\n"
-        for idx, result in enumerate(web_results):
-            web_search_text += f"網絡參考 {idx+1}: {result['title']}\n"
-            web_search_text += f"來源: {result['link']}\n"
-            web_search_text += f"摘要: {result['snippet']}\n\n"
+    ranked_web = rank_excerpts(message, web_results or [], lambda result: f"{result['title']} {result['snippet']}")
+    planner.add('web', 5, [
+        f"網絡參考 {idx+1}: {result['title']}\n來源: {result['link']}\n摘要: {result['snippet']}\n\n"
+        for idx, result in enumerate(ranked_web)
+    ], header="以下是從網絡搜索獲取的最新資料:\n\n")
     
     # 添加詳細網頁內容抓取結果
-    detailed_content_text = ""
-    if detailed_content:
-        detailed_content_text = "以下是關鍵網頁的詳細內容:\n\n"
-        for idx, content in enumerate(detailed_content):
-            detailed_content_text += f"詳細內容 {idx+1}: {content['title']}\n"
-            detailed_content_text += f"{content['content'][:1500]}...(內容已截斷)\n\n"
+    ranked_content = rank_excerpts(message, detailed_content or [], lambda content: f"{content['title']} {content['content'][:1500]}")
+    planner.add('detailed_content', 6, [
+        f"詳細內容 {idx+1}: {content['title']}\n{content['content'][:1500]}...(內容已截斷)\n\n"
+        for idx, content in enumerate(ranked_content)
+    ], header="以下是關鍵網頁的詳細內容:\n\n")
     
     # 處理上傳的文件內容
-    file_analysis_text = ""
     if file_content and file_type:
-        file_analysis_text = "用戶已上傳文件，以下是文件分析結果:\n"
-        
-        # 添加文件類型信息
-        file_analysis_text += f"文件類型: {file_type}\n"
-        
-        # 添加提取的文本內容
-        if extracted_text:
-            # 限制文本長度，避免提示過長
-            max_text_length = 3000
-            if len(extracted_text) > max_text_length:
-                displayed_text = extracted_text[:max_text_length] + "...(內容已截斷)"
-            else:
-                displayed_text = extracted_text
-                
-            file_analysis_text += "提取的文本內容:\n"
-            file_analysis_text += displayed_text + "\n\n"
-        
-        # 添加結構化數據信息
-        if file_analysis and file_analysis.get('structured_data'):
-            file_analysis_text += "檔案包含結構化數據。\n"
-        
-        # 添加表格信息
-        if file_analysis and file_analysis.get('tables'):
-            table_count = len(file_analysis.get('tables', []))
-            file_analysis_text += f"檔案中識別出 {table_count} 個表格。\n"
-        
-        if file_key:
-            file_analysis_text += f"文件已保存為: {file_key}\n"
-    
-    # 組合最終提示
-    full_prompt = f"{system_prompt}\n\n"
-    
-    if knowledge_text:
-        full_prompt += f"{knowledge_text}\n\n"
-    
-    if web_search_text:
-        full_prompt += f"{web_search_text}\n\n"
-    
-    if detailed_content_text:
-        full_prompt += f"{detailed_content_text}\n\n"
+        file_summary, file_text = format_file_analysis(file_type, file_key, extracted_text, file_analysis, include_nlp=False)
+        planner.add('file', 2, [file_summary, file_text])
     
-    if file_analysis_text:
-        full_prompt += f"{file_analysis_text}\n\n"
+    add_conversation_section(planner, conversation_history)
     
-    if conversation_text:
-        full_prompt += f"{conversation_text}\n"
-    
-    full_prompt += f"Human: {message}\n\nAssistant:"
-    
-    return full_prompt
+    return planner.build(prompt_report)
 
 def invoke_bedrock(prompt):
     """使用 modelId 調用 Bedrock（on-demand）"""
@@ -904,12 +2817,69 @@ def invoke_bedrock(prompt):
         )
 
         response_body = json.loads(response['body'].read())
+        record_bedrock_usage(response_body.get('usage'))
         return response_body['content'][0]['text']
 
     except Exception as e:
         print(f"Error invoking Bedrock: {str(e)}")
         return f"Error: {str(e)}"
 
+def invoke_bedrock_stream(prompt, usage=None):
+    """使用 invoke_model_with_response_stream 串流調用 Bedrock，逐段產生文本；usage為選用的輸出參數，記錄token數"""
+    if usage is None:
+        usage = {}
+    started = time.monotonic()
+    response = None
+    try:
+        request_body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 4000,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": prompt}]
+                }
+            ],
+            "temperature": 0.1,
+            "top_p": 0.9,
+            "top_k": 250
+        }
+
+        response = bedrock.invoke_model_with_response_stream(
+            modelId=os.environ.get("MODEL_ID", "anthropic.claude-3-sonnet-20240229-v1:0"),
+            body=json.dumps(request_body)
+        )
+
+        for event in response['body']:
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            payload = json.loads(chunk['bytes'])
+            if payload.get('type') == 'message_start':
+                usage['input_tokens'] = payload.get('message', {}).get('usage', {}).get('input_tokens', 0)
+            elif payload.get('type') == 'message_delta':
+                usage['output_tokens'] = payload.get('usage', {}).get('output_tokens', 0)
+            if payload.get('type') == 'content_block_delta':
+                text = payload.get('delta', {}).get('text', '')
+                if text:
+                    yield text
+
+    except Exception as e:
+        print(f"Error invoking Bedrock stream: {str(e)}")
+        usage['error'] = str(e)
+        yield f"Error: {str(e)}"
+    
+    finally:
+        # 提前停止讀取（例如審查階段只回覆無需修改）時關閉底層連線，不把未讀完的串流留在連線池
+        if response is not None:
+            try:
+                response['body'].close()
+            except Exception as e:
+                print(f"關閉Bedrock串流錯誤: {str(e)}")
+        # 串流讀取的時間不含在API呼叫區段內，另外記錄
+        record_span('bedrock.stream', started)
+        record_bedrock_usage(usage)
+
 def invoke_bedrock_with_web_search(prompt, search_query):
     """使用網絡搜索功能調用Bedrock模型"""
     try:
@@ -937,6 +2907,7 @@ def invoke_bedrock_with_web_search(prompt, search_query):
         )
 
         response_body = json.loads(response['body'].read())
+        record_bedrock_usage(response_body.get('usage'))
         return response_body['content'][0]['text']
 
     except Exception as e:
@@ -946,14 +2917,8 @@ def invoke_bedrock_with_web_search(prompt, search_query):
 def check_if_requires_web_search(message, kendra_results):
     """改進版：更積極地判斷是否需要進行網絡搜索，特別是針對標準查詢"""
     # 對於標準比較問題，始終進行網絡搜索
-    standards_keywords = [
-        "ASTM", "EN", "ISO", "JIS", "DIN", "UNS", "AISI", "SAE",
-        "標準", "規範", "對應", "比較", "相當", "換算", "等同"
-    ]
-    
-    for keyword in standards_keywords:
-        if keyword in message:
-            return True
+    if analyze_query(message).web_search_keywords:
+        return True
     
     # 如果Kendra結果不足或可信度低
     if len(kendra_results) < 3:
@@ -968,31 +2933,315 @@ def check_if_requires_web_search(message, kendra_results):
     
     return not has_comprehensive_info
 
-def extract_search_query(message):
-    """從用戶消息中提取搜索查詢關鍵詞"""
-    # 提取標準編號
-    standard_patterns = [
-        r'([A-Z]{2,5}\s*[A-Z]?[0-9]{1,5})',  # 匹配標準號，如ASTM A276
-        r'([A-Z]{2,5}\s*[A-Z]?-[0-9]{1,5})'  # 匹配帶連字符的標準號
-    ]
-    
+# 標準編號與鋼種名稱的匹配模式
+STANDARD_PATTERNS = [
+    re.compile(r'([A-Z]{2,5}\s*[A-Z]?[0-9]{1,5})'),  # 匹配標準號，如ASTM A276
+    re.compile(r'([A-Z]{2,5}\s*[A-Z]?-[0-9]{1,5})')  # 匹配帶連字符的標準號
+]
+STEEL_PATTERNS = [
+    re.compile(r'([0-9]{1,3}-[0-9]{1,2}[A-Z]{1,2})'),  # 如17-4PH
+    re.compile(r'([SN][0-9]{5})'),  # 如S32760、N08904
+    re.compile(r'(SUS\s*[0-9]{3}[A-Z0-9]*)'),  # 如SUS 630、SUS316L、SUS329J3L
+    re.compile(r'(1\.4[0-9]{3})')  # EN材料號，如1.4404
+]
+# 僅用於鋼種對照查詢的模式（AISI編號與EN鋼名）；後面接著單位的數字（如 430 MPa、600 °C）是數值而非鋼種
+MEASUREMENT_UNITS = r'MPA|GPA|KSI|PSI|HBW?|HR[ABC]|HV|°C|°F|℃|MM|CM|KG|N/MM|J\b|%|度|公斤|毫米|公分|公釐|小時'
+AISI_GRADE_PATTERN = re.compile(
+    r'(?<![A-Z0-9.\-])([0-9]{3,4}[A-Z]{0,2})(?![A-Z0-9.\-])(?!\s*(?:' + MEASUREMENT_UNITS + r'))'
+)
+EN_NAME_PATTERN = re.compile(r'(X[0-9]{1,2}[A-Z]+[0-9]+(?:-[0-9]+)*)')
+
+def extract_standard_and_grade_tokens(message):
+    """提取消息中的標準編號與鋼種名稱"""
     standards = []
-    for pattern in standard_patterns:
-        matches = re.findall(pattern, message)
-        standards.extend(matches)
-    
-    # 提取鋼種名稱
-    steel_patterns = [
-        r'([0-9]{1,3}-[0-9]{1,2}[A-Z]{1,2})',  # 如17-4PH
-        r'(S[0-9]{5})',  # 如S32760
-        r'(SUS\s*[0-9]{3})'  # 如SUS 630
-    ]
+    for pattern in STANDARD_PATTERNS:
+        standards.extend(pattern.findall(message))
     
     steels = []
-    for pattern in steel_patterns:
-        matches = re.findall(pattern, message)
-        steels.extend(matches)
+    for pattern in STEEL_PATTERNS:
+        steels.extend(pattern.findall(message))
+    
+    return standards, steels
+
+def format_composition_range(value):
+    """將成分範圍格式化為文字，單一數值代表上限"""
+    if isinstance(value, list):
+        low, high = value
+        return f"≤{high}" if low is None else f"{low}–{high}"
+    return f"≤{value}"
+
+def format_grade_reference(grade_matches):
+    """將鋼種對照結果格式化為Markdown表格與成分範圍"""
+    text = f"以下為本地鋼種對照資料庫（版本 {grade_index.version}）的精確對照:\n\n"
+    text += "| 鋼種 | UNS | AISI | JIS | EN | EN鋼名 |\n"
+    text += "|---|---|---|---|---|---|\n"
+    for _, grade in grade_matches:
+        aliases = grade['aliases']
+        uns = " / ".join(alias for alias in [aliases.get('UNS'), aliases.get('UNS_ALT')] if alias)
+        text += f"| {grade['name']} | {uns} | {aliases.get('AISI', '')} | {aliases.get('JIS', '')} | {aliases.get('EN', '')} | {aliases.get('EN_NAME', '')} |\n"
+    
+    text += "\n化學成分範圍 (wt%):\n"
+    for _, grade in grade_matches:
+        for composition in grade['compositions'].values():
+            elements = ", ".join(f"{element} {format_composition_range(value)}" for element, value in composition['elements'].items())
+            text += f"- {grade['name']} ({composition['standard']}): {elements}\n"
+    return text
+
+def format_range_bounds(low, high):
+    """將上下限格式化為文字"""
+    if low is None and high is None:
+        return "-"
+    if low is None:
+        return f"≤{high:g}"
+    if high is None:
+        return f"≥{low:g}"
+    return f"{low:g}–{high:g}"
+
+def format_composition_comparison(result):
+    """將各規格的成分範圍並列為Markdown表格，用於比較問題（不計算交集）"""
+    text = "以下為各規格的化學成分範圍（wt%，取自本地鋼種對照資料庫），供比較參考:\n\n"
+    text += "| 元素 | " + " | ".join(result['specs']) + " |\n"
+    text += "|---" * (len(result['specs']) + 1) + "|\n"
+    for element, info in result['elements'].items():
+        text += f"| {element} | " + " | ".join(format_range_bounds(low, high) for low, high in info['per_spec']) + " |\n"
+    return text
+
+def format_composition_table(result):
+    """將成分交集結果格式化為Markdown表格"""
+    text = "以下化學成分交集已由系統精確計算（wt%，同時滿足所有列出的標準），請直接引用:\n\n"
+    text += "| 元素 | " + " | ".join(result['specs']) + " | 交集 |\n"
+    text += "|---" * (len(result['specs']) + 2) + "|\n"
+    for element, info in result['elements'].items():
+        per_spec = " | ".join(format_range_bounds(low, high) for low, high in info['per_spec'])
+        merged = "⚠ 無交集" if info['empty'] else format_range_bounds(info['min'], info['max'])
+        text += f"| {element} | {per_spec} | {merged} |\n"
+    if result['conflicts']:
+        text += f"\n注意: {', '.join(result['conflicts'])} 的要求互相衝突，無法同時滿足這些標準。\n"
+    return text
+
+def composition_specs_for_query(query_analysis):
+    """依消息中的鋼種名稱選擇要比較的規格；只提到一個鋼種時比較其所有標準"""
+    rows = []
+    for token, grade in grade_index.match_tokens(query_analysis.grade_tokens):
+        try:
+            row = composition_engine.resolve_spec(token)
+        except ValueError:
+            continue
+        if row not in rows:
+            rows.append(row)
+    if len(rows) == 1:
+        grade_name = composition_engine.spec_keys[rows[0]][0]
+        rows = [row for row, key in enumerate(composition_engine.spec_keys) if key[0] == grade_name]
+    return rows
+
+# 純對照問題中允許出現的連接詞；移除這些詞與鋼種、標準名稱後必須沒有剩餘內容
+GRADE_LOOKUP_CONNECTOR_WORDS = re.compile(
+    r'\b(?:ASTM|AISI|UNS|JIS|EN|DIN|ISO|SUS|EQUIVALENTS?|EQUIVALENCE|CROSS.?REFERENCE|WHAT|WHICH|IS|ARE|THE|OF|TO|IN|FOR|GRADES?)\b|'
+    r'對應|相當|等同|對照|請問|鋼種|鋼號|牌號|材質|不銹鋼|標準|規範|的|是|什麼|哪個|哪些|嗎|呢|和|與|及|跟',
+    re.ASCII
+)
+
+def is_grade_lookup_question(message, grade_matches, query_analysis):
+    """判斷是否為單純的鋼種對照問題（移除鋼種、標準名稱與連接詞後沒有其他內容）"""
+    if not grade_matches or not query_analysis.term_counts['equivalence']:
+        return False
     
+    residual = message.upper()
+    grade_tokens = [token for token, _ in grade_index.match_tokens(query_analysis.grade_tokens)]
+    # re.ASCII下中文不算單詞字元，\b可正確分隔「SUS304和」這類寫法
+    for token in sorted(set(query_analysis.upper_standards + tuple(grade_tokens)), key=len, reverse=True):
+        residual = re.sub(r'\b' + re.escape(token) + r'\b', ' ', residual, flags=re.ASCII)
+    residual = GRADE_LOOKUP_CONNECTOR_WORDS.sub(' ', residual)
+    residual = re.sub(r'[\W_]+', '', residual)
+    return not residual
+
+class AhoCorasick:
+    """純Python的Aho-Corasick自動機：一次掃描找出所有（可重疊的）詞彙出現位置"""
+    
+    def __init__(self, terms):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for term in terms:
+            state = 0
+            for char in term:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(term)
+        
+        # 以廣度優先建立失敗連結，並合併後綴狀態的輸出
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+    
+    def iter_matches(self, text):
+        """逐一產生 (起始位置, 詞彙)"""
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for term in self.output[state]:
+                yield index - len(term) + 1, term
+
+# 查詢分析用的詞彙群組：(詞彙, 是否區分大小寫)；同一群組中重複的詞依出現次數計分
+QUERY_TERM_GROUPS = {
+    # 簡化版專業度評估的專業術語
+    'technical': (["奧氏體", "肥粒體", "馬氏體", "固溶處理", "時效硬化", "PREN", "晶間腐蝕"], False),
+    # 強制網絡搜索的標準關鍵詞
+    'force_web': (["ASTM", "EN", "ISO", "JIS", "DIN", "UNS", "AISI", "SAE",
+                   "標準", "規範", "對應", "比較", "相當"], True),
+    # 需要網絡搜索的標準比較關鍵詞
+    'web_keywords': (["ASTM", "EN", "ISO", "JIS", "DIN", "UNS", "AISI", "SAE",
+                      "標準", "規範", "對應", "比較", "相當", "換算", "等同"], True),
+    # 不同領域的專業術語詞庫
+    'metallurgy': ([
+        "奧氏體", "肥粒體", "馬氏體", "沃斯田鐵", "δ-鐵素體", "肥粒體", "雙相", "析出硬化", 
+        "時效硬化", "固溶處理", "再結晶", "晶粒", "晶界", "晶間腐蝕", "碳化物", "偏析",
+        "塑性變形", "冷作硬化", "熱處理", "退火", "淬火", "回火", "固溶", "沉澱",
+        "滲碳", "氮化", "σ相", "χ相", "金相", "位錯", "孿晶", "位錯", "晶格缺陷"
+    ], False),
+    'corrosion': ([
+        "點蝕", "縫隙腐蝕", "晶間腐蝕", "應力腐蝕開裂", "SCC", "氫脆", "電化學", 
+        "陽極", "陰極", "鈍化", "活性", "氧化還原", "電位", "極化", "電流密度",
+        "腐蝕電位", "電化學阻抗", "循環伏安", "PREN值", "CCT", "CPT", "IGC", "鹽霧測試"
+    ], False),
+    'mechanical': ([
+        "拉伸強度", "降伏強度", "屈服強度", "延伸率", "斷面收縮率", "彈性模量",
+        "硬度", "洛氏硬度", "布氏硬度", "維氏硬度", "衝擊韌性", "疲勞強度", "蠕變",
+        "斷裂韌性", "應力", "應變", "塑性", "脆性", "各向異性", "彈塑性", "應力集中"
+    ], False),
+    'standards': ([
+        "ASTM", "EN", "ISO", "JIS", "DIN", "UNS", "AISI", "SAE", "GB", "BS", 
+        "符合性", "認證", "測試方法", "規格", "等級", "標準偏差", "公差"
+    ], False),
+    # 高級專業術語 - 這些詞語表示深度專業知識
+    'advanced': ([
+        "PRE值計算", "Schaeffler圖", "DeLong圖", "WRC-1992", "孫能曲線", "Hall-Petch關係",
+        "Thermo-Calc", "相圖計算", "電子背散射", "穿透式電子顯微鏡", "電化學阻抗譜", 
+        "循環伏安法", "CALPHAD", "相場模型", "位錯動力學", "Gleeble", "等溫轉變",
+        "連續冷卻轉變", "Z相", "Laves相", "組織定量分析", "晶粒尺寸分佈", "顯微硬度分析"
+    ], False),
+    # 專業問題類型
+    'comparison': (["比較", "差異", "區別", "對比", "相比", "優缺點", "利弊", "不同點"], False),
+    'calculation': (["計算", "公式", "估算", "轉換", "換算", "推導", "求解"], False),
+    'mechanism': (["機制", "原理", "機理", "形成", "過程", "發展", "演變", "影響因素", "條件"], False),
+    # 詢問同時滿足多個規格的材料（成分交集）
+    'intersection': (["同時滿足", "同時符合", "都符合", "都滿足", "皆符合", "雙認證", "雙重認證", "交集", "共同範圍",
+                      "dual cert", "dual-cert", "dual grade", "meets both", "meet both", "satisfy both",
+                      "satisfies both", "comply with both", "complies with both", "intersection"], False),
+    # 鋼種對照用語（判斷是否為單純對照問題）
+    'equivalence': (["對應", "相當", "等同", "對照", "equivalent", "equivalence",
+                     "cross reference", "cross-reference", "crossreference", "cross_reference"], False),
+    # 需要多步推理的比較/計算用語（推理深度評估）
+    'reasoning': (["比較", "對應", "差異", "相當", "交集", "計算", "替代", "是否符合", "VS", "COMPARE", "EQUIVALENT"], False)
+}
+
+def build_query_term_matcher(groups):
+    """把所有群組的詞彙編成一個自動機（以小寫比對），並記錄每個詞所屬的群組"""
+    term_index = {}
+    for group, (terms, case_sensitive) in groups.items():
+        for term in terms:
+            entries = term_index.setdefault(term.lower(), {})
+            key = (group, term, case_sensitive)
+            entries[key] = entries.get(key, 0) + 1
+    return AhoCorasick(term_index), term_index
+
+QUERY_TERM_MATCHER, QUERY_TERM_INDEX = build_query_term_matcher(QUERY_TERM_GROUPS)
+STANDARD_REFERENCE_PATTERN = re.compile(r'[A-Z]{2,5}\s*[A-Z]?[0-9]{1,5}(-[0-9]+)?')
+COMPOSITION_REFERENCE_PATTERN = re.compile(r'(C|Si|Mn|P|S|Cr|Ni|Mo|Ti|Nb|N|Cu|W|V|Co|Al)[<>=≤≥]?(\d+(\.\d+)?)(wt|%|質量分數)?')
+SENTENCE_SPLIT_PATTERN = re.compile(r'[。！？.!?]')
+
+QueryAnalysis = namedtuple('QueryAnalysis', [
+    'language',             # 'zh' 或 'en'
+    'standards',            # 標準編號
+    'steels',               # 鋼種名稱
+    'upper_standards',      # 大寫後的標準編號（正規化與鋼種對照用）
+    'upper_steels',         # 大寫後的鋼種名稱
+    'grade_tokens',         # 鋼種對照的候選名稱（鋼種名稱、AISI編號與EN鋼名）
+    'term_counts',          # 各詞彙群組的命中數
+    'standard_refs',        # 標準引用數量
+    'composition_refs',     # 化學成分表達式數量
+    'avg_sentence_length',
+    'question_count',
+    'expertise_level',      # 簡化版專業度
+    'force_web_search',
+    'web_search_keywords',
+    'search_query'
+])
+
+@lru_cache(maxsize=512)
+def analyze_query(message):
+    """一次掃描分析消息：語言、標準與鋼種、各領域詞彙數、專業度與是否需要網絡搜索；結果依消息快取"""
+    lowered = message.lower()
+    # 小寫後長度不變時可用位置直接檢查大小寫
+    aligned = len(lowered) == len(message)
+    
+    term_counts = {group: 0 for group in QUERY_TERM_GROUPS}
+    seen = set()
+    for start, lowered_term in QUERY_TERM_MATCHER.iter_matches(lowered):
+        for (group, term, case_sensitive), multiplicity in QUERY_TERM_INDEX[lowered_term].items():
+            if (group, term) in seen:
+                continue
+            if case_sensitive:
+                exact = message[start:start + len(term)] == term if aligned else term in message
+                if not exact:
+                    continue
+            seen.add((group, term))
+            term_counts[group] += multiplicity
+    
+    standards, steels = extract_standard_and_grade_tokens(message)
+    # 大寫形式供查詢正規化、鋼種對照與推理深度評估共用，避免各自重新掃描消息
+    upper = message.upper()
+    upper_standards, upper_steels = extract_standard_and_grade_tokens(upper) if upper != message else (standards, steels)
+    grade_tokens = upper_steels + AISI_GRADE_PATTERN.findall(upper) + EN_NAME_PATTERN.findall(upper)
+    standard_refs = len(STANDARD_REFERENCE_PATTERN.findall(message))
+    
+    sentences = [sentence for sentence in SENTENCE_SPLIT_PATTERN.split(message) if sentence]
+    avg_sentence_length = sum(len(sentence) for sentence in sentences) / max(1, len(sentences))
+    
+    # 簡化版用戶專業度評估
+    if term_counts['technical'] >= 3 or standard_refs >= 2:
+        expertise_level = "expert"
+    elif term_counts['technical'] >= 1 or standard_refs >= 1:
+        expertise_level = "intermediate"
+    else:
+        expertise_level = "beginner"
+    
+    return QueryAnalysis(
+        language='zh' if contains_chinese(message) else 'en',
+        standards=tuple(standards),
+        steels=tuple(steels),
+        upper_standards=tuple(upper_standards),
+        upper_steels=tuple(upper_steels),
+        grade_tokens=tuple(grade_tokens),
+        term_counts=term_counts,
+        standard_refs=standard_refs,
+        composition_refs=len(COMPOSITION_REFERENCE_PATTERN.findall(message)),
+        avg_sentence_length=avg_sentence_length,
+        question_count=message.count('?') + message.count('？'),
+        expertise_level=expertise_level,
+        force_web_search=term_counts['force_web'] > 0,
+        web_search_keywords=term_counts['web_keywords'] > 0,
+        search_query=build_search_query(message, standards, steels)
+    )
+
+def extract_search_query(message):
+    """從用戶消息中提取搜索查詢關鍵詞"""
+    return analyze_query(message).search_query
+
+def build_search_query(message, standards, steels):
+    """以標準編號與鋼種名稱組合搜索查詢"""
     # 組合搜索查詢
     search_terms = []
     
@@ -1013,13 +3262,13 @@ def extract_search_query(message):
     
     return search_query
 
-def web_search(query, api_key, search_engine_id):
+def web_search(query, api_key, search_engine_id, deadline=None):
     """使用Google Custom Search API搜索網絡"""
     if not api_key or not search_engine_id:
         print("Google API key or Search Engine ID not provided, skipping web search")
         return []
     
-    url = "https://www.googleapis.com/customsearch/v1"
+    url = GOOGLE_SEARCH_ENDPOINT
     params = {
         'key': api_key,
         'cx': search_engine_id,
@@ -1027,7 +3276,7 @@ def web_search(query, api_key, search_engine_id):
     }
     
     try:
-        response = requests.get(url, params=params)
+        response = http_sessions['search'].get(url, params=params, timeout=http_timeout(deadline))
         
         if response.status_code == 200:
             search_results = response.json()
@@ -1048,9 +3297,21 @@ def web_search(query, api_key, search_engine_id):
         print(f"Error in web search: {str(e)}")
         return []
 
-def enhanced_web_search(query, api_key, search_engine_id):
-    """增強的網絡搜索功能，特別針對鋼鐵標準比較進行優化"""
-    results = []
+def normalize_url(url):
+    """正規化網址以便去重：忽略大小寫主機名、www前綴、片段、結尾斜線與追蹤參數"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query) if not key.startswith('utm_')])
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip('/'), query, ''))
+
+@traced('web.search')
+def enhanced_web_search(query, api_key, search_engine_id, deadline=WEB_SEARCH_TIMEOUT):
+    """增強的網絡搜索功能，特別針對鋼鐵標準比較進行優化；各站點搜索並行執行"""
+    if not api_key or not search_engine_id:
+        print("Google API key or Search Engine ID not provided, skipping web search")
+        return []
     
     # 提取標準編號
     standard_pattern = r'(ASTM|EN|ISO|JIS|DIN|UNS|AISI|SAE)\s*[A-Z]?[0-9\-]+(?:[A-Z]+)?'
@@ -1063,10 +3324,6 @@ def enhanced_web_search(query, api_key, search_engine_id):
     else:
         enhanced_query = query
     
-    # 基本搜索
-    google_results = web_search(enhanced_query, api_key, search_engine_id)
-    results.extend(google_results)
-    
     # 針對標準組織網站進行專門搜索
     standards_sites = [
         "astm.org", "en10088.info", "jisc.go.jp", "iso.org", 
@@ -1074,121 +3331,390 @@ def enhanced_web_search(query, api_key, search_engine_id):
         "worldstainless.org", "steeldata.info"
     ]
     
-    for site in standards_sites:
-        site_query = f"{query} site:{site}"
-        site_results = web_search(site_query, api_key, search_engine_id)
-        for result in site_results:
-            # 避免重複結果
-            if not any(r['link'] == result['link'] for r in results):
+    # 基本搜索與各站點搜索同時送出，共用連線池
+    started = time.monotonic()
+    queries = [enhanced_query] + [f"{query} site:{site}" for site in standards_sites]
+    futures = [
+        submit_traced(search_executor, web_search, search_query, api_key, search_engine_id, deadline)
+        for search_query in queries
+    ]
+    done, not_done = wait(futures, timeout=deadline)
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        print(f"網絡搜索 {len(not_done)}/{len(futures)} 個查詢超過期限")
+    
+    # 依查詢順序合併結果，以正規化網址去重
+    results = []
+    seen_links = set()
+    for future in futures:
+        if future not in done or future.exception():
+            continue
+        for result in future.result():
+            link_key = normalize_url(result['link'])
+            if link_key not in seen_links:
+                seen_links.add(link_key)
                 results.append(result)
     
+    print(f"網絡搜索完成: {len(results)} 筆結果，耗時 {time.monotonic() - started:.2f}s，連線統計: {http_pool_stats()['search']}")
     return results
 
-def scrape_website(url):
-    """增強版網頁抓取，針對鋼鐵標準網站優化"""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+class PageTextExtractor:
+    """單次走訪HTML事件，同時收集表格列、段落與全文；介面相容lxml的target解析器"""
+    
+    SKIP_TAGS = {'script', 'style', 'nav', 'footer', 'header', 'aside'}
+    CELL_TAGS = {'td', 'th'}
+    
+    def __init__(self):
+        self.skip_depth = 0
+        # 巢狀表格：進入內層表格時保存外層未完成的列與儲存格，內層結束後繼續
+        self.table_stack = []
+        self.row_cells = None
+        self.row_slot = None
+        self.cell_parts = None
+        self.paragraph_parts = None
+        self.table_rows = []
+        self.paragraphs = []
+        self.text_parts = []
+        self.pending_text = []
+    
+    def start(self, tag, attrs=None):
+        self._flush_text()
+        tag = tag.lower()
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+        if tag == 'table':
+            # 表格會結束未關閉的段落
+            self._close_paragraph()
+            self.table_stack.append((self.row_cells, self.row_slot, self.cell_parts))
+            self.row_cells = self.row_slot = self.cell_parts = None
+        elif tag == 'tr' and self.table_stack:
+            # 未關閉的列或儲存格在下一個開始標籤時視為結束；先佔位，外層列排在內層表格的列之前
+            self._close_row()
+            self.row_cells = []
+            self.row_slot = len(self.table_rows)
+            self.table_rows.append(None)
+        elif tag in self.CELL_TAGS and self.row_cells is not None:
+            self._close_cell()
+            self.cell_parts = []
+        elif tag == 'p':
+            # <p>不能巢狀，新的段落開始時結束前一段
+            self._close_paragraph()
+            self.paragraph_parts = []
+    
+    def end(self, tag):
+        self._flush_text()
+        tag = tag.lower()
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth:
+            return
+        if tag in self.CELL_TAGS:
+            self._close_cell()
+        elif tag == 'tr':
+            self._close_row()
+        elif tag == 'table' and self.table_stack:
+            self._close_row()
+            self.row_cells, self.row_slot, self.cell_parts = self.table_stack.pop()
+        elif tag == 'p':
+            self._close_paragraph()
+    
+    def data(self, text):
+        if not self.skip_depth:
+            self.pending_text.append(text)
+    
+    def comment(self, text):
+        self._flush_text()
+    
+    def _flush_text(self):
+        # 相鄰的文字事件（例如實體參照前後）合併為一個文字節點再處理
+        if not self.pending_text:
+            return
+        text = ''.join(self.pending_text)
+        self.pending_text = []
+        self.text_parts.append(text)
+        stripped = text.strip()
+        if not stripped:
+            return
+        if self.cell_parts is not None:
+            self.cell_parts.append(stripped)
+        if self.paragraph_parts is not None:
+            self.paragraph_parts.append(stripped)
+    
+    def _close_paragraph(self):
+        if self.paragraph_parts is not None:
+            paragraph = ''.join(self.paragraph_parts)
+            if paragraph:
+                self.paragraphs.append(paragraph)
+            self.paragraph_parts = None
+    
+    def _close_cell(self):
+        if self.cell_parts is not None:
+            self.row_cells.append(''.join(self.cell_parts))
+            self.cell_parts = None
+    
+    def _close_row(self):
+        self._close_cell()
+        if self.row_cells is not None:
+            row_text = ' | '.join(self.row_cells)
+            if row_text.strip():
+                self.table_rows[self.row_slot] = row_text
+            self.row_cells = None
+    
+    def close(self):
+        """組合表格與段落文本，兩者皆無時使用全文"""
+        self._flush_text()
+        while self.table_stack:
+            self._close_row()
+            self.row_cells, self.row_slot, self.cell_parts = self.table_stack.pop()
+        self._close_paragraph()
+        table_rows = [row for row in self.table_rows if row]
+        text = ""
+        if table_rows:
+            text += "表格數據:\n" + "\n".join(table_rows) + "\n\n\n"
+        if self.paragraphs:
+            text += "網頁內容:\n" + "\n".join(self.paragraphs)
+        
+        if not text:
+            lines = (line.strip() for line in '\n'.join(self.text_parts).splitlines())
+            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+            text = '\n'.join(chunk for chunk in chunks if chunk)
+        
+        return text[:15000]
+
+class HTMLParserDriver(HTMLParser):
+    """以標準庫的串流分詞器把事件轉交給extractor"""
+    
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+    
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, attrs)
+    
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag, attrs)
+        self.target.end(tag)
+    
+    def handle_endtag(self, tag):
+        self.target.end(tag)
     
+    def handle_data(self, data):
+        self.target.data(data)
+
+HTML_CHARSET_PATTERN = re.compile(rb'charset=["\']?([A-Za-z0-9_\-]+)')
+
+def decode_html_bytes(html):
+    """依<meta charset>解碼HTML位元組，無宣告時使用UTF-8"""
+    match = HTML_CHARSET_PATTERN.search(html[:4096])
+    if match:
+        try:
+            return html.decode(match.group(1).decode('ascii'), errors='replace')
+        except LookupError:
+            pass
+    return html.decode('utf-8', errors='replace')
+
+def extract_page_text_with_htmlparser(html):
+    """標準庫串流分詞器，單次走訪"""
+    if isinstance(html, bytes):
+        html = decode_html_bytes(html)
+    extractor = PageTextExtractor()
+    driver = HTMLParserDriver(extractor)
+    driver.feed(html)
+    driver.close()
+    return extractor.close()
+
+def extract_page_text_with_lxml(html):
+    """lxml的target解析器（C實作），單次走訪且不建立樹"""
+    encoding = None
+    if isinstance(html, str):
+        # 已解碼的字串若帶有編碼宣告，lxml會拒絕，改以UTF-8位元組餵入
+        html = html.encode('utf-8')
+        encoding = 'utf-8'
+    elif not HTML_CHARSET_PATTERN.search(html[:4096]):
+        # 沒有編碼宣告時lxml預設Latin-1，與其他引擎一致改用UTF-8
+        encoding = 'utf-8'
+    parser = lxml_etree.HTMLParser(target=PageTextExtractor(), encoding=encoding)
+    parser.feed(html)
+    return parser.close()
+
+def extract_page_text_with_bs4(html):
+    """原本的BeautifulSoup多次走訪版本，保留作為對照"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    # 移除不必要的元素
+    for tag in soup(["script", "style", "nav", "footer", "header", "aside"]):
+        tag.extract()
+    
+    # 特別關注表格內容（常包含化學成分）
+    tables = soup.find_all('table')
+    table_text = ""
+    
+    for table in tables:
+        rows = table.find_all('tr')
+        for row in rows:
+            cells = row.find_all(['td', 'th'])
+            row_text = ' | '.join([cell.get_text(strip=True) for cell in cells])
+            if row_text.strip():
+                table_text += row_text + "\n"
+    
+    # 提取正文文本
+    paragraphs = soup.find_all('p')
+    paragraph_text = "\n".join([p.get_text(strip=True) for p in paragraphs if p.get_text(strip=True)])
+    
+    # 組合所有文本
+    text = ""
+    if table_text:
+        text += "表格數據:\n" + table_text + "\n\n"
+    if paragraph_text:
+        text += "網頁內容:\n" + paragraph_text
+    
+    # 如果沒有表格或段落，使用一般文本
+    if not text:
+        text = soup.get_text(separator='\n')
+        lines = (line.strip() for line in text.splitlines())
+        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+        text = '\n'.join(chunk for chunk in chunks if chunk)
+    
+    return text[:15000]  # 增加提取長度上限
+
+# 可抽換的HTML抽取引擎
+HTML_EXTRACTORS = {
+    'lxml': extract_page_text_with_lxml,
+    'htmlparser': extract_page_text_with_htmlparser,
+    'bs4': extract_page_text_with_bs4
+}
+
+def extract_page_text(html):
+    """從HTML中提取表格與正文文本；auto時優先使用lxml，未安裝則用標準庫分詞器"""
+    engine = HTML_EXTRACTOR
+    if engine == 'auto':
+        engine = 'lxml' if LXML_AVAILABLE else 'htmlparser'
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # 移除不必要的元素
-            for tag in soup(["script", "style", "nav", "footer", "header", "aside"]):
-                tag.extract()
-            
-            # 特別關注表格內容（常包含化學成分）
-            tables = soup.find_all('table')
-            table_text = ""
-            
-            for table in tables:
-                rows = table.find_all('tr')
-                for row in rows:
-                    cells = row.find_all(['td', 'th'])
-                    row_text = ' | '.join([cell.get_text(strip=True) for cell in cells])
-                    if row_text.strip():
-                        table_text += row_text + "\n"
-            
-            # 提取正文文本
-            paragraphs = soup.find_all('p')
-            paragraph_text = "\n".join([p.get_text(strip=True) for p in paragraphs if p.get_text(strip=True)])
+        return HTML_EXTRACTORS[engine](html)
+    except Exception as e:
+        print(f"HTML抽取引擎 {engine} 錯誤，改用BeautifulSoup: {str(e)}")
+        return extract_page_text_with_bs4(html)
+
+def read_capped_body(response, deadline_at):
+    """串流讀取回應內容，超過位元組上限或期限時截斷，返回 (內容, 是否因期限截斷)"""
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=16384):
+        body.extend(chunk)
+        if len(body) >= SCRAPE_MAX_BYTES:
+            print(f"網頁內容超過 {SCRAPE_MAX_BYTES} 位元組，截斷: {response.url}")
+            return bytes(body[:SCRAPE_MAX_BYTES]), False
+        if deadline_at is not None and time.monotonic() >= deadline_at:
+            print(f"網頁下載超過期限，使用已取得的部分: {response.url}")
+            return bytes(body), True
+    return bytes(body), False
+
+def scrape_website(url, deadline_at=None):
+    """增強版網頁抓取，針對鋼鐵標準網站優化；使用快取與條件式請求，失敗時返回None"""
+    cached = scrape_cache.get(url)
+    if cached and time.time() - cached['fetched_at'] < SCRAPE_CACHE_FRESH:
+        return cached['text']
+    
+    # 快取過期但有驗證資訊時，以條件式請求確認內容是否變更
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    
+    remaining = None if deadline_at is None else max(0.1, deadline_at - time.monotonic())
+    try:
+        with http_sessions['scrape'].get(url, headers=headers, timeout=http_timeout(remaining), stream=True) as response:
+            if response.status_code == 304 and cached:
+                scrape_cache.set(url, dict(cached, fetched_at=time.time()))
+                return cached['text']
+            if response.status_code != 200:
+                print(f"無法抓取網頁，狀態碼: {response.status_code}: {url}")
+                return None
             
-            # 組合所有文本
-            text = ""
-            if table_text:
-                text += "表格數據:\n" + table_text + "\n\n"
-            if paragraph_text:
-                text += "網頁內容:\n" + paragraph_text
+            content_type = response.headers.get('Content-Type', '')
+            if content_type and 'html' not in content_type and 'text/plain' not in content_type:
+                print(f"略過非HTML內容 ({content_type}): {url}")
+                return None
+            declared_length = int(response.headers.get('Content-Length') or 0)
+            if declared_length > SCRAPE_MAX_BYTES * 4:
+                print(f"網頁過大 ({declared_length} 位元組)，略過: {url}")
+                return None
             
-            # 如果沒有表格或段落，使用一般文本
-            if not text:
-                text = soup.get_text(separator='\n')
-                lines = (line.strip() for line in text.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                text = '\n'.join(chunk for chunk in chunks if chunk)
+            body, timed_out = read_capped_body(response, deadline_at)
+            # 有宣告編碼時自行解碼，否則交由解析器判斷
+            html = body.decode(response.encoding, errors='replace') if 'charset' in content_type.lower() else body
+            text = extract_page_text(html)
             
-            return text[:15000]  # 增加提取長度上限
-        else:
-            return f"無法抓取網頁，狀態碼: {response.status_code}"
+            # 因期限截斷的內容不完整，不寫入快取
+            if not timed_out:
+                scrape_cache.set(url, {
+                    'text': text,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.time()
+                })
+            return text
     except Exception as e:
-        return f"抓取網頁時出錯: {str(e)}"
+        print(f"抓取網頁時出錯: {url}: {str(e)}")
+        return None
+
+@traced('web.scrape')
+def scrape_top_results(web_results, budget=SCRAPE_BUDGET):
+    """並行抓取前N個搜索結果，超過預算的網頁直接放棄"""
+    targets = web_results[:SCRAPE_TOP_N]
+    if not targets or budget <= 0:
+        return []
+    
+    # 讀取期限比等待期限稍早，因期限截斷的網頁才來得及解析並回傳
+    deadline_at = time.monotonic() + budget - min(0.25, budget / 4)
+    futures = [submit_traced(scrape_executor, scrape_website, result['link'], deadline_at) for result in targets]
+    done, not_done = wait(futures, timeout=budget)
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        print(f"網頁抓取 {len(not_done)}/{len(futures)} 個超過期限")
+    
+    detailed_content = []
+    for result, future in zip(targets, futures):
+        if future in done and not future.exception() and future.result():
+            detailed_content.append({'title': result['title'], 'link': result['link'], 'content': future.result()})
+    return detailed_content
+
+@traced('web')
+def search_and_scrape(query, api_key, search_engine_id):
+    """網絡搜索後接著抓取熱門結果的詳細內容，兩者共用同一個時間預算"""
+    total_budget = min(WEB_SEARCH_TIMEOUT + SCRAPE_BUDGET, RETRIEVAL_BUDGET)
+    started = time.monotonic()
+    # 至少保留抓取預算，避免搜索用完整個期限
+    web_results = enhanced_web_search(query, api_key, search_engine_id, deadline=max(1.0, total_budget - SCRAPE_BUDGET))
+    # 留一點餘裕，讓結果在檢索期限前回傳
+    remaining = total_budget - (time.monotonic() - started) - 0.25
+    detailed_content = scrape_top_results(web_results, min(SCRAPE_BUDGET, remaining))
+    print(f"網頁抓取完成: {len(detailed_content)} 頁，連線統計: {http_pool_stats()['scrape']}")
+    return web_results, detailed_content
 
 def evaluate_user_expertise(message, conversation_history):
     """評估使用者在不銹鋼領域的專業程度，返回詳細分級結果"""
     # 初始化分數
     expertise_score = 0
     
-    # 建立不同領域的專業術語詞庫
-    metallurgy_terms = [
-        "奧氏體", "肥粒體", "馬氏體", "沃斯田鐵", "δ-鐵素體", "肥粒體", "雙相", "析出硬化", 
-        "時效硬化", "固溶處理", "再結晶", "晶粒", "晶界", "晶間腐蝕", "碳化物", "偏析",
-        "塑性變形", "冷作硬化", "熱處理", "退火", "淬火", "回火", "固溶", "沉澱",
-        "滲碳", "氮化", "σ相", "χ相", "金相", "位錯", "孿晶", "位錯", "晶格缺陷"
-    ]
-    
-    corrosion_terms = [
-        "點蝕", "縫隙腐蝕", "晶間腐蝕", "應力腐蝕開裂", "SCC", "氫脆", "電化學", 
-        "陽極", "陰極", "鈍化", "活性", "氧化還原", "電位", "極化", "電流密度",
-        "腐蝕電位", "電化學阻抗", "循環伏安", "PREN值", "CCT", "CPT", "IGC", "鹽霧測試"
-    ]
-    
-    mechanical_terms = [
-        "拉伸強度", "降伏強度", "屈服強度", "延伸率", "斷面收縮率", "彈性模量",
-        "硬度", "洛氏硬度", "布氏硬度", "維氏硬度", "衝擊韌性", "疲勞強度", "蠕變",
-        "斷裂韌性", "應力", "應變", "塑性", "脆性", "各向異性", "彈塑性", "應力集中"
-    ]
-    
-    standards_terms = [
-        "ASTM", "EN", "ISO", "JIS", "DIN", "UNS", "AISI", "SAE", "GB", "BS", 
-        "符合性", "認證", "測試方法", "規格", "等級", "標準偏差", "公差"
-    ]
-    
-    # 高級專業術語 - 這些詞語表示深度專業知識
-    advanced_terms = [
-        "PRE值計算", "Schaeffler圖", "DeLong圖", "WRC-1992", "孫能曲線", "Hall-Petch關係",
-        "Thermo-Calc", "相圖計算", "電子背散射", "穿透式電子顯微鏡", "電化學阻抗譜", 
-        "循環伏安法", "CALPHAD", "相場模型", "位錯動力學", "Gleeble", "等溫轉變",
-        "連續冷卻轉變", "Z相", "Laves相", "組織定量分析", "晶粒尺寸分佈", "顯微硬度分析"
-    ]
-    
-    # 專業問題類型模式
-    comparison_pattern = r'(比較|差異|區別|對比|相比|優缺點|利弊|不同點)'
-    calculation_pattern = r'(計算|公式|估算|轉換|換算|推導|求解)'
-    mechanism_pattern = r'(機制|原理|機理|形成|過程|發展|演變|影響因素|條件)'
-    standard_reference_pattern = r'[A-Z]{2,5}\s*[A-Z]?[0-9]{1,5}(-[0-9]+)?'
-    composition_pattern = r'(C|Si|Mn|P|S|Cr|Ni|Mo|Ti|Nb|N|Cu|W|V|Co|Al)[<>=≤≥]?(\d+(\.\d+)?)(wt|%|質量分數)?'
-    
-    # 分析當前消息
-    message_lower = message.lower()
+    # 分析當前消息（詞彙群組定義見 QUERY_TERM_GROUPS）
+    analysis = analyze_query(message)
+    term_counts = analysis.term_counts
     
     # 檢測各領域專業術語
-    metallurgy_count = sum(1 for term in metallurgy_terms if term.lower() in message_lower)
-    corrosion_count = sum(1 for term in corrosion_terms if term.lower() in message_lower)
-    mechanical_count = sum(1 for term in mechanical_terms if term.lower() in message_lower)
-    standards_count = sum(1 for term in standards_terms if term.lower() in message_lower)
-    advanced_count = sum(1 for term in advanced_terms if term.lower() in message_lower)
+    metallurgy_count = term_counts['metallurgy']
+    corrosion_count = term_counts['corrosion']
+    mechanical_count = term_counts['mechanical']
+    standards_count = term_counts['standards']
+    advanced_count = term_counts['advanced']
     
     # 加權計算專業術語分數
     expertise_score += metallurgy_count * 1.0
@@ -1198,32 +3724,27 @@ def evaluate_user_expertise(message, conversation_history):
     expertise_score += advanced_count * 3.0  # 高級術語權重更高
     
     # 檢測問題類型的複雜度
-    if re.search(comparison_pattern, message_lower):
+    if term_counts['comparison']:
         expertise_score += 1.5  # 比較分析表示一定的專業性
     
-    if re.search(calculation_pattern, message_lower):
+    if term_counts['calculation']:
         expertise_score += 2.0  # 計算和公式表示較高專業性
     
-    if re.search(mechanism_pattern, message_lower):
+    if term_counts['mechanism']:
         expertise_score += 2.5  # 機制和原理探討表示高專業性
     
     # 檢測標準引用數量
-    standard_refs = re.findall(standard_reference_pattern, message)
-    expertise_score += len(standard_refs) * 1.5
+    expertise_score += analysis.standard_refs * 1.5
     
     # 檢測化學成分表達式
-    composition_refs = re.findall(composition_pattern, message)
-    expertise_score += len(composition_refs) * 2.0
+    expertise_score += analysis.composition_refs * 2.0
     
     # 句子結構複雜度分析
-    sentences = re.split(r'[。！？.!?]', message)
-    avg_sentence_length = sum(len(s) for s in sentences if s) / max(1, len([s for s in sentences if s]))
-    if avg_sentence_length > 30:  # 長句可能表示更複雜的表達
+    if analysis.avg_sentence_length > 30:  # 長句可能表示更複雜的表達
         expertise_score += 1.0
     
     # 問句數量分析 - 多個問題可能表示更深入的探討
-    question_count = message.count('?') + message.count('？')
-    if question_count >= 3:
+    if analysis.question_count >= 3:
         expertise_score += 1.5
     
     # 分析歷史對話中的專業度
@@ -1231,19 +3752,12 @@ def evaluate_user_expertise(message, conversation_history):
     if conversation_history:
         for turn in conversation_history[-5:]:  # 只看最近5次對話
             if turn['role'] == 'human':
-                hist_message = turn['content'].lower()
-                
-                # 檢測各類專業術語
-                hist_metallurgy = sum(1 for term in metallurgy_terms if term.lower() in hist_message)
-                hist_corrosion = sum(1 for term in corrosion_terms if term.lower() in hist_message)
-                hist_mechanical = sum(1 for term in mechanical_terms if term.lower() in hist_message)
-                hist_standards = sum(1 for term in standards_terms if term.lower() in hist_message)
-                hist_advanced = sum(1 for term in advanced_terms if term.lower() in hist_message)
+                hist_counts = analyze_query(turn['content']).term_counts
                 
                 # 計算歷史專業度
-                history_score = (hist_metallurgy + hist_corrosion + hist_mechanical) * 0.5
-                history_score += hist_standards * 0.25
-                history_score += hist_advanced * 1.5
+                history_score = (hist_counts['metallurgy'] + hist_counts['corrosion'] + hist_counts['mechanical']) * 0.5
+                history_score += hist_counts['standards'] * 0.25
+                history_score += hist_counts['advanced'] * 1.5
                 
                 # 累加到歷史專業度
                 history_expertise += history_score
@@ -1283,27 +3797,67 @@ def evaluate_user_expertise(message, conversation_history):
         "domains_covered": domains_covered
     }
 
-def internal_reasoning(message, conversation_history, knowledge_base, web_results=None, expertise_level="beginner"):
-    """在返回最終答案前，進行多次內部推理以產生更高質量的回答"""
+REVIEW_NO_CHANGES = "[NO_CHANGES]"
+
+def reasoning_complexity(message, query_analysis, expertise_level="beginner", has_web_results=False):
+    """估計問題複雜度：長度、標準與鋼種數量、比較類用語、子問題數與專業程度"""
+    score = 0
+    score += min(2, estimate_tokens(message) // 60)
+    score += min(2, len(set(query_analysis.upper_standards + query_analysis.upper_steels)) // 2)
+    score += 1 if query_analysis.term_counts['reasoning'] else 0
+    score += 1 if query_analysis.question_count > 1 else 0
+    score += 1 if expertise_level == "expert" else 0
+    score += 1 if has_web_results else 0
+    return score
+
+def select_reasoning_depth(complexity):
+    """依複雜度選擇推理深度：single單次回答、draft_review草稿加審查、full分析加草稿加審查"""
+    if complexity <= 1:
+        return 'single'
+    if complexity <= 3:
+        return 'draft_review'
+    return 'full'
+
+def internal_reasoning(message, conversation_history, knowledge_base, web_results=None, expertise_level="beginner", reasoning_stats=None):
+    """在返回最終答案前，依問題複雜度進行適當深度的內部推理，返回完整回答"""
+    return "".join(internal_reasoning_stream(
+        message, conversation_history, knowledge_base, web_results, expertise_level, reasoning_stats
+    ))
+
+def internal_reasoning_stream(message, conversation_history, knowledge_base, web_results=None, expertise_level="beginner", reasoning_stats=None):
+    """自適應深度的內部推理，只串流最後一個階段；審查沒有修改時直接使用草稿
+    
+    reasoning_stats為選用的輸出參數，記錄深度、複雜度與各階段的延遲與token數。
+    """
+    complexity = reasoning_complexity(message, analyze_query(message), expertise_level, bool(web_results))
+    depth = select_reasoning_depth(complexity)
+    stats = reasoning_stats if reasoning_stats is not None else {}
+    stats.update({'complexity': complexity, 'depth': depth, 'stages': [], 'early_stop': False})
+    print(f"內部推理深度: {depth} (複雜度 {complexity})")
+    
+    context = knowledge_base
+    if web_results:
+        context += f"""
+
+網絡搜索結果：
+{web_results}"""
     
-    # 構建初步思考提示
-    reasoning_prompt = f"""為了生成高質量回答，我需要先進行一些內部推理。
+    # 單次回答：直接串流
+    if depth == 'single':
+        yield from stream_reasoning_stage('answer', context, stats)
+        return
+    
+    analysis = ""
+    if depth == 'full':
+        # 構建初步思考提示
+        reasoning_prompt = f"""為了生成高質量回答，我需要先進行一些內部推理。
 問題：{message}
 
 用戶專業水平：{expertise_level}
 
 可用的知識：
-{knowledge_base}
-
-"""
-    if web_results:
-        reasoning_prompt += f"""
-網絡搜索結果：
-{web_results}
+{context}
 
-"""
-    
-    reasoning_prompt += """
 #第一步：問題分析
 - 用戶真正想知道的核心問題是什麼？
 - 需要哪些關鍵信息來回答這個問題？
@@ -1324,15 +3878,16 @@ def internal_reasoning(message, conversation_history, knowledge_base, web_result
 - 如何組織信息，使回答清晰有條理？
 - 需要使用表格、比較或列表嗎？
 
-現在，基於以上思考，展開我的分析："""
-
-    # 調用Bedrock進行第一輪內部推理
-    first_reasoning = invoke_internal_reasoning(reasoning_prompt)
+現在，基於以上思考，展開我的分析（只需列出要點）："""
+        analysis = run_reasoning_stage('analysis', reasoning_prompt, 1000, stats)
     
-    # 構建第二輪思考，基於第一輪的結果
-    second_prompt = f"""基於我的初步分析：
+    # 生成回答草稿
+    if analysis:
+        draft_prompt = f"""{context}
 
-{first_reasoning}
+基於我的初步分析：
+
+{analysis}
 
 我現在需要組織一個結構化的回答。考慮到用戶的專業水平是「{expertise_level}」，我應該：
 
@@ -1340,13 +3895,15 @@ def internal_reasoning(message, conversation_history, knowledge_base, web_result
 2. 如果是中級：提供更詳細的解釋，包括一些技術細節，但仍需附帶背景信息
 3. 如果是專家：直接提供技術性資訊，可使用專業術語，重點關注數據和細節
 
-現在，讓我生成最終回答的草稿："""
-
-    # 調用Bedrock進行第二輪推理，生成回答草稿
-    draft_response = invoke_internal_reasoning(second_prompt)
+現在，讓我生成回答："""
+    else:
+        draft_prompt = context
+    draft_response = run_reasoning_stage('draft', draft_prompt, 4000, stats)
     
-    # 最終審查和完善
-    final_prompt = f"""這是我的回答草稿：
+    # 最終審查：沒有需要修改時只輸出標記，直接使用草稿
+    final_prompt = f"""問題：{message}
+
+這是我的回答草稿：
 
 {draft_response}
 
@@ -1357,19 +3914,63 @@ def internal_reasoning(message, conversation_history, knowledge_base, web_result
 4. 檢查是否有任何遺漏的重要信息
 5. 確保沒有請求用戶提供更多信息
 
-最終回答："""
+如果草稿不需要任何修改，只輸出 {REVIEW_NO_CHANGES}，不要輸出其他內容。
+否則直接輸出完整的最終回答："""
+    
+    review = stream_reasoning_stage('review', final_prompt, stats)
+    buffered = ""
+    for chunk in review:
+        if buffered is None:
+            yield chunk
+            continue
+        buffered += chunk
+        stripped = buffered.lstrip()
+        if stripped.startswith(REVIEW_NO_CHANGES):
+            # 審查沒有修改，停止讀取並改為送出草稿
+            review.close()
+            stats['early_stop'] = True
+            yield draft_response
+            return
+        if len(stripped) >= len(REVIEW_NO_CHANGES) or not REVIEW_NO_CHANGES.startswith(stripped):
+            yield buffered
+            buffered = None
+    if buffered:
+        yield buffered
 
-    # 調用Bedrock進行最終完善
-    final_response = invoke_internal_reasoning(final_prompt)
-    
-    return final_response
+def run_reasoning_stage(stage, prompt, max_tokens, stats):
+    """執行一個非串流的推理階段並記錄延遲與token數"""
+    started = time.monotonic()
+    text, usage = invoke_model_with_usage(prompt, max_tokens)
+    record_reasoning_stage(stats, stage, started, usage)
+    return text
 
-def invoke_internal_reasoning(prompt):
-    """專門用於內部推理過程的Bedrock調用"""
+def stream_reasoning_stage(stage, prompt, stats):
+    """串流最後一個推理階段，結束（或提前停止）時記錄延遲與token數"""
+    started = time.monotonic()
+    usage = {}
+    try:
+        yield from invoke_bedrock_stream(prompt, usage=usage)
+    finally:
+        record_reasoning_stage(stats, stage, started, usage)
+
+def record_reasoning_stage(stats, stage, started, usage):
+    """記錄推理階段的延遲與token數；階段失敗時標記 failed，整個回答不寫入快取"""
+    stats['stages'].append({
+        'stage': stage,
+        'latency': round(time.monotonic() - started, 3),
+        'input_tokens': usage.get('input_tokens', 0),
+        'output_tokens': usage.get('output_tokens', 0)
+    })
+    if 'error' in usage:
+        stats['stages'][-1]['error'] = usage['error']
+        stats['failed'] = True
+
+def invoke_model_with_usage(prompt, max_tokens=4000):
+    """專門用於內部推理過程的Bedrock調用，返回 (文本, token使用量)"""
     try:
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 4000,
+            "max_tokens": max_tokens,
             "messages": [
                 {
                     "role": "user",
@@ -1387,8 +3988,62 @@ def invoke_internal_reasoning(prompt):
         )
 
         response_body = json.loads(response['body'].read())
-        return response_body['content'][0]['text']
+        record_bedrock_usage(response_body.get('usage'))
+        return response_body['content'][0]['text'], response_body.get('usage', {})
 
     except Exception as e:
         print(f"Error in internal reasoning: {str(e)}")
-        return f"推理過程錯誤: {str(e)}"
\ No newline at end of file
+        return f"推理過程錯誤: {str(e)}", {'error': str(e)}
+
+def invoke_internal_reasoning(prompt):
+    """專門用於內部推理過程的Bedrock調用"""
+    return invoke_model_with_usage(prompt)[0]
+
+def run_local_server(port=8080):
+    """本地開發伺服器：以chunked傳輸輸出NDJSON串流，可替代Lambda回應串流"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ChatRequestHandler(BaseHTTPRequestHandler):
+        def _send_cors_headers(self):
+            for key, value in CORS_HEADERS.items():
+                if key != 'Content-Type':
+                    self.send_header(key, value)
+
+        def do_OPTIONS(self):
+            self.send_response(204)
+            self._send_cors_headers()
+            self.end_headers()
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+
+            if not body.get('stream'):
+                result = lambda_handler({'body': body}, None)
+                payload = result['body'].encode('utf-8')
+                self.send_response(result['statusCode'])
+                self._send_cors_headers()
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            self.send_response(200)
+            self._send_cors_headers()
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event in stream_chat(body):
+                line = (json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8')
+                self.wfile.write(f"{len(line):X}\r\n".encode('ascii') + line + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            conversation_writer.invocation_finished()
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), ChatRequestHandler)
+    print(f"Local chat server listening on port {port}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    run_local_server(int(os.environ.get('PORT', '8080')))
@@ -0,0 +1,1030 @@
+"""離線重播與壓力測試：以JSONL事件語料驅動 lambda_handler，AWS服務與搜索API以行程內的假服務代替
+
+用法:
+    python replay.py corpus.jsonl --concurrency 4 --repeat 3
+    python replay.py --latency bedrock_ttft=lognormal:0.6:0.3 --time-scale 0.1
+    python replay.py corpus.jsonl --cold-start 5
+    python replay.py --html-bench pages/
+    python replay.py --textract-bench 1,10,50,200
+
+語料每行一個JSON：完整的Lambda事件（含 body 或 Records），或直接是請求內容
+（message / action / file）。請求內容可用 "file_path" 指定本地檔案，會自動以base64附上。
+"""
+import argparse
+import base64
+import hashlib
+import importlib
+import io
+import json
+import math
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+
+from botocore.exceptions import ClientError
+
+# lambda.py 在設定好環境變數後才載入（見 load_lambda）
+lam = None
+
+# 預設延遲分佈（秒）；bedrock_tps為模型每秒輸出token數
+DEFAULT_LATENCY_PROFILE = {
+    'bedrock_ttft': 'lognormal:0.6:0.3',
+    'bedrock_tps': 'fixed:80',
+    'bedrock_embed': 'lognormal:0.08:0.3',
+    'kendra': 'lognormal:0.25:0.3',
+    'kendra_index': 'lognormal:0.4:0.3',
+    'dynamodb': 'lognormal:0.008:0.4',
+    's3': 'lognormal:0.03:0.4',
+    'textract': 'lognormal:0.8:0.3',
+    'textract_job': 'fixed:5',
+    'rekognition': 'lognormal:0.4:0.3',
+    'comprehend': 'lognormal:0.15:0.3',
+    'search': 'lognormal:0.35:0.4',
+    'scrape': 'lognormal:0.25:0.5'
+}
+
+# 未提供語料時使用的範例事件
+SAMPLE_EVENTS = [
+    {'message': "304 不銹鋼的耐蝕性如何？", 'user_id': 'replay', 'session_id': 'replay-1'},
+    {'message': "SUS304 對應的 ASTM 與 EN 鋼種是什麼", 'user_id': 'replay', 'session_id': 'replay-1'},
+    {'message': "比較 ASTM A240 316L 與 EN 10088-2 1.4404 的化學成分差異，並說明點蝕與PREN值", 'user_id': 'replay', 'session_id': 'replay-2'},
+    {'message': "What is the difference between 2205 duplex and 316L in chloride environments?", 'user_id': 'replay', 'session_id': 'replay-3'},
+    {'message': "請解釋固溶處理後晶間腐蝕的形成機制", 'user_id': 'replay', 'session_id': 'replay-2'},
+    {'message': "這份檢驗報告的成分符合 ASTM A240 304 嗎？", 'user_id': 'replay', 'session_id': 'replay-4',
+     'sample_file': 'csv'},
+    {'message': "請摘要這份規範的重點", 'user_id': 'replay', 'session_id': 'replay-5', 'sample_file': 'pdf'},
+    {'message': "圖片中的鋼種是什麼", 'user_id': 'replay', 'session_id': 'replay-6', 'sample_file': 'image'}
+]
+
+ANSWER_SENTENCES = [
+    "奧氏體不銹鋼在含氯環境中的耐點蝕能力主要取決於鉻、鉬與氮的含量。",
+    "依據 ASTM A240 的化學成分要求，304 的鉻含量為 18.0% 至 20.0%，鎳含量為 8.0% 至 10.5%。",
+    "316L 添加 2.0% 至 3.0% 的鉬，PREN 值通常高於 24，適合海水與化工環境。",
+    "固溶處理後快速冷卻可避免碳化鉻在晶界析出，降低晶間腐蝕的風險。",
+    "雙相不銹鋼 2205 兼具高強度與優異的抗應力腐蝕開裂能力。"
+]
+
+KNOWLEDGE_EXCERPTS = [
+    "ASTM A240/A240M 規範涵蓋鉻及鉻鎳不銹鋼板、片材與帶材，適用於壓力容器與一般用途。",
+    "EN 10088-2 規定耐蝕鋼板材與帶材的交貨技術條件，1.4301 對應 AISI 304，1.4404 對應 316L。",
+    "JIS G4304 熱軋不銹鋼板規定 SUS304 的化學成分與機械性質，拉伸強度不低於 520 MPa。",
+    "點蝕抵抗當量 PREN = Cr + 3.3Mo + 16N，用於比較不同鋼種在含氯環境下的耐點蝕性。",
+    "晶間腐蝕試驗依 ASTM A262 進行，常用方法包括草酸蝕刻與硫酸銅試驗。"
+]
+
+class Latency:
+    """延遲分佈：fixed:秒、uniform:最小:最大、normal:平均:標準差、lognormal:中位數:sigma、off"""
+
+    def __init__(self, spec, rng):
+        parts = spec.split(':')
+        self.kind = parts[0]
+        self.params = [float(value) for value in parts[1:]]
+        self.rng = rng
+        expected = {'off': 0, 'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}
+        if self.kind not in expected or len(self.params) != expected[self.kind]:
+            raise ValueError(f"無效的延遲分佈: {spec}")
+
+    def sample(self):
+        if self.kind == 'off':
+            return 0.0
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return self.rng.uniform(*self.params)
+        if self.kind == 'normal':
+            return max(0.0, self.rng.gauss(*self.params))
+        median, sigma = self.params
+        return median * math.exp(self.rng.gauss(0, sigma))
+
+class LatencyProfile:
+    """各假服務的延遲分佈；time_scale可整體縮短或放大等待時間"""
+
+    def __init__(self, specs, time_scale=1.0, seed=None):
+        self.rng = random.Random(seed)
+        self.time_scale = time_scale
+        self.latencies = {name: Latency(spec, self.rng) for name, spec in specs.items()}
+
+    def sample(self, name):
+        return self.latencies[name].sample()
+
+    def sleep(self, name):
+        delay = self.sample(name) * self.time_scale
+        if delay > 0:
+            time.sleep(delay)
+
+class FakeService:
+    """假服務的共用部分：每次操作先依延遲分佈等待，並記錄為與真實客戶端相同名稱的追蹤區段"""
+
+    service_name = ''
+    latency = ''
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    @contextmanager
+    def operation(self, name, latency=None):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        started = time.monotonic()
+        error = None
+        try:
+            self.profile.sleep(latency or self.latency)
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            lam.record_span(f"{self.service_name}.{name}", started, error)
+
+class FakeStreamingBody:
+    """模擬botocore的StreamingBody"""
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def read(self, amount=None):
+        return self._data.read() if amount is None else self._data.read(amount)
+
+def client_error(code, operation):
+    """建立與boto3相同格式的ClientError"""
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class FakeBedrock(FakeService):
+    """Bedrock Runtime：依提示估算輸入token，輸出時間 = 首token延遲 + 輸出token數 / 每秒token數"""
+
+    service_name = 'bedrock-runtime'
+    latency = 'bedrock_ttft'
+
+    def __init__(self, profile, output_tokens=300, review_no_change=0.5):
+        super().__init__(profile)
+        self.output_tokens = output_tokens
+        self.review_no_change = review_no_change
+
+    def _answer(self, prompt, max_tokens):
+        """產生確定性的回答文本；審查階段依比例回覆無需修改"""
+        digest = int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16)
+        if lam.REVIEW_NO_CHANGES in prompt and (digest % 1000) / 1000 < self.review_no_change:
+            return lam.REVIEW_NO_CHANGES
+        target = min(self.output_tokens, max_tokens)
+        parts = []
+        index = digest
+        while lam.estimate_tokens("".join(parts)) < target:
+            parts.append(ANSWER_SENTENCES[index % len(ANSWER_SENTENCES)])
+            index //= 3
+            index += 7
+        return lam.truncate_to_tokens("".join(parts), target)
+
+    def _generation_seconds(self, output_tokens):
+        tokens_per_second = max(1.0, self.profile.sample('bedrock_tps'))
+        return output_tokens / tokens_per_second * self.profile.time_scale
+
+    def invoke_model(self, modelId, body, **kwargs):
+        request = json.loads(body)
+        if 'inputText' in request:
+            with self.operation('InvokeModel', 'bedrock_embed'):
+                vector = lam.embed_text_with_hashing(request['inputText'])
+                payload = {
+                    'embedding': [float(value) for value in vector],
+                    'inputTextTokenCount': lam.estimate_tokens(request['inputText'])
+                }
+            return {'body': FakeStreamingBody(json.dumps(payload).encode('utf-8'))}
+
+        prompt = request['messages'][0]['content'][0]['text']
+        with self.operation('InvokeModel'):
+            text = self._answer(prompt, request.get('max_tokens', 4000))
+            output_tokens = lam.estimate_tokens(text)
+            time.sleep(self._generation_seconds(output_tokens))
+        payload = {
+            'content': [{'type': 'text', 'text': text}],
+            'usage': {'input_tokens': lam.estimate_tokens(prompt), 'output_tokens': output_tokens}
+        }
+        return {'body': FakeStreamingBody(json.dumps(payload, ensure_ascii=False).encode('utf-8'))}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        request = json.loads(body)
+        prompt = request['messages'][0]['content'][0]['text']
+        with self.operation('InvokeModelWithResponseStream'):
+            text = self._answer(prompt, request.get('max_tokens', 4000))
+        return {'body': self._stream_events(prompt, text)}
+
+    def _stream_events(self, prompt, text):
+        """以約20字一段的速度逐段送出，模擬串流輸出"""
+        output_tokens = lam.estimate_tokens(text)
+        yield self._event({'type': 'message_start', 'message': {'usage': {'input_tokens': lam.estimate_tokens(prompt)}}})
+        pieces = [text[start:start + 20] for start in range(0, len(text), 20)] or [""]
+        delay = self._generation_seconds(output_tokens) / len(pieces)
+        for piece in pieces:
+            time.sleep(delay)
+            yield self._event({'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': piece}})
+        yield self._event({'type': 'message_delta', 'usage': {'output_tokens': output_tokens}})
+        yield self._event({'type': 'message_stop'})
+
+    @staticmethod
+    def _event(payload):
+        return {'chunk': {'bytes': json.dumps(payload, ensure_ascii=False).encode('utf-8')}}
+
+class FakeKendra(FakeService):
+    """Kendra：查詢返回固定的規範摘錄，批次索引全部成功"""
+
+    service_name = 'kendra'
+    latency = 'kendra'
+
+    def __init__(self, profile, results=3):
+        super().__init__(profile)
+        self.results = results
+        self.indexed_documents = 0
+
+    def query(self, IndexId, QueryText, **kwargs):
+        with self.operation('Query'):
+            start = int(hashlib.md5(QueryText.encode('utf-8')).hexdigest(), 16) % len(KNOWLEDGE_EXCERPTS)
+            items = []
+            for offset in range(self.results):
+                excerpt = KNOWLEDGE_EXCERPTS[(start + offset) % len(KNOWLEDGE_EXCERPTS)]
+                items.append({
+                    'Id': str(offset),
+                    'Type': 'DOCUMENT',
+                    'DocumentTitle': {'Text': f"規範文件 {offset + 1}"},
+                    'DocumentExcerpt': {'Text': excerpt * 3},
+                    'DocumentURI': f"s3://stainless-steel-standards-docs/standards/{offset + 1}.pdf"
+                })
+            return {'ResultItems': items}
+
+    def batch_put_document(self, IndexId, Documents, **kwargs):
+        with self.operation('BatchPutDocument', 'kendra_index'):
+            with self.lock:
+                self.indexed_documents += len(Documents)
+            return {'FailedDocuments': []}
+
+class FakeTable(FakeService):
+    """DynamoDB對話表：以 (user_id, timestamp_session) 為鍵存在記憶體，支援程式用到的查詢（begins_with與BETWEEN）與更新表達式"""
+
+    service_name = 'dynamodb'
+    latency = 'dynamodb'
+
+    def __init__(self, profile, name):
+        super().__init__(profile)
+        self.name = name
+        self.items = {}
+        self.meta = SimpleNamespace(client=SimpleNamespace(batch_write_item=self.batch_write_item))
+
+    @staticmethod
+    def _key(key):
+        return key['user_id'], key['timestamp_session']
+
+    def get_item(self, Key, **kwargs):
+        with self.operation('GetItem'):
+            with self.lock:
+                item = self.items.get(self._key(Key))
+            return {'Item': dict(item)} if item else {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, ScanIndexForward=True, Limit=None, **kwargs):
+        with self.operation('Query'):
+            user_id = ExpressionAttributeValues[':uid']
+            prefix = ExpressionAttributeValues.get(':sid', '')
+            lower = ExpressionAttributeValues.get(':lower')
+            upper = ExpressionAttributeValues.get(':upper')
+            with self.lock:
+                matches = [
+                    dict(item) for (item_user, sort_key), item in self.items.items()
+                    if item_user == user_id and sort_key.startswith(prefix)
+                    and (lower is None or lower <= sort_key <= upper)
+                ]
+            matches.sort(key=lambda item: item['timestamp_session'], reverse=not ScanIndexForward)
+            return {'Items': matches[:Limit] if Limit else matches}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        """支援 SET a = :x 與 ADD a :n；ConditionExpression不檢查"""
+        with self.operation('UpdateItem'):
+            set_part, _, add_part = UpdateExpression.partition('ADD ')
+            with self.lock:
+                item = self.items.setdefault(self._key(Key), dict(Key))
+                for name, value in re.findall(r'(\w+)\s*=\s*(:\w+)', set_part.replace('SET ', '', 1)):
+                    item[name] = ExpressionAttributeValues[value]
+                for name, value in re.findall(r'(\w+)\s+(:\w+)', add_part):
+                    item[name] = item.get(name, 0) + ExpressionAttributeValues[value]
+            return {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        with self.operation('BatchWriteItem'):
+            with self.lock:
+                for write_request in RequestItems.get(self.name, []):
+                    item = write_request['PutRequest']['Item']
+                    self.items[self._key(item)] = dict(item)
+            return {'UnprocessedItems': {}}
+
+class FakeS3(FakeService):
+    """S3：單一記憶體物件存放區"""
+
+    service_name = 's3'
+    latency = 's3'
+
+    def __init__(self, profile):
+        super().__init__(profile)
+        self.objects = {}
+        self.exceptions = SimpleNamespace(NoSuchKey=type('NoSuchKey', (ClientError,), {}))
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        """支援條件式寫入：IfMatch需與目前ETag相同，IfNoneMatch='*'要求物件不存在"""
+        with self.operation('PutObject'):
+            data = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+            with self.lock:
+                current = self.objects.get((Bucket, Key))
+                if (IfMatch is not None and (current is None or self._etag(current) != IfMatch)) or \
+                        (IfNoneMatch == '*' and current is not None):
+                    raise client_error('PreconditionFailed', 'PutObject')
+                self.objects[(Bucket, Key)] = data
+            return {'ETag': self._etag(data)}
+
+    @staticmethod
+    def _etag(data):
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.operation('GetObject'):
+            with self.lock:
+                data = self.objects.get((Bucket, Key))
+            if data is None:
+                raise self.exceptions.NoSuchKey({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+            return {'Body': FakeStreamingBody(data), 'ContentLength': len(data), 'ETag': self._etag(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.operation('DeleteObject'):
+            with self.lock:
+                self.objects.pop((Bucket, Key), None)
+            return {}
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(paginate=self._paginate_objects)
+
+    def _paginate_objects(self, Bucket, Prefix='', **kwargs):
+        with self.operation('ListObjectsV2'):
+            with self.lock:
+                keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        yield {'Contents': [{'Key': key} for key in keys]}
+
+def pdf_page_count(data):
+    """以 /Type /Page 標記粗略估算PDF頁數"""
+    return max(1, len(re.findall(rb'/Type\s*/Page\b', data)))
+
+def document_lines(data, pages):
+    """依文件內容產生確定性的文字行"""
+    seed = int(hashlib.md5(data).hexdigest(), 16)
+    lines = []
+    for page in range(1, pages + 1):
+        for row in range(12):
+            excerpt = KNOWLEDGE_EXCERPTS[(seed + page + row) % len(KNOWLEDGE_EXCERPTS)]
+            lines.append((page, f"{page}.{row + 1} {excerpt}"))
+    return lines
+
+def line_blocks(lines):
+    return [
+        {'Id': str(uuid.uuid4()), 'BlockType': 'LINE', 'Text': text, 'Page': page}
+        for page, text in lines
+    ]
+
+def table_blocks(rows, page=1, bounding_box=None):
+    """產生TABLE/CELL/WORD區塊，與Textract的表格格式相同"""
+    blocks = []
+    cell_ids = []
+    for row_index, row in enumerate(rows, 1):
+        for column_index, text in enumerate(row, 1):
+            word_id = str(uuid.uuid4())
+            cell_id = str(uuid.uuid4())
+            blocks.append({'Id': word_id, 'BlockType': 'WORD', 'Text': text, 'Page': page})
+            blocks.append({
+                'Id': cell_id, 'BlockType': 'CELL', 'RowIndex': row_index, 'ColumnIndex': column_index, 'Page': page,
+                'Relationships': [{'Type': 'CHILD', 'Ids': [word_id]}]
+            })
+            cell_ids.append(cell_id)
+    table = {
+        'Id': str(uuid.uuid4()), 'BlockType': 'TABLE', 'Page': page,
+        'Relationships': [{'Type': 'CHILD', 'Ids': cell_ids}]
+    }
+    if bounding_box:
+        table['Geometry'] = {'BoundingBox': bounding_box}
+    blocks.append(table)
+    return blocks
+
+class FakeTextract(FakeService):
+    """Textract：同步API與真實服務相同，多頁文件拋出UnsupportedDocumentException；非同步作業在 textract_job 延遲後完成，結果以1000區塊分頁"""
+
+    service_name = 'textract'
+    latency = 'textract'
+
+    def __init__(self, profile, s3):
+        super().__init__(profile)
+        self.s3 = s3
+        self.jobs = {}
+
+    def _document_bytes(self, document):
+        if 'Bytes' in document:
+            return document['Bytes']
+        location = document['S3Object']
+        with self.s3.lock:
+            return self.s3.objects.get((location['Bucket'], location['Name']), b'')
+
+    def _require_single_page(self, data, operation):
+        if pdf_page_count(data) > 1:
+            raise client_error('UnsupportedDocumentException', operation)
+
+    def detect_document_text(self, Document, **kwargs):
+        with self.operation('DetectDocumentText'):
+            data = self._document_bytes(Document)
+            self._require_single_page(data, 'DetectDocumentText')
+            return {'Blocks': line_blocks(document_lines(data, 1))}
+
+    def analyze_document(self, Document, FeatureTypes, **kwargs):
+        with self.operation('AnalyzeDocument'):
+            self._require_single_page(self._document_bytes(Document), 'AnalyzeDocument')
+            return {'Blocks': table_blocks([
+                ["元素", "最小值 (%)", "最大值 (%)"],
+                ["Cr", "18.0", "20.0"],
+                ["Ni", "8.0", "10.5"]
+            ])}
+
+    def start_document_text_detection(self, DocumentLocation, **kwargs):
+        with self.operation('StartDocumentTextDetection'):
+            location = DocumentLocation['S3Object']
+            data = self._document_bytes({'S3Object': location})
+            job_id = uuid.uuid4().hex
+            ready_at = time.monotonic() + self.profile.sample('textract_job') * self.profile.time_scale
+            with self.lock:
+                self.jobs[job_id] = {
+                    'ready_at': ready_at,
+                    'file_key': location['Name'],
+                    'blocks': line_blocks(document_lines(data, pdf_page_count(data)))
+                }
+            return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None, **kwargs):
+        with self.operation('GetDocumentTextDetection'):
+            job = self.jobs.get(JobId)
+            if job is None:
+                raise client_error('InvalidJobIdException', 'GetDocumentTextDetection')
+            if time.monotonic() < job['ready_at']:
+                return {'JobStatus': 'IN_PROGRESS'}
+            start = int(NextToken or 0)
+            response = {'JobStatus': 'SUCCEEDED', 'Blocks': job['blocks'][start:start + MaxResults]}
+            if start + MaxResults < len(job['blocks']):
+                response['NextToken'] = str(start + MaxResults)
+            return response
+
+    def pending_notifications(self):
+        """等待所有非同步作業完成，返回對應的SNS通知事件"""
+        with self.lock:
+            jobs = list(self.jobs.items())
+        if jobs:
+            remaining = max(job['ready_at'] for _, job in jobs) - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        return [{'Records': [{'Sns': {'Message': json.dumps({
+            'JobId': job_id,
+            'Status': 'SUCCEEDED',
+            'DocumentLocation': {'S3ObjectName': job['file_key'], 'S3Bucket': 'stainless-steel-standards-docs'}
+        })}}]} for job_id, job in jobs]
+
+class FakeRekognition(FakeService):
+    """Rekognition：回傳固定的文字行"""
+
+    service_name = 'rekognition'
+    latency = 'rekognition'
+
+    def detect_text(self, Image, **kwargs):
+        with self.operation('DetectText'):
+            return {'TextDetections': [
+                {'Type': 'LINE', 'DetectedText': "SUS304 2B 1.5mm"},
+                {'Type': 'LINE', 'DetectedText': "JIS G4305 HEAT NO. A1234"},
+                {'Type': 'WORD', 'DetectedText': "SUS304"}
+            ]}
+
+class FakeComprehend(FakeService):
+    """Comprehend：以規範編號與數值作為實體與關鍵片語"""
+
+    service_name = 'comprehend'
+    latency = 'comprehend'
+
+    def detect_entities(self, Text, LanguageCode, **kwargs):
+        with self.operation('DetectEntities'):
+            return {'Entities': [
+                {'Text': match, 'Type': 'QUANTITY', 'Score': 0.9}
+                for match in re.findall(r'\d+(?:\.\d+)?\s*%?', Text)[:20]
+            ]}
+
+    def detect_key_phrases(self, Text, LanguageCode, **kwargs):
+        with self.operation('DetectKeyPhrases'):
+            standards, steels = lam.extract_standard_and_grade_tokens(Text)
+            return {'KeyPhrases': [{'Text': token, 'Score': 0.9} for token in standards + steels]}
+
+def synthetic_page(seed):
+    """產生含導覽列、表格與段落的規範網頁"""
+    rows = "".join(
+        f"<tr><td>{element}</td><td>{low}</td><td>{high}</td></tr>"
+        for element, low, high in [("C", "-", "0.08"), ("Cr", "18.0", "20.0"), ("Ni", "8.0", "10.5")]
+    )
+    paragraphs = "".join(
+        f"<p>{KNOWLEDGE_EXCERPTS[(seed + index) % len(KNOWLEDGE_EXCERPTS)]} &amp; 詳見第{index + 1}節。</p>"
+        for index in range(40)
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>Stainless steel standard</title>"
+        "<script>var tracking = 1;</script><style>p{margin:0}</style></head><body>"
+        "<header>Site header</header><nav><a href='/'>Home</a></nav>"
+        f"<main><h1>Grade {seed % 1000}</h1><table>{rows}</table>{paragraphs}</main>"
+        "<footer>Copyright</footer></body></html>"
+    ).encode('utf-8')
+
+class SearchStubHandler(BaseHTTPRequestHandler):
+    """搜索API與網頁的替身：/customsearch 返回指向本伺服器 /page/ 的結果，網頁支援ETag條件式請求"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        stub = self.server.stub
+        if parts.path == '/customsearch':
+            stub.profile.sleep('search')
+            query = parse_qs(parts.query).get('q', [''])[0]
+            digest = hashlib.md5(query.encode('utf-8')).hexdigest()[:12]
+            items = [{
+                'title': f"{query} - 結果 {index + 1}",
+                'link': f"http://127.0.0.1:{self.server.server_port}/page/{digest}/{index}",
+                'snippet': KNOWLEDGE_EXCERPTS[index % len(KNOWLEDGE_EXCERPTS)]
+            } for index in range(5)]
+            self._send(200, json.dumps({'items': items}, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+        elif parts.path.startswith('/page/'):
+            stub.profile.sleep('scrape')
+            body = stub.page(parts.path)
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self._send(304, b'', None, etag)
+            else:
+                self._send(200, body, 'text/html; charset=utf-8', etag)
+        else:
+            self._send(404, b'', None)
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class SearchStub:
+    """在背景執行緒啟動搜索替身伺服器；提供 html_dir 時以其中的HTML檔作為網頁內容"""
+
+    def __init__(self, profile, html_dir=None):
+        self.profile = profile
+        self.pages = load_html_files(html_dir) if html_dir else []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SearchStubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server.server_port}/customsearch"
+
+    def page(self, path):
+        seed = int(hashlib.md5(path.encode('utf-8')).hexdigest(), 16)
+        if self.pages:
+            return self.pages[seed % len(self.pages)]
+        return synthetic_page(seed)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def load_html_files(html_dir):
+    """讀取目錄下所有 .html/.htm 檔案"""
+    pages = []
+    for name in sorted(os.listdir(html_dir)):
+        if name.lower().endswith(('.html', '.htm')):
+            with open(os.path.join(html_dir, name), 'rb') as page:
+                pages.append(page.read())
+    return pages
+
+def parse_latency_overrides(values, profile_path=None):
+    """合併預設延遲、JSON設定檔與命令列的 名稱=分佈 覆寫"""
+    specs = dict(DEFAULT_LATENCY_PROFILE)
+    if profile_path:
+        with open(profile_path, encoding='utf-8') as profile_file:
+            specs.update(json.load(profile_file))
+    for value in values or []:
+        name, _, spec = value.partition('=')
+        if name not in specs:
+            raise ValueError(f"未知的延遲名稱: {name}")
+        specs[name] = spec
+    return specs
+
+def load_lambda(search_endpoint):
+    """設定重播用的環境變數後載入 lambda.py，返回 (模組, 匯入秒數)"""
+    global lam
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['GOOGLE_SEARCH_ENDPOINT'] = search_endpoint
+    os.environ.setdefault('GOOGLE_API_KEY', 'replay')
+    os.environ.setdefault('GOOGLE_SEARCH_ENGINE_ID', 'replay')
+    os.environ.setdefault('TRACE_EMF_ENABLED', 'false')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    started = time.perf_counter()
+    lam = importlib.import_module('lambda')
+    return lam, time.perf_counter() - started
+
+def install_fakes(profile, args):
+    """以假服務取代 lambda.py 的AWS客戶端與DynamoDB表"""
+    s3 = FakeS3(profile)
+    fakes = {
+        'bedrock': FakeBedrock(profile, args.output_tokens, args.review_no_change),
+        'kendra': FakeKendra(profile, args.kendra_results),
+        's3': s3,
+        'textract': FakeTextract(profile, s3),
+        'rekognition': FakeRekognition(profile),
+        'comprehend': FakeComprehend(profile),
+        'conversation_table': FakeTable(profile, lam.CONVERSATION_TABLE)
+    }
+    for name, fake in fakes.items():
+        setattr(lam, name, fake)
+    if lam.answer_cache_table is not None:
+        lam.answer_cache_table = FakeTable(profile, lam.ANSWER_CACHE_TABLE)
+    return fakes
+
+def sample_file(kind):
+    """範例事件使用的上傳檔案：csv、pdf（三頁）、pdf1（單頁），其他為PNG圖片"""
+    if kind == 'csv':
+        content = "element,min,max,measured\nC,,0.08,0.05\nCr,18.0,20.0,18.3\nNi,8.0,10.5,8.1\n".encode('utf-8')
+        return {'name': 'mill_cert.csv', 'type': 'text/csv', 'content': content}
+    if kind in ('pdf', 'pdf1'):
+        page_count = 1 if kind == 'pdf1' else 3
+        pages = "".join(f"{index + 3} 0 obj << /Type /Page /Parent 2 0 R >> endobj\n" for index in range(page_count))
+        content = f"%PDF-1.4\n2 0 obj << /Type /Pages /Count {page_count} >> endobj\n{pages}%%EOF\n".encode('ascii')
+        return {'name': 'standard.pdf' if page_count > 1 else 'mill_cert.pdf', 'type': 'application/pdf', 'content': content}
+    content = b'\x89PNG\r\n\x1a\n' + hashlib.sha256(b'replay').digest() * 16
+    return {'name': 'coil_label.png', 'type': 'image/png', 'content': content}
+
+def to_event(record, base_dir='.'):
+    """把語料中的一行轉為Lambda事件，並要求回應附上 timings"""
+    if 'Records' in record:
+        return record
+    body = record.get('body', record)
+    if isinstance(body, str):
+        body = json.loads(body)
+    body = dict(body)
+    attachment = None
+    if body.get('file_path'):
+        with open(os.path.join(base_dir, body.pop('file_path')), 'rb') as attached:
+            attachment = {
+                'name': os.path.basename(attached.name),
+                'type': body.pop('file_type', 'application/octet-stream'),
+                'content': attached.read()
+            }
+    elif body.get('sample_file'):
+        attachment = sample_file(body.pop('sample_file'))
+    if attachment:
+        body['file'] = dict(attachment, content=base64.b64encode(attachment['content']).decode('ascii'))
+    body['timings'] = True
+    return {'body': body}
+
+def load_corpus(path):
+    """讀取JSONL語料；未指定時使用範例事件"""
+    if not path:
+        return [to_event(record) for record in SAMPLE_EVENTS]
+    events = []
+    with open(path, encoding='utf-8') as corpus:
+        for line in corpus:
+            if line.strip():
+                events.append(to_event(json.loads(line), os.path.dirname(os.path.abspath(path))))
+    if not events:
+        raise ValueError(f"語料檔沒有任何事件: {path}")
+    return events
+
+def event_kind(event):
+    if 'Records' in event:
+        return 'sns'
+    return 'action' if event['body'].get('action') else 'chat'
+
+def run_event(event):
+    """執行一個事件，返回耗時、各階段耗時與token數"""
+    started = time.perf_counter()
+    result = lam.lambda_handler(event, None)
+    total_ms = (time.perf_counter() - started) * 1000
+    record = {'kind': event_kind(event), 'status': result.get('statusCode'), 'total_ms': total_ms}
+    try:
+        body = json.loads(result.get('body') or '{}')
+    except ValueError:
+        body = {}
+    timings = body.get('timings') if isinstance(body, dict) else None
+    if timings:
+        record['stages'] = timings['stages']
+        record['tokens'] = timings['tokens']
+    return record
+
+def percentile(values, fraction):
+    """最近秩百分位數"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+def summarize(records, wall_seconds):
+    """計算吞吐量與各階段的 p50/p95/p99"""
+    stages = {}
+    for record in records:
+        stages.setdefault('total', []).append(record['total_ms'])
+        for name, duration in record.get('stages', {}).items():
+            stages.setdefault(name, []).append(duration)
+    tokens = {}
+    for record in records:
+        for name, count in record.get('tokens', {}).items():
+            tokens[name] = tokens.get(name, 0) + count
+    return {
+        'requests': len(records),
+        'errors': sum(1 for record in records if record['status'] != 200),
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(records) / wall_seconds, 3) if wall_seconds else 0.0,
+        'tokens': tokens,
+        'stages': {
+            name: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.50), 1),
+                'p95_ms': round(percentile(values, 0.95), 1),
+                'p99_ms': round(percentile(values, 0.99), 1),
+                'max_ms': round(max(values), 1)
+            }
+            for name, values in sorted(stages.items(), key=lambda item: -percentile(item[1], 0.50))
+        }
+    }
+
+def peak_rss_mb():
+    """行程的常駐記憶體高水位（MB）"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / 1024 if sys.platform != 'darwin' else usage / 1024 / 1024, 1)
+
+@contextmanager
+def quiet(enabled):
+    """隱藏 lambda.py 的日誌輸出"""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+def replay(args):
+    """重播語料並返回報告"""
+    profile = LatencyProfile(parse_latency_overrides(args.latency, args.profile), args.time_scale, args.seed)
+    stub = SearchStub(profile, args.html_dir).start()
+    try:
+        _, import_seconds = load_lambda(stub.endpoint)
+        fakes = install_fakes(profile, args)
+        events = load_corpus(args.corpus)
+        rss_before = peak_rss_mb()
+        if args.tracemalloc:
+            tracemalloc.start()
+
+        with quiet(not args.verbose):
+            for event in events[:args.warmup]:
+                run_event(event)
+
+            schedule = events * args.repeat
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                records = list(executor.map(run_event, schedule))
+            # 多頁PDF的非同步Textract作業以SNS通知事件收尾
+            if args.textract_notify:
+                records.extend(run_event(event) for event in fakes['textract'].pending_notifications())
+            wall_seconds = time.perf_counter() - started
+            lam.conversation_writer.flush()
+
+        report = summarize(records, wall_seconds)
+        report['import_seconds'] = round(import_seconds, 3)
+        report['memory'] = {'rss_before_mb': rss_before, 'rss_peak_mb': peak_rss_mb()}
+        if args.tracemalloc:
+            report['memory']['python_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+        report['fake_calls'] = {name: dict(fake.calls) for name, fake in fakes.items() if fake.calls}
+        report['http_pools'] = lam.http_pool_stats()
+        report['concurrency'] = args.concurrency
+        report['time_scale'] = args.time_scale
+        return report
+    finally:
+        stub.stop()
+
+def cold_start_child(args):
+    """在全新的行程中量測匯入時間與第一個請求，結果以JSON輸出到stdout"""
+    profile = LatencyProfile(parse_latency_overrides(args.latency, args.profile), args.time_scale, args.seed)
+    stub = SearchStub(profile, args.html_dir).start()
+    try:
+        _, import_seconds = load_lambda(stub.endpoint)
+        install_fakes(profile, args)
+        event = load_corpus(args.corpus)[0]
+        with quiet(True):
+            first = run_event(event)
+            second = run_event(event)
+        # 假服務不會建立boto3客戶端，另外量測真實客戶端的建立成本
+        client_init = {}
+        import boto3
+        for service in ['bedrock-runtime', 'kendra', 's3', 'dynamodb', 'textract', 'rekognition', 'comprehend']:
+            started = time.perf_counter()
+            boto3.client(service)
+            client_init[service] = round((time.perf_counter() - started) * 1000, 1)
+        print(json.dumps({
+            'import_ms': round(import_seconds * 1000, 1),
+            'first_request_ms': round(first['total_ms'], 1),
+            'second_request_ms': round(second['total_ms'], 1),
+            'first_request_stages': first.get('stages', {}),
+            'lazy_init_ms': {name: round(seconds * 1000, 1) for name, seconds in lam.lazy_init_timings.items()},
+            'boto3_client_init_ms': client_init
+        }, ensure_ascii=False))
+    finally:
+        stub.stop()
+
+def cold_start(args):
+    """重複啟動子行程量測冷啟動"""
+    command = [sys.executable, os.path.abspath(__file__), '--cold-start-child',
+               '--time-scale', str(args.time_scale), '--output-tokens', str(args.output_tokens)]
+    if args.corpus:
+        command.insert(2, args.corpus)
+    for value in args.latency or []:
+        command += ['--latency', value]
+    if args.profile:
+        command += ['--profile', args.profile]
+    runs = []
+    for _ in range(args.cold_start):
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    def stats(key):
+        values = [run[key] for run in runs]
+        return {'p50_ms': round(percentile(values, 0.5), 1), 'max_ms': round(max(values), 1)}
+
+    return {
+        'runs': len(runs),
+        'import': stats('import_ms'),
+        'first_request': stats('first_request_ms'),
+        'second_request': stats('second_request_ms'),
+        'last_run': runs[-1]
+    }
+
+def html_bench(args):
+    """比較各HTML抽取引擎在語料上的吞吐量（MB/s）"""
+    _, _ = load_lambda('http://127.0.0.1:9/customsearch')
+    pages = load_html_files(args.html_bench) if args.html_bench != '-' else []
+    if not pages:
+        pages = [synthetic_page(seed) for seed in range(50)]
+    total_bytes = sum(len(page) for page in pages)
+    results = {}
+    with quiet(True):
+        for engine, extract in lam.HTML_EXTRACTORS.items():
+            if engine == 'lxml' and not lam.LXML_AVAILABLE:
+                continue
+            rounds = 0
+            started = time.perf_counter()
+            while rounds == 0 or time.perf_counter() - started < args.bench_seconds:
+                for page in pages:
+                    extract(page)
+                rounds += 1
+            elapsed = time.perf_counter() - started
+            results[engine] = {
+                'mb_per_second': round(total_bytes * rounds / elapsed / 1024 / 1024, 2),
+                'rounds': rounds
+            }
+    return {'pages': len(pages), 'corpus_bytes': total_bytes, 'engines': results}
+
+def synthetic_textract_tables(pages, rows=40, columns=8, seed=1):
+    """產生多頁表格的Textract回應：每4頁中3頁為延續同一表格（重複表頭、貼近頁面上下緣），
+    第4頁為頁面中段的獨立表格；每5列第一欄以MERGED_CELL跨兩列，區塊順序打亂"""
+    rng = random.Random(seed)
+    header = [f"欄位{column + 1}" for column in range(columns)]
+    blocks = []
+    for page in range(1, pages + 1):
+        standalone = page % 4 == 0
+        box = {'Left': 0.05, 'Width': 0.9, 'Top': 0.3 if standalone else 0.05, 'Height': 0.4 if standalone else 0.9}
+        body = [[f"{page}-{row}-{column}" for column in range(columns)] for row in range(rows)]
+        page_blocks = table_blocks([header] + body, page, box)
+        table = page_blocks[-1]
+        cells = {(block['RowIndex'], block['ColumnIndex']): block['Id']
+                 for block in page_blocks if block['BlockType'] == 'CELL'}
+        merged_ids = []
+        for row in range(2, rows, 5):
+            merged_id = str(uuid.uuid4())
+            merged_ids.append(merged_id)
+            page_blocks.append({
+                'Id': merged_id, 'BlockType': 'MERGED_CELL', 'Page': page,
+                'RowIndex': row, 'ColumnIndex': 1, 'RowSpan': 2, 'ColumnSpan': 1,
+                'Relationships': [{'Type': 'CHILD', 'Ids': [cells[(row, 1)], cells[(row + 1, 1)]]}]
+            })
+        table['Relationships'].append({'Type': 'MERGED_CELL', 'Ids': merged_ids})
+        blocks.extend(page_blocks)
+    rng.shuffle(blocks)
+    return {'Blocks': blocks}
+
+def textract_bench(args):
+    """量測 extract_tables_from_textract 在逐漸增大的合成Textract回應上的耗時"""
+    _, _ = load_lambda('http://127.0.0.1:9/customsearch')
+    results = []
+    with quiet(True):
+        for pages in (int(size) for size in args.textract_bench.split(',')):
+            response = synthetic_textract_tables(pages, args.bench_rows, args.bench_columns, args.seed)
+            timings = []
+            started = time.perf_counter()
+            while not timings or time.perf_counter() - started < args.bench_seconds:
+                run_started = time.perf_counter()
+                tables = lam.extract_tables_from_textract(response)
+                timings.append(time.perf_counter() - run_started)
+            timings.sort()
+            median = timings[len(timings) // 2]
+            results.append({
+                'pages': pages,
+                'blocks': len(response['Blocks']),
+                'tables': len(tables),
+                'rows': sum(len(table) for table in tables),
+                'runs': len(timings),
+                'min_ms': round(timings[0] * 1000, 3),
+                'median_ms': round(median * 1000, 3),
+                'blocks_per_second': round(len(response['Blocks']) / median)
+            })
+    return {'rows_per_page': args.bench_rows, 'columns': args.bench_columns, 'sizes': results}
+
+def print_report(report):
+    """以表格輸出重播結果"""
+    print(f"請求數: {report['requests']}  錯誤: {report['errors']}  "
+          f"耗時: {report['wall_seconds']}s  吞吐量: {report['throughput_rps']} req/s  "
+          f"並行: {report['concurrency']}  時間倍率: {report['time_scale']}")
+    print(f"匯入 lambda.py: {report['import_seconds']}s  記憶體高水位: {report['memory']}")
+    print(f"Bedrock token: {report['tokens']}")
+    print(f"{'stage':<40}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stage in report['stages'].items():
+        print(f"{name:<40}{stage['count']:>7}{stage['p50_ms']:>10}{stage['p95_ms']:>10}{stage['p99_ms']:>10}{stage['max_ms']:>10}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以假AWS服務重播請求語料，報告吞吐量、各階段延遲與記憶體")
+    parser.add_argument('corpus', nargs='?', help="JSONL事件語料（未指定時使用內建範例）")
+    parser.add_argument('--concurrency', type=int, default=1, help="並行請求數（1 相當於單一Lambda容器）")
+    parser.add_argument('--repeat', type=int, default=1, help="語料重複次數")
+    parser.add_argument('--warmup', type=int, default=0, help="不列入統計的暖機事件數")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="所有假服務延遲的倍率")
+    parser.add_argument('--latency', action='append', help="覆寫延遲分佈，例如 kendra=lognormal:0.2:0.3")
+    parser.add_argument('--profile', help="延遲分佈設定檔（JSON，名稱對應分佈字串）")
+    parser.add_argument('--seed', type=int, default=1, help="延遲抽樣的亂數種子")
+    parser.add_argument('--output-tokens', type=int, default=300, help="模擬回答的輸出token數")
+    parser.add_argument('--review-no-change', type=float, default=0.5, help="推理審查階段回覆無需修改的比例")
+    parser.add_argument('--kendra-results', type=int, default=3, help="每次Kendra查詢返回的結果數")
+    parser.add_argument('--html-dir', help="搜索替身返回的網頁目錄（預設為產生的網頁）")
+    parser.add_argument('--no-textract-notify', dest='textract_notify', action='store_false',
+                        help="不在重播結束時送出非同步Textract作業的SNS通知")
+    parser.add_argument('--tracemalloc', action='store_true', help="以tracemalloc量測Python配置的高水位（較慢）")
+    parser.add_argument('--cold-start', type=int, metavar='RUNS', help="在子行程中量測冷啟動 RUNS 次")
+    parser.add_argument('--cold-start-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--html-bench', metavar='DIR', help="量測HTML抽取引擎的吞吐量（- 表示使用產生的網頁）")
+    parser.add_argument('--textract-bench', metavar='PAGES', help="以逗號分隔的頁數量測Textract表格擷取，例如 1,10,50,200")
+    parser.add_argument('--bench-rows', type=int, default=40, help="Textract基準測試每頁表格的資料列數")
+    parser.add_argument('--bench-columns', type=int, default=8, help="Textract基準測試表格的欄數")
+    parser.add_argument('--bench-seconds', type=float, default=1.0, help="每個HTML抽取引擎或Textract回應大小的量測時間")
+    parser.add_argument('--output', help="將報告另存為JSON")
+    parser.add_argument('--verbose', action='store_true', help="顯示 lambda.py 的日誌")
+    args = parser.parse_args(argv)
+
+    if args.cold_start_child:
+        cold_start_child(args)
+        return
+    if args.html_bench:
+        report = html_bench(args)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    elif args.textract_bench:
+        report = textract_bench(args)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    elif args.cold_start:
+        report = cold_start(args)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        report = replay(args)
+        print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""測試共用的fixture：以 replay.py 的假服務載入 lambda.py"""
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import replay  # noqa: E402
+
+@pytest.fixture(scope='session')
+def profile():
+    """關閉所有模擬延遲"""
+    return replay.LatencyProfile({name: 'off' for name in replay.DEFAULT_LATENCY_PROFILE}, 0.0, 1)
+
+@pytest.fixture(scope='session')
+def lam(profile):
+    """載入 lambda.py 模組，網絡搜索指向本機替身伺服器"""
+    stub = replay.SearchStub(profile).start()
+    module, _ = replay.load_lambda(stub.endpoint)
+    yield module
+    stub.stop()
+
+@pytest.fixture
+def fakes(lam, profile):
+    """每個測試使用全新的假服務與容器內快取"""
+    installed = replay.install_fakes(profile, argparse.Namespace(output_tokens=50, review_no_change=0.5, kendra_results=3))
+    lam.conversation_writer = lam.ConversationWriter('sync')
+    lam.analysis_cache = lam.TTLCache(lam.ANALYSIS_CACHE_SIZE, lam.ANALYSIS_CACHE_TTL)
+    return installed
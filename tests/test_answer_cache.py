@@ -0,0 +1,86 @@
+"""答案快取：重複問題直接使用先前的回答，Kendra結果變動時失效"""
+import pytest
+
+import replay
+
+class AnswerTable:
+    """以 cache_key 為鍵的共享答案快取表"""
+
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, Key):
+        item = self.items.get(Key['cache_key'])
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item):
+        self.items[Item['cache_key']] = dict(Item)
+
+@pytest.fixture
+def cache(lam, fakes, monkeypatch):
+    """全新的答案快取，關閉語意快取與網絡搜索"""
+    monkeypatch.setattr(lam, 'answer_cache', lam.TTLCache(lam.ANSWER_CACHE_SIZE, lam.ANSWER_CACHE_TTL))
+    monkeypatch.setattr(lam, 'answer_cache_table', None)
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+    monkeypatch.setattr(lam, 'SEMANTIC_CACHE_ENABLED', False)
+    monkeypatch.setattr(lam, 'WEB_SEARCH_ENABLED', False)
+    return lam.answer_cache
+
+def ask(lam, message, session_id):
+    events = list(lam.stream_chat({'user_id': 'test-user', 'session_id': session_id, 'message': message}))
+    return "".join(event['text'] for event in events if event['type'] == 'delta')
+
+def model_calls(fakes):
+    return fakes['bedrock'].calls.get('InvokeModelWithResponseStream', 0) + fakes['bedrock'].calls.get('InvokeModel', 0)
+
+def test_repeated_question_is_answered_from_cache(lam, fakes, cache, monkeypatch):
+    # 替身依查詢文字選擇摘錄；真實Kendra對兩種寫法返回相同的摘錄
+    query = fakes['kendra'].query
+    monkeypatch.setattr(fakes['kendra'], 'query', lambda IndexId, QueryText, **kwargs: query(IndexId, 'SUS304', **kwargs))
+    first = ask(lam, 'SUS304 對應的 ASTM 鋼種與成分範圍說明', 'first')
+    calls = model_calls(fakes)
+
+    repeat = ask(lam, 'SUS 304  對應的 ASTM 鋼種與成分範圍說明？', 'repeat')
+
+    assert repeat == first
+    assert model_calls(fakes) == calls
+
+def test_changed_kendra_results_invalidate_cached_answer(lam, fakes, cache, monkeypatch):
+    message = 'SUS304 對應的 ASTM 鋼種與成分範圍說明'
+    ask(lam, message, 'first')
+    calls = model_calls(fakes)
+
+    # 知識庫重新索引後摘錄內容改變，指紋不同，重新生成並更新快取
+    monkeypatch.setattr(replay, 'KNOWLEDGE_EXCERPTS', [excerpt + '（修訂版）' for excerpt in replay.KNOWLEDGE_EXCERPTS])
+    ask(lam, message, 'after-reindex')
+    assert model_calls(fakes) == calls + 1
+
+    ask(lam, message, 'again')
+    assert model_calls(fakes) == calls + 1
+
+def test_follow_up_with_history_skips_cache(lam, fakes, cache):
+    ask(lam, 'SUS304 對應的 ASTM 鋼種與成分範圍說明', 'session')
+    ask(lam, '那 SUS316L 呢？', 'session')
+    calls = model_calls(fakes)
+
+    ask(lam, '那 SUS316L 呢？', 'session')
+
+    assert model_calls(fakes) == calls + 1
+
+def test_shared_table_serves_other_containers(lam, fakes, cache, monkeypatch):
+    table = AnswerTable()
+    monkeypatch.setattr(lam, 'answer_cache_table', table)
+    message = 'SUS304 對應的 ASTM 鋼種與成分範圍說明'
+    first = ask(lam, message, 'first')
+    calls = model_calls(fakes)
+
+    monkeypatch.setattr(lam, 'answer_cache', lam.TTLCache(lam.ANSWER_CACHE_SIZE, lam.ANSWER_CACHE_TTL))
+    assert ask(lam, message, 'other-container') == first
+    assert model_calls(fakes) == calls
+
+    # DynamoDB的TTL刪除有延遲，過期項目由程式自行忽略
+    for item in table.items.values():
+        item['expires_at'] = 0
+    monkeypatch.setattr(lam, 'answer_cache', lam.TTLCache(lam.ANSWER_CACHE_SIZE, lam.ANSWER_CACHE_TTL))
+    ask(lam, message, 'expired')
+    assert model_calls(fakes) == calls + 1
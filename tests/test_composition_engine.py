@@ -0,0 +1,56 @@
+"""成分交集引擎：向量化運算與逐元素計算一致，規格解析與操作API"""
+import itertools
+import json
+
+import pytest
+
+def scalar_intersection(lam, specs):
+    """逐元素計算交集的對照實作，返回 {元素: (下限, 上限)}"""
+    bounds = {}
+    for grade_name, system in specs:
+        grade = next(grade for grade in lam.grade_index.grades if grade['name'] == grade_name)
+        for element, value in grade['compositions'][system]['elements'].items():
+            low, high = value if isinstance(value, list) else (None, value)
+            current_low, current_high = bounds.get(element, (0.0, float('inf')))
+            bounds[element] = (max(current_low, low or 0.0), min(current_high, high))
+    return bounds
+
+def test_vectorized_matches_scalar_for_all_pairs(lam):
+    engine = lam.composition_engine
+    for first, second in itertools.combinations(range(len(engine.spec_keys)), 2):
+        result = engine.intersect([first, second])
+        expected = scalar_intersection(lam, [engine.spec_keys[first][:2], engine.spec_keys[second][:2]])
+
+        assert set(result['elements']) == set(expected)
+        for element, (low, high) in expected.items():
+            info = result['elements'][element]
+            assert (info['min'] or 0.0) == pytest.approx(low)
+            assert info['max'] == pytest.approx(high)
+            assert info['empty'] == (low > high)
+        assert result['feasible'] == all(low <= high for low, high in expected.values())
+
+def test_resolve_spec_by_grade_and_standard(lam):
+    engine = lam.composition_engine
+    row = engine.resolve_spec({'grade': '304', 'standard': 'JIS G4304'})
+
+    assert engine.spec_keys[row][:2] == ('304', 'JIS')
+    assert engine.resolve_spec('SUS304') == row
+    with pytest.raises(ValueError):
+        engine.resolve_spec('999X')
+
+def test_single_grade_question_compares_all_its_standards(lam):
+    rows = lam.composition_specs_for_query(lam.analyze_query('316L 的成分範圍'))
+
+    assert {lam.composition_engine.spec_keys[row][0] for row in rows} == {'316L'}
+    assert len(rows) == len([key for key in lam.composition_engine.spec_keys if key[0] == '316L'])
+
+def test_intersection_action(lam):
+    response = lam.lambda_handler({'action': 'composition_intersection', 'specs': ['304', 'SUS304']}, None)
+    body = json.loads(response['body'])
+
+    assert response['statusCode'] == 200
+    assert body['feasible']
+    assert '| 交集 |' in body['table']
+
+    response = lam.lambda_handler({'action': 'composition_intersection', 'specs': ['999X']}, None)
+    assert response['statusCode'] == 400
@@ -0,0 +1,122 @@
+"""對話歷史視窗與滾動摘要：依token預算截取最新對話，移出視窗的對話併入摘要"""
+import time
+
+import pytest
+
+QUESTIONS = ['不鏽鋼三零四的耐蝕性如何', '三一六與三零四差在哪裡', '雙相鋼適合海水環境嗎']
+
+@pytest.fixture
+def conversation(lam, fakes, monkeypatch):
+    """寫入數輪對話並立即寫入對話表；返回各輪的 (問題, 回答)"""
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+
+    def say(questions=QUESTIONS):
+        turns = []
+        for question in questions:
+            time.sleep(0.002)  # 排序鍵以毫秒區分
+            answer = f"關於{question}的回答"
+            lam.save_conversation('test-user', 'session', question, answer)
+            turns.append((question, answer))
+        lam.conversation_writer.flush()
+        return turns
+    return say
+
+def history(lam):
+    return lam.get_conversation_history('test-user', 'session')
+
+def meta(lam, fakes):
+    return fakes['conversation_table'].items[('test-user', 'session!meta')]
+
+def test_window_keeps_newest_turns_within_budget(lam, fakes, conversation, monkeypatch):
+    turns = conversation()
+    question, answer = turns[-1]
+    monkeypatch.setattr(lam, 'HISTORY_TOKEN_BUDGET', lam.estimate_tokens(question) + lam.estimate_tokens(answer))
+
+    result = history(lam)
+
+    assert result[0]['role'] == 'summary'
+    assert result[1:] == [{'role': 'human', 'content': question}, {'role': 'assistant', 'content': answer}]
+    # 移出視窗的兩輪併入摘要，由舊到新
+    assert result[0]['content'].splitlines() == [
+        f"問: {turns[0][0]}", f"答: {turns[0][1]}", f"問: {turns[1][0]}", f"答: {turns[1][1]}"
+    ]
+
+def test_oversized_newest_item_is_truncated(lam, fakes, conversation, monkeypatch):
+    conversation(['短問題'])
+    monkeypatch.setattr(lam, 'HISTORY_TOKEN_BUDGET', 5)
+
+    result = history(lam)
+
+    assert [turn['role'] for turn in result] == ['summary', 'assistant']
+    assert result[-1]['content'].endswith("...(已截斷)")
+    assert lam.estimate_tokens(result[-1]['content'].replace("...(已截斷)", "")) <= 5
+
+def test_summary_is_stored_and_not_redone(lam, fakes, conversation, monkeypatch):
+    turns = conversation()
+    monkeypatch.setattr(lam, 'HISTORY_TOKEN_BUDGET', lam.estimate_tokens(turns[-1][0]) + lam.estimate_tokens(turns[-1][1]))
+
+    first = history(lam)
+    lam.conversation_writer.flush()
+    stored = meta(lam, fakes)
+    assert stored['summary'] == first[0]['content']
+    assert stored['summarized_until'].endswith('_2')
+
+    # 摘要進度已涵蓋移出視窗的對話：不再排入更新，直接使用已存的摘要
+    assert history(lam) == first
+    assert lam.conversation_writer.updates == []
+
+def test_new_turns_extend_existing_summary(lam, fakes, conversation, monkeypatch):
+    turns = conversation()
+    monkeypatch.setattr(lam, 'HISTORY_TOKEN_BUDGET', lam.estimate_tokens(turns[-1][0]) + lam.estimate_tokens(turns[-1][1]))
+    history(lam)
+    lam.conversation_writer.flush()
+
+    later = conversation(['麻田散鐵系會生鏽嗎'])
+    summary = history(lam)[0]['content'].splitlines()
+
+    assert summary[:4] == [f"問: {turns[0][0]}", f"答: {turns[0][1]}", f"問: {turns[1][0]}", f"答: {turns[1][1]}"]
+    assert summary[4:] == [f"問: {turns[2][0]}", f"答: {turns[2][1]}"]
+    assert later[0][0] not in "\n".join(summary)
+
+def test_summary_drops_oldest_lines_over_limit(lam, fakes, conversation, monkeypatch):
+    turns = conversation()
+    monkeypatch.setattr(lam, 'HISTORY_TOKEN_BUDGET', lam.estimate_tokens(turns[-1][0]) + lam.estimate_tokens(turns[-1][1]))
+    monkeypatch.setattr(lam, 'HISTORY_SUMMARY_TOKENS', 30)
+
+    summary = history(lam)[0]['content']
+
+    assert lam.estimate_tokens(summary) <= 30
+    assert summary.splitlines()[-1] == f"答: {turns[1][1]}"
+    assert turns[0][0] not in summary
+
+def test_turns_beyond_fetch_limit_are_summarized(lam, fakes, conversation, monkeypatch):
+    turns = conversation()
+    monkeypatch.setattr(lam, 'HISTORY_FETCH_LIMIT', 2)
+
+    result = history(lam)
+
+    # 只讀取最新一輪，更早的兩輪另外讀取後併入摘要
+    assert result[1:] == [{'role': 'human', 'content': turns[-1][0]}, {'role': 'assistant', 'content': turns[-1][1]}]
+    assert result[0]['content'].splitlines() == [
+        f"問: {turns[0][0]}", f"答: {turns[0][1]}", f"問: {turns[1][0]}", f"答: {turns[1][1]}"
+    ]
+    lam.conversation_writer.flush()
+
+    # 摘要已涵蓋讀取範圍之前的對話，不再重複併入
+    assert history(lam) == result
+    assert lam.conversation_writer.updates == []
+
+def test_short_history_has_no_summary(lam, fakes, conversation):
+    turns = conversation()
+
+    result = history(lam)
+
+    assert [turn['content'] for turn in result] == [text for turn in turns for text in turn]
+    assert 'summary' not in meta(lam, fakes)
+
+def test_error_returns_empty_history(lam, fakes, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("table unavailable")
+    monkeypatch.setattr(fakes['conversation_table'], 'get_item', fail)
+
+    assert history(lam) == []
@@ -0,0 +1,108 @@
+"""對話紀錄批次寫入：每批最多25筆，未處理項目與限流重試，序號更新在項目寫入之後"""
+import time
+
+import pytest
+
+import replay
+
+def items(count, session_id='writer'):
+    return [
+        {'user_id': 'test-user', 'timestamp_session': f'{session_id}#{index:05d}', 'message': f'第{index}則'}
+        for index in range(count)
+    ]
+
+@pytest.fixture
+def batches(lam, fakes, monkeypatch):
+    """記錄每次batch_write_item的項目數，可預先安排回應（例外或未處理的項目數）"""
+    table = fakes['conversation_table']
+    write = table.batch_write_item
+    sizes = []
+    script = []
+
+    def scripted_write(RequestItems, **kwargs):
+        requests = RequestItems[table.name]
+        sizes.append(len(requests))
+        outcome = script.pop(0) if script else 0
+        if isinstance(outcome, Exception):
+            raise outcome
+        write(RequestItems={table.name: requests[outcome:]})
+        return {'UnprocessedItems': {table.name: requests[:outcome]} if outcome else {}}
+
+    monkeypatch.setattr(table.meta.client, 'batch_write_item', scripted_write)
+    monkeypatch.setattr(lam.random, 'uniform', lambda low, high: 0)
+    return sizes, script
+
+def stored(fakes):
+    return sorted(key[1] for key in fakes['conversation_table'].items)
+
+def test_items_are_written_in_batches_of_25(lam, fakes, batches):
+    sizes, _ = batches
+    lam.conversation_writer.enqueue(items(60))
+
+    assert lam.conversation_writer.flush() == 0
+    assert sizes == [25, 25, 10]
+    assert len(stored(fakes)) == 60
+
+def test_unprocessed_items_and_throttling_are_retried(lam, fakes, batches):
+    sizes, script = batches
+    script.extend([5, replay.client_error('ProvisionedThroughputExceededException', 'BatchWriteItem')])
+    lam.conversation_writer.enqueue(items(20))
+
+    assert lam.conversation_writer.flush() == 0
+    assert sizes == [20, 5, 5]
+    assert len(stored(fakes)) == 20
+
+def test_non_retryable_error_reports_failures(lam, fakes, batches):
+    sizes, script = batches
+    script.append(replay.client_error('ValidationException', 'BatchWriteItem'))
+    lam.conversation_writer.enqueue(items(30))
+
+    assert lam.conversation_writer.flush() == 25
+    assert sizes == [25, 5]
+
+def test_updates_run_after_items_and_confirm_on_success(lam, fakes, monkeypatch):
+    order = []
+    table = fakes['conversation_table']
+    write, update = table.meta.client.batch_write_item, table.update_item
+    monkeypatch.setattr(table.meta.client, 'batch_write_item', lambda **kwargs: (order.append('items'), write(**kwargs))[1])
+    monkeypatch.setattr(table, 'update_item', lambda **kwargs: (order.append('update'), update(**kwargs))[1])
+    confirmed = []
+    lam.conversation_writer.enqueue_update(
+        {'Key': lam.session_meta_key('test-user', 'writer'), 'UpdateExpression': 'ADD seq :one',
+         'ExpressionAttributeValues': {':one': 1}},
+        on_success=lambda: confirmed.append(True)
+    )
+    lam.conversation_writer.enqueue(items(2))
+
+    lam.conversation_writer.flush()
+
+    assert order == ['items', 'update']
+    assert confirmed == [True]
+
+def test_failed_update_is_not_confirmed(lam, fakes, monkeypatch):
+    def failing_update(**kwargs):
+        raise replay.client_error('ConditionalCheckFailedException', 'UpdateItem')
+
+    monkeypatch.setattr(fakes['conversation_table'], 'update_item', failing_update)
+    confirmed = []
+    lam.conversation_writer.enqueue_update({'Key': {}}, on_success=lambda: confirmed.append(True))
+
+    lam.conversation_writer.flush()
+
+    assert confirmed == []
+
+def test_sync_mode_writes_when_invocation_finishes(lam, fakes):
+    lam.save_conversation('test-user', 'sync', '304 的成分？', '回答')
+    assert stored(fakes) == []
+
+    lam.conversation_writer.invocation_finished()
+    assert len([key for key in stored(fakes) if key.startswith('sync#')]) == 2
+
+def test_thread_mode_writes_in_background(lam, fakes, monkeypatch):
+    monkeypatch.setattr(lam, 'conversation_writer', lam.ConversationWriter('thread'))
+    lam.save_conversation('test-user', 'thread', '304 的成分？', '回答')
+
+    deadline = time.monotonic() + 2
+    while len([key for key in stored(fakes) if key.startswith('thread#')]) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len([key for key in stored(fakes) if key.startswith('thread#')]) == 2
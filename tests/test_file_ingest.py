@@ -0,0 +1,136 @@
+"""檔案處理階段的服務調用次數：每個檔案只分析一次，重複上傳使用分析快取"""
+import base64
+import json
+
+import replay
+
+ANALYSIS_SERVICES = ('textract', 'rekognition', 'comprehend')
+
+def upload(lam, kind, session_id):
+    """以範例檔案執行檔案處理階段"""
+    sample = replay.sample_file(kind)
+    file_data = {
+        'name': sample['name'],
+        'type': sample['type'],
+        'content': base64.b64encode(sample['content']).decode('ascii')
+    }
+    return lam.ingest_file(file_data, 'test-user', session_id)
+
+def call_counts(fakes):
+    """目前為止各分析服務的操作調用次數"""
+    return {name: dict(fakes[name].calls) for name in ANALYSIS_SERVICES}
+
+def test_image_is_analyzed_once(lam, fakes):
+    ingestion = upload(lam, 'png', 'image')
+
+    assert ingestion['file_analysis']['success']
+    assert call_counts(fakes) == {
+        'textract': {'AnalyzeDocument': 1},
+        'rekognition': {'DetectText': 1},
+        'comprehend': {'DetectEntities': 1, 'DetectKeyPhrases': 1}
+    }
+
+def test_multi_page_pdf_starts_async_job_without_sync_calls(lam, fakes):
+    ingestion = upload(lam, 'pdf', 'pdf')
+
+    assert ingestion['file_analysis']['success']
+    assert ingestion['file_analysis']['async_job']
+    assert call_counts(fakes) == {
+        'textract': {'StartDocumentTextDetection': 1},
+        'rekognition': {},
+        'comprehend': {}
+    }
+
+def test_pdf_with_unknown_page_count_falls_back_to_async_job(lam, fakes, monkeypatch):
+    # 頁面物件在壓縮串流中時無法計算頁數，由同步API的UnsupportedDocumentException判斷
+    monkeypatch.setattr(lam, 'pdf_page_count', lambda file_content: 0)
+
+    ingestion = upload(lam, 'pdf', 'pdf')
+
+    assert ingestion['file_analysis']['success']
+    assert ingestion['file_analysis']['async_job']
+    assert call_counts(fakes)['textract'] == {'DetectDocumentText': 1, 'StartDocumentTextDetection': 1}
+
+def test_single_page_pdf_uses_sync_api(lam, fakes):
+    ingestion = upload(lam, 'pdf1', 'pdf')
+
+    assert not ingestion['file_analysis'].get('async_job')
+    assert ingestion['extracted_text']
+    assert ingestion['file_analysis']['tables']
+    assert call_counts(fakes)['textract'] == {'DetectDocumentText': 1, 'AnalyzeDocument': 1}
+
+def test_repeat_image_upload_uses_analysis_cache(lam, fakes):
+    first = upload(lam, 'png', 'first')
+    counts = call_counts(fakes)
+
+    repeat = upload(lam, 'png', 'repeat')
+
+    assert call_counts(fakes) == counts
+    assert repeat['extracted_text'] == first['extracted_text']
+    assert repeat['file_key'] != first['file_key']
+
+def test_repeat_pdf_upload_after_job_completes_uses_analysis_cache(lam, fakes):
+    upload(lam, 'pdf', 'first')
+    for event in fakes['textract'].pending_notifications():
+        lam.lambda_handler(event, None)
+    counts = call_counts(fakes)
+
+    repeat = upload(lam, 'pdf', 'repeat')
+    assert call_counts(fakes) == counts
+    assert not repeat['file_analysis'].get('async_job')
+
+    # 容器內快取清空後（例如另一個容器）改由S3上的分析結果命中
+    lam.analysis_cache = lam.TTLCache(lam.ANALYSIS_CACHE_SIZE, lam.ANALYSIS_CACHE_TTL)
+    other_container = upload(lam, 'pdf', 'other')
+    assert call_counts(fakes) == counts
+    assert other_container['extracted_text'] == repeat['extracted_text']
+
+def analysis_objects(fakes):
+    """S3上的分析快取物件"""
+    return {key: data for (_, key), data in fakes['s3'].objects.items() if key.startswith('analysis-cache/')}
+
+def test_expired_s3_analysis_is_reanalyzed(lam, fakes):
+    upload(lam, 'png', 'first')
+    [(key, data)] = analysis_objects(fakes).items()
+    entry = json.loads(data)
+    entry['cached_at'] -= lam.ANALYSIS_CACHE_TTL + 1
+    fakes['s3'].objects[('stainless-steel-standards-docs', key)] = json.dumps(entry).encode('utf-8')
+    lam.analysis_cache = lam.TTLCache(lam.ANALYSIS_CACHE_SIZE, lam.ANALYSIS_CACHE_TTL)
+
+    upload(lam, 'png', 'expired')
+
+    assert call_counts(fakes)['rekognition'] == {'DetectText': 2}
+    assert json.loads(analysis_objects(fakes)[key])['cached_at'] > entry['cached_at']
+
+def test_failed_analysis_is_not_cached(lam, fakes, monkeypatch):
+    def failing_analyze(file_key, file_type, file_content):
+        raise RuntimeError('textract unavailable')
+
+    monkeypatch.setattr(lam, 'analyze_file', failing_analyze)
+    failed = upload(lam, 'png', 'failed')
+    monkeypatch.undo()
+
+    assert not failed['file_analysis']['success']
+    assert analysis_objects(fakes) == {}
+    assert upload(lam, 'png', 'retry')['file_analysis']['success']
+    assert call_counts(fakes)['rekognition'] == {'DetectText': 1}
+
+def test_cache_key_includes_file_type(lam):
+    content = replay.sample_file('csv')['content']
+
+    assert lam.file_content_hash(content, 'text/csv') != lam.file_content_hash(content, 'text/plain')
+    assert lam.file_content_hash(content, 'text/csv') == lam.file_content_hash(bytes(content), 'text/csv')
+
+def test_ttl_cache_evicts_least_recently_used_and_expired(lam, monkeypatch):
+    cache = lam.TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+    now = lam.time.time()
+    monkeypatch.setattr(lam.time, 'time', lambda: now + 61)
+    assert cache.get('a') is None
@@ -0,0 +1,78 @@
+"""鋼種對照索引：從消息中辨識鋼種名稱"""
+import pytest
+
+def grade_names(lam, message):
+    return [grade['name'] for _, grade in lam.grade_index.resolve(lam.analyze_query(message).grade_tokens)]
+
+@pytest.mark.parametrize('message, expected', [
+    ('SUS304 對應 AISI 哪個', ['304']),
+    ('304 和 316L 差在哪', ['304', '316L']),
+    ('UNS S31603 的 EN 牌號', ['316L']),
+    ('430 的耐蝕性', ['430'])
+])
+def test_resolves_grade_names(lam, message, expected):
+    assert grade_names(lam, message) == expected
+
+@pytest.mark.parametrize('message, expected', [
+    ('316L 板材…另外 430 MPa 的件可以用嗎', ['316L']),
+    ('在 600°C 下 310S 可以用嗎', ['310S']),
+    ('硬度 200 HV 的 410', ['410']),
+    ('厚度 304 mm 的鍛件', []),
+    ('伸長率 430% 不合理', [])
+])
+def test_numbers_followed_by_units_are_not_grades(lam, message, expected):
+    assert grade_names(lam, message) == expected
+
+@pytest.fixture
+def short_circuit(lam, fakes, monkeypatch):
+    monkeypatch.setattr(lam, 'GRADE_LOOKUP_SHORT_CIRCUIT', True)
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+    return fakes
+
+def test_pure_lookup_is_answered_locally_with_one_history_read(lam, short_circuit):
+    state = lam.prepare_request({'user_id': 'test-user', 'session_id': 'lookup', 'message': 'SUS304 對應 AISI 哪個'})
+
+    assert '本地鋼種對照資料庫直接回答' in state['direct_response']
+    assert short_circuit['conversation_table'].calls == {'GetItem': 1, 'Query': 1}
+    assert short_circuit['kendra'].calls == {}
+
+def test_lookup_with_history_reuses_history_read(lam, short_circuit):
+    lam.save_conversation('test-user', 'lookup', '我們在談 304 板材', '好的')
+    lam.conversation_writer.flush()
+    calls = dict(short_circuit['conversation_table'].calls)
+
+    state = lam.prepare_request({'user_id': 'test-user', 'session_id': 'lookup', 'message': 'SUS304 對應 AISI 哪個'})
+
+    assert state['direct_response'] is None
+    assert short_circuit['conversation_table'].calls['GetItem'] == calls.get('GetItem', 0) + 1
+    assert short_circuit['kendra'].calls == {'Query': 1}
+
+def prompt_for(lam, message):
+    return lam.prepare_request({'user_id': 'test-user', 'session_id': 'composition', 'message': message})['prompt']
+
+def test_comparison_question_gets_side_by_side_ranges(lam, fakes):
+    prompt = prompt_for(lam, '304 和 316L 差在哪')
+
+    assert '供比較參考' in prompt
+    assert '同時滿足所有列出的標準' not in prompt
+    assert '無交集' not in prompt
+
+def test_dual_certification_question_gets_intersection(lam, fakes):
+    prompt = prompt_for(lam, '要同時符合 304 與 304L 的成分範圍是多少')
+
+    assert '同時滿足所有列出的標準' in prompt
+    assert '| 交集 |' in prompt
+
+def test_composition_intersection_math(lam):
+    rows = [lam.composition_engine.resolve_spec('304'), lam.composition_engine.resolve_spec('304L')]
+    result = lam.composition_engine.intersect(rows)
+
+    assert result['elements']['C']['max'] == pytest.approx(0.03)
+    assert not result['conflicts']
+
+def test_composition_intersection_reports_conflicts(lam):
+    rows = [lam.composition_engine.resolve_spec('316L'), lam.composition_engine.resolve_spec('430')]
+    result = lam.composition_engine.intersect(rows)
+
+    assert result['conflicts'] == ['Ni']
+    assert '⚠ 無交集' in lam.format_composition_table(result)
@@ -0,0 +1,78 @@
+"""網頁抽取：lxml延遲載入，各抽取引擎的輸出與原本的BeautifulSoup版本一致，巢狀與未關閉的標籤"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+import replay
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def big5_page():
+    """宣告Big5編碼的網頁"""
+    return (
+        '<html><head><meta charset="big5"></head><body>'
+        '<table><tr><th>元素</th><th>含量</th></tr><tr><td>鉻</td><td>18.0-20.0</td></tr></table>'
+        '<p>不鏽鋼 304 &amp; 316L</p></body></html>'
+    ).encode('big5')
+
+PAGES = [replay.synthetic_page(seed) for seed in range(3)] + [
+    replay.synthetic_page(3).decode('utf-8'),
+    big5_page(),
+    b'<html><body><div>only  text\n here</div></body></html>',
+    b'<html><body><nav><p>menu</p><table><tr><td>nav cell</td></tr></table></nav><p>keep <b>bold</b> text</p>'
+    b'<script>var a="<p>no</p>";</script></body></html>',
+    b'<html><body><div>line one</div><div>line  two   parts</div><span>&lt;tag&gt; &amp; more</span></body></html>',
+    b'<html><body><p>a<br>b</p><table><tr><th> h1 </th><th>h2\n</th></tr><tr><td></td><td></td></tr></table></body></html>',
+    b'<html><body>' + b''.join(b'<p>' + b'para %d ' % index * 50 + b'</p>' for index in range(200)) + b'</body></html>'
+]
+
+@pytest.mark.parametrize('engine', ['lxml', 'htmlparser'])
+@pytest.mark.parametrize('page', range(len(PAGES)))
+def test_matches_bs4(lam, engine, page):
+    if engine == 'lxml' and not lam.LXML_AVAILABLE:
+        pytest.skip('lxml not installed')
+    html = PAGES[page]
+
+    assert lam.HTML_EXTRACTORS[engine](html) == lam.extract_page_text_with_bs4(html)
+
+def test_lxml_is_not_imported_at_module_load():
+    script = (
+        "import sys, replay\n"
+        "lam, _ = replay.load_lambda('http://127.0.0.1:9/customsearch')\n"
+        "print('lxml.etree' in sys.modules)\n"
+        "lam.extract_page_text(b'<p>x</p>')\n"
+        "print('lxml.etree' in sys.modules or not lam.LXML_AVAILABLE)\n"
+    )
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+
+    assert output.split() == ['False', 'True']
+
+# BeautifulSoup對巢狀表格會重複計入內層的列，對未關閉的標籤會把後面的內容併入前一個儲存格；單次走訪版本依文件順序輸出
+MALFORMED_PAGES = [
+    (b'<table><tr><td>A<table><tr><td>inner</td></tr></table>tail</td><td>B</td></tr><tr><td>C</td></tr></table><p>x</p>',
+     '表格數據:\nAtail | B\ninner\nC\n\n\n網頁內容:\nx'),
+    (b'<p>first<p>second<table><tr><td>c1<td>c2<tr><td>c3</table>',
+     '表格數據:\nc1 | c2\nc3\n\n\n網頁內容:\nfirst\nsecond'),
+    (b'<table><tr><td>a<td>b<table><tr><td>c', '表格數據:\na | b\nc\n\n\n'),
+    (b'<table><tr><td>a<script>x', '表格數據:\na\n\n\n')
+]
+
+@pytest.mark.parametrize('engine', ['lxml', 'htmlparser'])
+@pytest.mark.parametrize('page', range(len(MALFORMED_PAGES)))
+def test_nested_and_unclosed_tags(lam, engine, page):
+    if engine == 'lxml' and not lam.LXML_AVAILABLE:
+        pytest.skip('lxml not installed')
+    html, expected = MALFORMED_PAGES[page]
+
+    assert lam.HTML_EXTRACTORS[engine](b'<html><body>' + html) == expected
+
+def test_failing_engine_falls_back_to_bs4(lam, monkeypatch):
+    def broken(html):
+        raise ValueError('parser error')
+
+    monkeypatch.setitem(lam.HTML_EXTRACTORS, 'htmlparser', broken)
+    monkeypatch.setattr(lam, 'HTML_EXTRACTOR', 'htmlparser')
+
+    assert lam.extract_page_text(PAGES[0]) == lam.extract_page_text_with_bs4(PAGES[0])
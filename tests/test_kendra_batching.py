@@ -0,0 +1,84 @@
+"""Kendra批次索引：依文檔數與位元組上限分批，限流與內部錯誤以退避重試"""
+import pytest
+
+import replay
+
+def documents(count, size=100):
+    return [{'Id': f'doc_{index}', 'Blob': b'x' * size} for index in range(count)]
+
+@pytest.fixture
+def batch_calls(lam, fakes, monkeypatch):
+    """依序回放預先安排的結果（例外或失敗文檔代碼），記錄每次提交的文檔Id"""
+    calls = []
+    script = []
+
+    def scripted_put(IndexId, Documents, **kwargs):
+        calls.append([document['Id'] for document in Documents])
+        outcome = script.pop(0) if script else {}
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {'FailedDocuments': [
+            {'Id': document_id, 'ErrorCode': code, 'ErrorMessage': code}
+            for document_id, code in outcome.items()
+        ]}
+
+    monkeypatch.setattr(fakes['kendra'], 'batch_put_document', scripted_put)
+    monkeypatch.setattr(lam.random, 'uniform', lambda low, high: 0)
+    return calls, script
+
+def test_batches_respect_document_count_and_bytes(lam, monkeypatch):
+    assert [len(batch) for batch in lam.batch_kendra_documents(documents(23))] == [10, 10, 3]
+
+    monkeypatch.setattr(lam, 'KENDRA_MAX_BATCH_BYTES', 250)
+    batches = lam.batch_kendra_documents(documents(5))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    # 單一文檔超過上限時自成一批，不產生空批次
+    assert [len(batch) for batch in lam.batch_kendra_documents(documents(2, size=400))] == [1, 1]
+
+def test_throttled_batch_is_retried(lam, batch_calls):
+    calls, script = batch_calls
+    script.extend([replay.client_error('ThrottlingException', 'BatchPutDocument')] * 2)
+
+    assert lam.put_kendra_batch(documents(3)) == []
+    assert len(calls) == 3
+
+def test_only_internal_errors_are_retried(lam, batch_calls):
+    calls, script = batch_calls
+    script.append({'doc_0': 'InternalError', 'doc_1': 'InvalidDocumentFormat'})
+
+    failed = lam.put_kendra_batch(documents(3))
+
+    assert calls == [['doc_0', 'doc_1', 'doc_2'], ['doc_0']]
+    assert [(failure['Id'], failure['ErrorCode']) for failure in failed] == [('doc_1', 'InvalidDocumentFormat')]
+
+def test_retries_stop_after_limit(lam, batch_calls, monkeypatch):
+    monkeypatch.setattr(lam, 'KENDRA_MAX_RETRIES', 2)
+    calls, script = batch_calls
+    script.extend([replay.client_error('ThrottlingException', 'BatchPutDocument')] * 5)
+
+    failed = lam.put_kendra_batch(documents(2))
+
+    assert len(calls) == 3
+    assert [(failure['Id'], failure['ErrorCode']) for failure in failed] == [
+        ('doc_0', 'ThrottlingException'), ('doc_1', 'ThrottlingException')
+    ]
+
+def test_non_retryable_error_fails_whole_batch(lam, batch_calls):
+    calls, script = batch_calls
+    script.append(replay.client_error('ValidationException', 'BatchPutDocument'))
+
+    failed = lam.put_kendra_batch(documents(2))
+
+    assert len(calls) == 1
+    assert {failure['ErrorCode'] for failure in failed} == {'ValidationException'}
+
+def test_index_extracted_text_submits_every_chunk_once(lam, batch_calls):
+    calls, script = batch_calls
+    text = "\n".join(f"{index}. 條款 {index}：" + "不銹鋼板的化學成分應符合表1的規定。" * 200 for index in range(1, 31))
+
+    report = lam.index_extracted_text(text, 'uploads/test/standard.pdf')
+
+    submitted = [document_id for batch in calls for document_id in batch]
+    assert report['success']
+    assert report['indexed'] == len(submitted) == len(set(submitted)) > 10
+    assert all(len(batch) <= lam.KENDRA_BATCH_SIZE for batch in calls)
@@ -0,0 +1,53 @@
+"""規範文本切分：每個片段不超過Kendra文檔大小上限，表格片段重複欄名列"""
+import random
+
+import pytest
+
+def chunk_sizes(chunks):
+    return [len(chunk['text'].encode('utf-8')) for chunk in chunks]
+
+def test_long_table_header_stays_within_limit(lam):
+    header = " | ".join(f"欄位名稱{index}" for index in range(400))
+    rows = [" | ".join(str(row * col) for col in range(20)) for row in range(400)]
+    text = "\n".join(["Table 1 Chemical Requirements", header] + rows)
+
+    chunks = lam.chunk_standard_text(text, 'standards/ASTM A240.pdf', max_bytes=5000, overlap_bytes=300)
+
+    assert len(chunks) > 1
+    assert max(chunk_sizes(chunks)) <= 5000
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_text_stays_within_limit(lam, seed):
+    rng = random.Random(seed)
+    words = ["Cr", "Ni", "316L", "≤0.03", "耐蝕性", "化學成分", "5.2 Chemical Composition", "表 1", "---"]
+    lines = []
+    for _ in range(rng.randint(1, 300)):
+        width = rng.choice([0, 0, 2, 5, 40])
+        if width:
+            lines.append(" | ".join(rng.choice(words) * rng.randint(1, 60) for _ in range(width)))
+        else:
+            lines.append(" ".join(rng.choice(words) for _ in range(rng.randint(1, 200))))
+    max_bytes = rng.choice([200, 1000, 5000])
+
+    chunks = lam.chunk_standard_text("\n".join(lines), 'random.txt', max_bytes=max_bytes, overlap_bytes=max_bytes // 10)
+
+    assert max(chunk_sizes(chunks)) <= max_bytes
+    # 切分（含重複表頭與重疊）不會遺失內容
+    chunked = "".join(chunk['text'] for chunk in chunks)
+    assert sum(not char.isspace() for char in chunked) >= sum(not char.isspace() for char in "".join(lines))
+
+def test_csv_table_repeats_column_names_not_separator(lam):
+    rows = [f"Cr | {18 + index % 3}.0 | {20 + index % 3}.0" for index in range(300)]
+    text = "CSV數據:\nelement | min | max\n" + "-" * 80 + "\n" + "\n".join(rows)
+
+    chunks = lam.chunk_standard_text(text, 'uploads/mill_cert.csv', max_bytes=1000, overlap_bytes=100)
+
+    table_chunks = [chunk['text'].splitlines() for chunk in chunks if 'Cr | ' in chunk['text']]
+    assert len(table_chunks) > 1
+    for lines in table_chunks[1:]:
+        assert lines[0] == "element | min | max"
+        assert "-" * 80 not in lines
+
+def test_split_text_by_bytes_keeps_characters_whole(lam):
+    assert lam.split_text_by_bytes("不銹鋼", 4) == ["不", "銹", "鋼"]
+    assert lam.split_text_by_bytes("不銹鋼", 1) == ["不", "銹", "鋼"]
@@ -0,0 +1,53 @@
+"""提示預算：大量檢索摘錄不會擠掉最近一輪對話"""
+
+def kendra_results(count, sentence='ASTM A240 304 Cr 18.0-20.0 Ni 8.0-10.5。'):
+    return [{'title': f'A240 第{index}節', 'excerpt': sentence * 40} for index in range(count)]
+
+def history(turns):
+    items = []
+    for index in range(turns):
+        items.append({'role': 'human', 'content': f'第{index}個問題：304 的耐蝕性如何？'})
+        items.append({'role': 'assistant', 'content': f'第{index}個回答：' + '304 在一般大氣中耐蝕。' * 20})
+    return items
+
+def test_latest_turn_survives_many_passages(lam, monkeypatch):
+    monkeypatch.setattr(lam, 'PROMPT_TOKEN_CEILING', 3000)
+    report = {}
+
+    prompt = lam.construct_prompt('那 316L 呢？', history(6), kendra_results(40), prompt_report=report)
+
+    assert '第5個問題' in prompt and '第5個回答' in prompt
+    assert '第0個問題' not in prompt
+    assert report['sections']['knowledge']['dropped_items'] > 0
+    assert report['total_tokens'] <= 3000
+
+def test_latest_turn_survives_web_prompt(lam, monkeypatch):
+    monkeypatch.setattr(lam, 'PROMPT_TOKEN_CEILING', 3000)
+    web = [{'title': 'A240', 'link': 'https://example.com', 'snippet': 'Cr 18.0-20.0 ' * 100}] * 10
+
+    prompt = lam.construct_prompt_with_web_results('那 316L 呢？', history(3), kendra_results(40), web, [])
+
+    assert '第2個問題' in prompt and '第2個回答' in prompt
+
+def test_long_latest_turn_is_truncated_to_reserve(lam, monkeypatch):
+    monkeypatch.setattr(lam, 'PROMPT_TOKEN_CEILING', 3000)
+    monkeypatch.setattr(lam, 'PROMPT_HISTORY_RESERVE_TOKENS', 200)
+    turns = history(1)
+    turns[-1]['content'] = '很長的回答。' * 2000
+    report = {}
+
+    prompt = lam.construct_prompt('那 316L 呢？', turns, kendra_results(40), prompt_report=report)
+
+    assert '很長的回答' in prompt
+    assert report['sections']['conversation']['tokens'] <= 200 + 5
+    assert report['sections']['knowledge']['tokens'] > 2000
+
+def test_reserve_is_not_wasted_without_history(lam, monkeypatch):
+    monkeypatch.setattr(lam, 'PROMPT_TOKEN_CEILING', 3000)
+    with_history, without_history = {}, {}
+
+    lam.construct_prompt('304 的成分？', [], kendra_results(40), prompt_report=without_history)
+    lam.construct_prompt('304 的成分？', history(1), kendra_results(40), prompt_report=with_history)
+
+    assert without_history['sections']['knowledge']['tokens'] > with_history['sections']['knowledge']['tokens']
+    assert without_history['total_tokens'] > 2800
@@ -0,0 +1,72 @@
+"""單次查詢分析：詞彙計數、鋼種候選名稱，以及下游只使用分析結果而不重新掃描消息"""
+import pytest
+
+@pytest.fixture
+def scans(lam, monkeypatch):
+    """記錄 extract_standard_and_grade_tokens 的呼叫次數"""
+    calls = []
+    original = lam.extract_standard_and_grade_tokens
+
+    def counting_extract(message):
+        calls.append(message)
+        return original(message)
+
+    monkeypatch.setattr(lam, 'extract_standard_and_grade_tokens', counting_extract)
+    lam.analyze_query.cache_clear()
+    yield calls
+    lam.analyze_query.cache_clear()
+
+def test_term_counts_and_expertise(lam):
+    analysis = lam.analyze_query('ASTM A240 和 EN 10088 的 316L 比較，固溶處理後的晶間腐蝕？')
+
+    assert analysis.term_counts['comparison'] == 1
+    assert analysis.term_counts['reasoning'] == 1
+    assert analysis.term_counts['technical'] == 2
+    assert analysis.expertise_level == 'expert'
+    assert analysis.force_web_search
+    assert analysis.question_count == 1
+
+def test_case_sensitive_groups_ignore_lowercase(lam):
+    analysis = lam.analyze_query('the engine is ok')
+
+    assert not analysis.force_web_search
+    assert not analysis.web_search_keywords
+
+def test_grade_tokens_are_upper_case(lam):
+    analysis = lam.analyze_query('sus316l 和 x2crnimo17-12-2 對應的 astm 鋼種')
+
+    assert 'SUS316L' in analysis.upper_steels
+    assert 'SUS316L' in analysis.grade_tokens
+    assert 'X2CRNIMO17-12-2' in analysis.grade_tokens
+    assert analysis.steels == ()
+    assert analysis.term_counts['equivalence'] == 1
+
+def test_normalize_query_ignores_case_and_spacing(lam):
+    first = 'ASTM A240 316L 的成分？'
+    second = 'ASTM  A240 316l 的成分'
+
+    assert lam.answer_cache_key(first, lam.analyze_query(first)) == lam.answer_cache_key(second, lam.analyze_query(second))
+
+def test_reasoning_complexity_uses_analysis(lam):
+    message = 'S32205 與 S32750 比較？哪個 PREN 較高？'
+
+    assert lam.reasoning_complexity(message, lam.analyze_query(message)) == 3
+
+def test_prepare_request_scans_message_once(lam, fakes, scans):
+    message = 'sus304 和 316l 的差異是什麼？'
+
+    lam.prepare_request({'user_id': 'test-user', 'session_id': 'scan', 'message': message})
+
+    # analyze_query 各掃描一次原始與大寫形式，鋼種對照、快取鍵與推理深度都沿用分析結果
+    assert scans == [message, message.upper()]
+
+def test_reasoning_scans_nothing_after_analysis(lam, fakes, scans):
+    message = 'SUS304 和 316L 的差異是什麼？'
+    lam.analyze_query(message)
+    scans.clear()
+
+    stats = {}
+    lam.internal_reasoning(message, [], '', reasoning_stats=stats)
+
+    assert scans == []
+    assert stats['complexity'] >= 1
@@ -0,0 +1,101 @@
+"""自適應內部推理：審查階段回覆無需修改時提前停止並關閉Bedrock串流；任一階段失敗的回答不寫入快取"""
+import json
+
+class ClosableStream:
+    """記錄是否被關閉的串流回應主體"""
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def close(self):
+        self.closed = True
+        self.events.close()
+
+def test_review_without_changes_closes_stream(lam, fakes, monkeypatch):
+    bedrock = fakes['bedrock']
+    bedrock.review_no_change = 1.0
+    streams = []
+    invoke_stream = bedrock.invoke_model_with_response_stream
+
+    def tracking_invoke(**kwargs):
+        response = invoke_stream(**kwargs)
+        response['body'] = ClosableStream(response['body'])
+        streams.append(response['body'])
+        return response
+
+    monkeypatch.setattr(bedrock, 'invoke_model_with_response_stream', tracking_invoke)
+    stats = {'stages': []}
+    message = '比較304與316L的成分差異並計算交集'
+
+    answer = "".join(lam.internal_reasoning_stream(message, [], '規範摘錄', expertise_level='expert', reasoning_stats=stats))
+
+    assert stats['early_stop']
+    assert lam.REVIEW_NO_CHANGES not in answer
+    assert [stream.closed for stream in streams] == [True]
+
+def ask(lam, message, session_id):
+    return lam.stream_chat({'user_id': 'test-user', 'session_id': session_id, 'message': message})
+
+def fresh_caches(lam, monkeypatch):
+    monkeypatch.setattr(lam, 'answer_cache', lam.TTLCache(lam.ANSWER_CACHE_SIZE, lam.ANSWER_CACHE_TTL))
+    monkeypatch.setattr(lam, 'SEMANTIC_CACHE_ENABLED', False)
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+
+def cache_key(lam, message):
+    return lam.answer_cache_key(message, lam.analyze_query(message))
+
+def test_failed_reasoning_stage_is_not_cached(lam, fakes, monkeypatch):
+    fresh_caches(lam, monkeypatch)
+    monkeypatch.setattr(lam, 'INTERNAL_REASONING', 'adaptive')
+    bedrock = fakes['bedrock']
+    invoke_model = bedrock.invoke_model
+
+    def failing_invoke(modelId, body, **kwargs):
+        if 'inputText' not in json.loads(body):
+            raise lam.ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'InvokeModel')
+        return invoke_model(modelId=modelId, body=body, **kwargs)
+
+    monkeypatch.setattr(bedrock, 'invoke_model', failing_invoke)
+    message = '比較 S32205 與 S32750 的 PREN 並計算差異？哪個較適合海水？'
+
+    events = list(ask(lam, message, 'reasoning-failure'))
+
+    # 審查階段仍正常輸出，回答看起來完整，但草稿階段失敗
+    answer = "".join(event['text'] for event in events if event['type'] == 'delta')
+    assert answer and not answer.startswith('Error:')
+    assert lam.answer_cache.get(cache_key(lam, message)) is None
+
+def test_stream_failure_midway_is_not_cached(lam, fakes, monkeypatch):
+    fresh_caches(lam, monkeypatch)
+    bedrock = fakes['bedrock']
+    invoke_stream = bedrock.invoke_model_with_response_stream
+
+    def broken_stream(**kwargs):
+        events = invoke_stream(**kwargs)['body']
+
+        def body():
+            yield next(events)
+            yield next(events)
+            raise ConnectionError('stream reset')
+
+        return {'body': body()}
+
+    monkeypatch.setattr(bedrock, 'invoke_model_with_response_stream', broken_stream)
+    message = '304 不銹鋼適合什麼用途'
+
+    answer = "".join(event['text'] for event in ask(lam, message, 'stream-failure') if event['type'] == 'delta')
+
+    assert 'Error: stream reset' in answer and not answer.startswith('Error:')
+    assert lam.answer_cache.get(cache_key(lam, message)) is None
+
+def test_successful_answer_is_cached(lam, fakes, monkeypatch):
+    fresh_caches(lam, monkeypatch)
+    message = '304 不銹鋼適合什麼用途'
+
+    answer = "".join(event['text'] for event in ask(lam, message, 'stream-success') if event['type'] == 'delta')
+
+    assert lam.answer_cache.get(cache_key(lam, message))['response'] == answer
@@ -0,0 +1,127 @@
+"""網頁抓取：頁面快取與條件式請求、位元組上限、非HTML內容與期限截斷"""
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import replay
+
+PAGE = replay.synthetic_page(1)
+
+class PageHandler(BaseHTTPRequestHandler):
+    """測試用網頁伺服器，記錄每個路徑的請求與304回應"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        etag = '"' + hashlib.md5(PAGE).hexdigest() + '"'
+        if self.path == '/page' and self.headers.get('If-None-Match') == etag:
+            self._head(304, None, 0, etag)
+        elif self.path == '/page':
+            self._head(200, 'text/html; charset=utf-8', len(PAGE), etag)
+            self.wfile.write(PAGE)
+        elif self.path == '/big':
+            body = b'<html><body>' + b'<p>304 Cr 18.0-20.0</p>' * 20000 + b'</body></html>'
+            self._head(200, 'text/html', len(body))
+            self.wfile.write(body)
+        elif self.path == '/declared-huge':
+            self._head(200, 'text/html', 10 ** 9)
+        elif self.path == '/pdf':
+            self._head(200, 'application/pdf', 4)
+            self.wfile.write(b'%PDF')
+        elif self.path == '/slow':
+            chunk = b'<p>' + 'Cr 18.0-20.0 '.encode('utf-8') * 1000 + b'</p>'
+            self._head(200, 'text/html', len(chunk) * 20)
+            try:
+                for _ in range(20):
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            except ConnectionError:
+                # 抓取端在期限到時關閉連線
+                pass
+        else:
+            self._head(404, None, 0)
+
+    def _head(self, status, content_type, length, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+@pytest.fixture(scope='module')
+def httpd():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def server(lam, httpd, monkeypatch):
+    """每個測試使用空的網頁快取與請求紀錄"""
+    monkeypatch.setattr(lam, 'scrape_cache', lam.TTLCache(lam.SCRAPE_CACHE_SIZE, lam.SCRAPE_CACHE_TTL))
+    httpd.requests = []
+    return httpd
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_port}{path}"
+
+def test_fresh_cache_skips_request_and_stale_cache_revalidates(lam, server, monkeypatch):
+    text = lam.scrape_website(url(server, '/page'))
+    assert '表格數據' in text
+    assert lam.scrape_website(url(server, '/page')) == text
+    assert len(server.requests) == 1
+
+    monkeypatch.setattr(lam, 'SCRAPE_CACHE_FRESH', 0)
+    assert lam.scrape_website(url(server, '/page')) == text
+    assert len(server.requests) == 2
+    assert server.requests[1][1] is not None
+
+def test_body_is_capped(lam, server, monkeypatch):
+    monkeypatch.setattr(lam, 'SCRAPE_MAX_BYTES', 200000)
+    sizes = []
+    read_capped_body = lam.read_capped_body
+
+    def recording_read(response, deadline_at):
+        body, timed_out = read_capped_body(response, deadline_at)
+        sizes.append(len(body))
+        return body, timed_out
+
+    monkeypatch.setattr(lam, 'read_capped_body', recording_read)
+
+    assert '304 Cr 18.0-20.0' in lam.scrape_website(url(server, '/big'))
+    assert sizes == [200000]
+
+def test_oversized_and_non_html_pages_are_skipped(lam, server):
+    assert lam.scrape_website(url(server, '/declared-huge')) is None
+    assert lam.scrape_website(url(server, '/pdf')) is None
+    assert lam.scrape_website(url(server, '/missing')) is None
+
+def test_deadline_truncates_and_is_not_cached(lam, server):
+    started = time.monotonic()
+    text = lam.scrape_website(url(server, '/slow'), deadline_at=started + 0.3)
+
+    assert text and time.monotonic() - started < 0.8
+    assert lam.scrape_cache.get(url(server, '/slow')) is None
+
+def test_top_results_are_scraped_within_budget(lam, server, monkeypatch):
+    monkeypatch.setattr(lam, 'SCRAPE_TOP_N', 3)
+    results = [{'title': path, 'link': url(server, path)} for path in ('/page', '/slow', '/pdf', '/big')]
+    started = time.monotonic()
+
+    content = lam.scrape_top_results(results, budget=0.3)
+
+    assert time.monotonic() - started < 0.6
+    assert [item['title'] for item in content] == ['/page', '/slow']
+    assert not any(path == '/big' for path, _ in server.requests)
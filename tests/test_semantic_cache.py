@@ -0,0 +1,105 @@
+"""語意快取：相似問題命中，多個容器的新項目以條件式寫入合併到S3上的同一個索引"""
+import numpy
+import pytest
+
+import replay
+
+def unit_vector(seed):
+    vector = numpy.random.default_rng(seed).standard_normal(256).astype(numpy.float32)
+    return vector / numpy.linalg.norm(vector)
+
+@pytest.fixture
+def new_cache(lam, fakes):
+    """建立模擬不同容器的語意快取"""
+    return lambda: lam.SemanticCache('semantic-cache/test', 0.92, 100, 3600)
+
+def stored_responses(lam):
+    vectors, entries, _ = lam.SemanticCache('semantic-cache/test', 0.92, 100, 3600)._read_index()
+    assert len(vectors) == len(entries)
+    return sorted(entry['response'] for entry in entries)
+
+def test_search_matches_similar_vector_and_expertise(new_cache):
+    cache = new_cache()
+    vector = unit_vector(1)
+    cache.add(vector, 'expert', '304 對應 SUS304')
+
+    nearby = vector + 0.05 * unit_vector(2)
+    assert cache.search(nearby / numpy.linalg.norm(nearby), 'expert') == '304 對應 SUS304'
+    assert cache.search(vector, 'beginner') is None
+    assert cache.search(unit_vector(3), 'expert') is None
+
+def test_flush_merges_entries_from_two_containers(lam, fakes, new_cache):
+    first, second = new_cache(), new_cache()
+    first.search(unit_vector(0), 'expert')
+    second.search(unit_vector(0), 'expert')
+    first.add(unit_vector(1), 'expert', 'first')
+    second.add(unit_vector(2), 'expert', 'second')
+
+    first.flush(force=True)
+    second.flush(force=True)
+
+    assert stored_responses(lam) == ['first', 'second']
+    # 合併後容器內的索引也包含其他容器的項目
+    assert second.search(unit_vector(1), 'expert') == 'first'
+
+def test_flush_retries_after_concurrent_write(lam, fakes, new_cache, monkeypatch):
+    first, second = new_cache(), new_cache()
+    first.add(unit_vector(1), 'expert', 'first')
+    second.add(unit_vector(2), 'expert', 'second')
+    put_object = fakes['s3'].put_object
+    raced = []
+
+    def racing_put(**kwargs):
+        # 第一次寫入前另一個容器搶先寫入，ETag條件不成立
+        if not raced:
+            raced.append(True)
+            second.flush(force=True)
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(fakes['s3'], 'put_object', racing_put)
+    first.flush(force=True)
+
+    # 另一個容器的寫入、本容器失敗的條件式寫入與重新合併後的寫入
+    assert fakes['s3'].calls['PutObject'] == 3
+    assert stored_responses(lam) == ['first', 'second']
+    assert first.pending == []
+
+def test_failed_flush_keeps_pending_entries(lam, fakes, new_cache, monkeypatch):
+    cache = new_cache()
+    cache.add(unit_vector(1), 'expert', 'first')
+    monkeypatch.setattr(lam, 'SEMANTIC_CACHE_MERGE_RETRIES', 2)
+
+    def conflicting_put(**kwargs):
+        raise replay.client_error('PreconditionFailed', 'PutObject')
+
+    monkeypatch.setattr(fakes['s3'], 'put_object', conflicting_put)
+    cache.flush(force=True)
+    assert [entry['response'] for _, entry in cache.pending] == ['first']
+
+    monkeypatch.undo()
+    cache.flush(force=True)
+    assert stored_responses(lam) == ['first']
+
+def test_flush_waits_for_interval_unless_forced(lam, fakes, new_cache, monkeypatch):
+    monkeypatch.setattr(lam, 'SEMANTIC_CACHE_FLUSH_INTERVAL', 60)
+    cache = new_cache()
+    cache.add(unit_vector(1), 'expert', 'first')
+    cache.flush(force=True)
+    cache.add(unit_vector(2), 'expert', 'second')
+
+    cache.flush()
+    assert stored_responses(lam) == ['first']
+
+    cache.flush(force=True)
+    assert stored_responses(lam) == ['first', 'second']
+
+def test_trim_drops_expired_and_oldest_entries(lam, fakes, new_cache):
+    cache = lam.SemanticCache('semantic-cache/test', 0.92, 2, 3600)
+    now = lam.time.time()
+    entries = [{'id': str(index), 'created_at': now - age} for index, age in enumerate([7200, 30, 20, 10])]
+    vectors = numpy.stack([unit_vector(index) for index in range(4)]).astype(numpy.float16)
+
+    kept_vectors, kept = cache._trim(vectors, entries)
+
+    assert [entry['id'] for entry in kept] == ['2', '3']
+    assert numpy.array_equal(kept_vectors, vectors[[2, 3]])
@@ -0,0 +1,60 @@
+"""容器內對話快取：本容器尚未寫入的對話直接使用，其他容器寫入後重新查詢"""
+import time
+
+import pytest
+
+@pytest.fixture
+def conversation(lam, fakes, monkeypatch):
+    """本容器的對話快取與寫入器；other_container_says 以另一個容器的快取與寫入器寫入一輪對話"""
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+
+    def say(message):
+        time.sleep(0.002)  # 排序鍵以毫秒區分
+        lam.save_conversation('test-user', 'session', message, f"回答: {message}")
+
+    def other_container_says(message):
+        own_cache, own_writer = lam.session_cache, lam.conversation_writer
+        lam.session_cache = lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES)
+        lam.conversation_writer = lam.ConversationWriter('sync')
+        try:
+            say(message)
+            lam.conversation_writer.flush()
+        finally:
+            lam.session_cache, lam.conversation_writer = own_cache, own_writer
+
+    def history():
+        return [turn['content'] for turn in lam.get_conversation_history('test-user', 'session') if turn['role'] == 'human']
+
+    say.other_container = other_container_says
+    say.history = history
+    return say
+
+def query_count(fakes):
+    return fakes['conversation_table'].calls.get('Query', 0)
+
+def test_own_pending_and_confirmed_writes_use_cache(lam, fakes, conversation):
+    conversation('第一個問題')
+    lam.conversation_writer.flush()
+    assert conversation.history() == ['第一個問題']
+    queries = query_count(fakes)
+
+    conversation('第二個問題')
+    assert conversation.history() == ['第一個問題', '第二個問題']
+    lam.conversation_writer.flush()
+    assert conversation.history() == ['第一個問題', '第二個問題']
+    assert query_count(fakes) == queries
+
+def test_other_container_write_invalidates_cache_with_own_writes_queued(lam, fakes, conversation):
+    conversation('第一個問題')
+    lam.conversation_writer.flush()
+    assert conversation.history() == ['第一個問題']
+
+    # 本容器有兩筆尚未寫入，另一容器寫入一筆：總序號差與本容器的待寫入數相同，但快取已過時
+    conversation('本容器問題一')
+    conversation('本容器問題二')
+    conversation.other_container('另一容器的問題')
+    assert '另一容器的問題' in conversation.history()
+
+    lam.conversation_writer.flush()
+
+    assert conversation.history() == ['第一個問題', '本容器問題一', '本容器問題二', '另一容器的問題']
@@ -0,0 +1,32 @@
+"""非同步Textract作業的輪詢：不等待進行中的作業，單一損毀紀錄不影響其他作業"""
+import base64
+import time
+
+import replay
+
+def submit_pdf(lam, session_id):
+    """上傳多頁PDF，返回提交的作業識別碼"""
+    sample = replay.sample_file('pdf')
+    file_data = {'name': sample['name'], 'type': sample['type'], 'content': base64.b64encode(sample['content']).decode('ascii')}
+    return lam.ingest_file(file_data, 'test-user', session_id)['file_analysis']['async_job']['job_id']
+
+def test_poll_checks_every_job_without_waiting(lam, fakes):
+    slow_job = submit_pdf(lam, 'slow')
+    fakes['textract'].jobs[slow_job]['ready_at'] = time.monotonic() + 3600
+    fakes['s3'].put_object(Bucket='stainless-steel-standards-docs', Key='textract-jobs/corrupt.json', Body=b'{not json')
+    done_job = submit_pdf(lam, 'done')
+
+    started = time.monotonic()
+    statuses = {job['job_id']: job['status'] for job in lam.poll_pending_textract_jobs()['jobs']}
+
+    assert time.monotonic() - started < 1
+    assert statuses == {slow_job: 'IN_PROGRESS', 'corrupt': 'ERROR', done_job: 'SUCCEEDED'}
+    remaining = {key for _, key in fakes['s3'].objects if key.startswith('textract-jobs/')}
+    assert remaining == {f"textract-jobs/{slow_job}.json", 'textract-jobs/corrupt.json'}
+
+def test_poll_defers_jobs_after_time_budget(lam, fakes, monkeypatch):
+    job_id = submit_pdf(lam, 'late')
+    monkeypatch.setattr(lam, 'TEXTRACT_POLL_MAX_WAIT', 0)
+
+    assert lam.poll_pending_textract_jobs()['jobs'] == [{'job_id': job_id, 'status': 'DEFERRED'}]
+    assert fakes['textract'].calls.get('GetDocumentTextDetection', 0) == 0
@@ -0,0 +1,58 @@
+"""Textract表格擷取：合併儲存格、跨頁延續與重複表頭"""
+import json
+import os
+
+import pytest
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'textract_tables.json')
+
+@pytest.fixture
+def textract_response():
+    """三頁的表格區塊：第1、2頁為同一表格（第2頁重複表頭），第3頁為欄數相同的另一表格"""
+    with open(FIXTURE, encoding='utf-8') as f:
+        return json.load(f)
+
+def test_continued_table_is_merged_without_repeated_header(lam, textract_response):
+    tables = lam.extract_tables_from_textract(textract_response)
+
+    assert tables[0] == [
+        ['Grade', 'C max', 'Cr'],
+        ['304', '0.08', '18.0-20.0'],
+        ['304', '0.07', '17.5-19.5'],
+        ['316L', '0.03', '16.0-18.0'],
+        ['Per ASTM A240', 'Per ASTM A240', 'Per ASTM A240']
+    ]
+
+def test_same_width_tables_on_consecutive_pages_stay_separate(lam, textract_response):
+    tables = lam.extract_tables_from_textract(textract_response)
+
+    assert len(tables) == 2
+    assert tables[1] == [
+        ['Property', 'Min', 'Max'],
+        ['Tensile MPa', '515', '']
+    ]
+
+def test_titled_table_is_not_merged(lam, textract_response):
+    # 第2頁的表格有標題時是新的表格，即使位置與欄數都像延續
+    second_page_table = next(
+        block for block in textract_response['Blocks']
+        if block['BlockType'] == 'TABLE' and block['Page'] == 2
+    )
+    second_page_table['Relationships'].append({'Type': 'TABLE_TITLE', 'Ids': ['table-title']})
+
+    tables = lam.extract_tables_from_textract(textract_response)
+
+    assert [len(table) for table in tables] == [3, 3, 2]
+    assert tables[1][0] == ['Grade', 'C max', 'Cr']
+
+def test_response_without_blocks(lam):
+    assert lam.extract_tables_from_textract({}) == []
+
+def test_synthetic_benchmark_response(lam):
+    # replay.py --textract-bench 使用的合成回應：每4頁中3頁為同一表格的延續，第4頁為獨立表格
+    import replay
+
+    tables = lam.extract_tables_from_textract(replay.synthetic_textract_tables(8, rows=10, columns=3))
+
+    assert [len(table) for table in tables] == [31, 11, 31, 11]
+    assert tables[0][1][0] == tables[0][2][0] == '1-0-0 1-1-0'
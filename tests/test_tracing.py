@@ -0,0 +1,140 @@
+"""請求追蹤：計時區段、回應中的 timings 欄位與CloudWatch EMF輸出"""
+import json
+import time
+
+import pytest
+
+@pytest.fixture
+def trace(lam):
+    """設定為目前請求的追蹤"""
+    trace = lam.RequestTrace('test-request')
+    token = lam.current_trace.set(trace)
+    yield trace
+    lam.current_trace.reset(token)
+
+def span_names(trace):
+    return [span['name'] for span in trace.spans]
+
+def test_nested_spans_record_paths_and_errors(lam, trace):
+    @lam.traced('outer')
+    def outer():
+        with lam.trace_span('inner'):
+            lam.record_span('marker', time.monotonic())
+        with pytest.raises(ValueError):
+            with lam.trace_span('failing'):
+                raise ValueError("boom")
+
+    outer()
+
+    assert span_names(trace) == ['outer/inner/marker', 'outer/inner', 'outer/failing', 'outer']
+    errors = {span['name']: span.get('error') for span in trace.spans}
+    assert errors['outer/failing'] == 'ValueError'
+    assert errors['outer'] is None
+    assert lam.current_span.get() == ''
+
+def test_spans_without_trace_do_nothing(lam):
+    @lam.traced('outer')
+    def outer():
+        with lam.trace_span('inner'):
+            lam.record_span('marker', time.monotonic())
+        return 'result'
+
+    assert lam.current_trace.get() is None
+    assert outer() == 'result'
+
+def test_worker_threads_continue_current_span(lam, trace):
+    with lam.trace_span('retrieval'):
+        future = lam.submit_traced(lam.retrieval_executor, lam.traced('kendra')(lambda: 'done'))
+        assert future.result() == 'done'
+
+    assert span_names(trace) == ['retrieval/kendra', 'retrieval']
+
+def test_timings_sum_stages_by_last_segment(lam, trace):
+    trace.record('prepare/kendra', trace.started, 0.010)
+    trace.record('prepare/web/kendra', trace.started + 0.001, 0.005)
+    trace.record('generate', trace.started + 0.002, 0.100)
+    trace.add_usage({'input_tokens': 120, 'output_tokens': 30})
+    trace.add_usage({'input_tokens': 5})
+    trace.annotate(expertise_level='expert')
+
+    timings = trace.timings()
+
+    assert timings['request_id'] == 'test-request'
+    assert timings['stages'] == {'kendra': 15.0, 'generate': 100.0}
+    assert [span['name'] for span in timings['spans']] == ['prepare/kendra', 'prepare/web/kendra', 'generate']
+    assert timings['tokens'] == {'input_tokens': 125, 'output_tokens': 30, 'bedrock_calls': 2}
+    assert timings['expertise_level'] == 'expert'
+
+def test_emf_record_lists_stage_and_token_metrics(lam, trace, capsys, monkeypatch):
+    monkeypatch.setattr(lam, 'TRACE_EMF_ENABLED', True)
+    monkeypatch.setattr(lam, 'TRACE_LOCAL_SINK', '')
+    trace.record('retrieval/kendra', trace.started, 0.020)
+    trace.add_usage({'input_tokens': 10, 'output_tokens': 4})
+
+    lam.emit_trace_metrics(trace)
+
+    record = json.loads(capsys.readouterr().out.strip())
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == lam.TRACE_NAMESPACE
+    assert directive['Dimensions'] == [['FunctionName']]
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    assert units == {
+        'kendra': 'Milliseconds', 'total': 'Milliseconds',
+        'input_tokens': 'Count', 'output_tokens': 'Count', 'bedrock_calls': 'Count'
+    }
+    # 每個指標都必須是記錄的頂層欄位
+    assert all(name in record for name in units)
+    assert record['kendra'] == 20.0
+    assert record['RequestId'] == 'test-request'
+
+def test_emf_disabled_writes_only_local_sink(lam, trace, capsys, monkeypatch, tmp_path):
+    sink = tmp_path / 'trace.jsonl'
+    monkeypatch.setattr(lam, 'TRACE_EMF_ENABLED', False)
+    monkeypatch.setattr(lam, 'TRACE_LOCAL_SINK', str(sink))
+
+    lam.emit_trace_metrics(trace)
+    lam.emit_trace_metrics(trace)
+
+    assert capsys.readouterr().out == ''
+    lines = sink.read_text(encoding='utf-8').splitlines()
+    assert [json.loads(line)['RequestId'] for line in lines] == ['test-request', 'test-request']
+
+    monkeypatch.setattr(lam, 'TRACE_LOCAL_SINK', '')
+    lam.emit_trace_metrics(trace)
+    assert capsys.readouterr().out == ''
+
+@pytest.fixture
+def chat(lam, fakes, monkeypatch):
+    """關閉快取與網絡搜索，讓每次請求都走完檢索與生成"""
+    monkeypatch.setattr(lam, 'answer_cache', lam.TTLCache(lam.ANSWER_CACHE_SIZE, lam.ANSWER_CACHE_TTL))
+    monkeypatch.setattr(lam, 'answer_cache_table', None)
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+    monkeypatch.setattr(lam, 'SEMANTIC_CACHE_ENABLED', False)
+    monkeypatch.setattr(lam, 'WEB_SEARCH_ENABLED', False)
+    monkeypatch.setattr(lam, 'TRACE_EMF_ENABLED', False)
+    monkeypatch.setattr(lam, 'TRACE_LOCAL_SINK', '')
+
+def handler_body(lam, **body):
+    response = lam.lambda_handler({'user_id': 'test-user', **body}, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+def test_handler_returns_timings_on_request(lam, fakes, chat):
+    assert 'timings' not in handler_body(lam, session_id='plain', message='316不鏽鋼的耐蝕性')
+
+    timings = handler_body(lam, session_id='timed', message='304不鏽鋼的耐蝕性', timings=True)['timings']
+
+    names = [span['name'] for span in timings['spans']]
+    assert 'history' in timings['stages']
+    assert any(name.endswith('kendra.Query') for name in names)
+    assert timings['tokens']['bedrock_calls'] >= 1
+    assert timings['total_ms'] >= max(span['start_ms'] + span['duration_ms'] for span in timings['spans']) - 1
+
+def test_stream_done_event_carries_timings(lam, fakes, chat):
+    events = list(lam.stream_chat({'user_id': 'test-user', 'session_id': 'stream', 'message': '430不鏽鋼的耐蝕性', 'timings': True}))
+
+    done = events[-1]
+    assert done['type'] == 'done'
+    assert 'stream' in done['timings']['stages']
+    assert done['timings']['tokens']['bedrock_calls'] >= 1
+    assert lam.current_trace.get() is None
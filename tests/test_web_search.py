@@ -0,0 +1,78 @@
+"""網絡搜索：只在 WEB_SEARCH_ENABLED 開啟時呼叫搜索API，各站點搜索並行執行並去重合併"""
+import pytest
+
+@pytest.fixture
+def searches(lam, fakes, monkeypatch):
+    """記錄 search_and_scrape 的呼叫"""
+    calls = []
+
+    def fake_search_and_scrape(query, api_key, search_engine_id):
+        calls.append(query)
+        return [{'title': 'ASTM A240', 'link': 'https://example.com/a240', 'snippet': 'Cr 18.0-20.0'}], []
+
+    monkeypatch.setattr(lam, 'search_and_scrape', fake_search_and_scrape)
+    monkeypatch.setattr(lam, 'session_cache', lam.SessionCache(lam.SESSION_CACHE_MAX_BYTES))
+    return calls
+
+def ask(lam, message, session_id='web'):
+    return lam.prepare_request({'user_id': 'test-user', 'session_id': session_id, 'message': message})
+
+def test_standards_question_does_not_search_when_disabled(lam, searches, monkeypatch):
+    monkeypatch.setattr(lam, 'WEB_SEARCH_ENABLED', False)
+
+    state = ask(lam, 'ASTM A240 304 的成分標準')
+
+    assert state['requires_web_search']
+    assert searches == []
+
+def test_standards_question_searches_once_when_enabled(lam, searches, monkeypatch):
+    monkeypatch.setattr(lam, 'WEB_SEARCH_ENABLED', True)
+
+    state = ask(lam, 'ASTM A240 304 的成分標準')
+
+    assert state['requires_web_search']
+    assert len(searches) == 1
+    assert 'https://example.com/a240' in state['prompt']
+
+def test_normalize_url_ignores_cosmetic_differences(lam):
+    variants = [
+        'https://www.Example.com/a240/?utm_source=google',
+        'https://example.com/a240#composition',
+        'HTTPS://example.com/a240'
+    ]
+
+    assert {lam.normalize_url(url) for url in variants} == {'https://example.com/a240'}
+    assert lam.normalize_url('https://example.com/a240?page=2') != lam.normalize_url('https://example.com/a240')
+
+def test_site_searches_run_concurrently_and_merge_in_query_order(lam, monkeypatch):
+    queries = []
+
+    def fake_web_search(query, api_key, search_engine_id, deadline=None):
+        queries.append(query)
+        if 'site:iso.org' in query:
+            # 超過期限的站點搜索不影響其他結果
+            lam.time.sleep(1.0)
+            return [{'title': 'late', 'link': 'https://iso.org/late', 'snippet': ''}]
+        lam.time.sleep(0.05)
+        site = query.split('site:')[-1] if 'site:' in query else 'google.com'
+        return [
+            {'title': site, 'link': f'https://{site}/304', 'snippet': ''},
+            {'title': 'shared', 'link': 'https://www.worldstainless.org/304/?utm_source=x', 'snippet': ''}
+        ]
+
+    monkeypatch.setattr(lam, 'web_search', fake_web_search)
+    started = lam.time.monotonic()
+
+    results = lam.enhanced_web_search('ASTM A240 304', 'key', 'engine', deadline=0.5)
+
+    assert lam.time.monotonic() - started < 0.9
+    assert len(queries) == 10
+    links = [result['link'] for result in results]
+    assert links[:2] == ['https://google.com/304', 'https://www.worldstainless.org/304/?utm_source=x']
+    assert 'https://iso.org/late' not in links
+    assert len(links) == len({lam.normalize_url(link) for link in links}) == 9
+
+def test_missing_credentials_skip_search(lam, monkeypatch):
+    monkeypatch.setattr(lam, 'web_search', lambda *args: pytest.fail('should not search'))
+
+    assert lam.enhanced_web_search('ASTM A240', '', 'engine') == []